@@ -0,0 +1,183 @@
+#!/usr/bin.env/python
+# -*- coding: utf-8 -*-
+"""
+In-process caching of Numpy arrays, such as decoded event data and the results
+of expensive estimates, held within a byte budget.
+
+Copyright 2020 Ross Burton
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the
+Software, and to permit persons to whom the Software is furnished
+to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+
+__author__ = "Ross Burton"
+__copyright__ = "Copyright 2020, CytoPy"
+__credits__ = ["Ross Burton", "Simone Cuff", "Andreas Artemiou", "Matthias Eberl"]
+__license__ = "MIT"
+__version__ = "1.0.0"
+__maintainer__ = "Ross Burton"
+__email__ = "burtonrj@cardiff.ac.uk"
+__status__ = "Production"
+
+
+class ArrayCache:
+    """
+    Thread-safe, least-recently-used, in-process cache of Numpy arrays. Keys are tuples, ordered
+    from the most general to the most specific component (e.g. file path followed by source) such
+    that related entries can be invalidated together. The total size of the cached arrays is held
+    within a byte budget by evicting the least recently used entries; an array larger than the budget
+    is never cached. Cached arrays are read-only. Used for decoded event data (see CytoPy.data.fcs)
+    and estimated densities (see CytoPy.data.gate).
+
+    Parameters
+    ----------
+    max_bytes: int
+        Byte budget; a value of 0 disables caching
+    """
+    def __init__(self,
+                 max_bytes: int):
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.nbytes = 0
+        self._max_bytes = int(max_bytes)
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value: int):
+        assert value >= 0, "max_bytes must be a positive integer or 0"
+        with self._lock:
+            self._max_bytes = int(value)
+            self._evict()
+
+    def __contains__(self, key: tuple):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def fits(self,
+             nbytes: int) -> bool:
+        """
+        Test if an array of the given size can be held within the byte budget
+
+        Parameters
+        ----------
+        nbytes: int
+
+        Returns
+        -------
+        bool
+        """
+        return 0 < nbytes <= self._max_bytes
+
+    def get(self,
+            key: tuple) -> tuple or None:
+        """
+        Retrieve a cached entry, marking it as most recently used.
+
+        Parameters
+        ----------
+        key: tuple
+
+        Returns
+        -------
+        tuple or None
+            Cached array followed by any additional attributes stored with it,
+            or None if not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self,
+            key: tuple,
+            values: np.ndarray,
+            *attrs):
+        """
+        Add an array to the cache, evicting least recently used entries to stay within budget.
+        Ignored if the array alone exceeds the budget.
+
+        Parameters
+        ----------
+        key: tuple
+        values: Numpy.Array
+        attrs:
+            Additional attributes to store with the array (e.g. channels and markers of an event matrix)
+
+        Returns
+        -------
+        None
+        """
+        if not self.fits(values.nbytes):
+            return
+        values.flags.writeable = False
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (values, *attrs)
+            self.nbytes += values.nbytes
+            self._evict()
+
+    def invalidate(self,
+                   *prefix):
+        """
+        Remove cached entries whose key begins with the given components e.g. invalidate(path)
+        removes all entries for a file and invalidate(path, source) those of a single source.
+
+        Parameters
+        ----------
+        prefix:
+            Leading components of the keys to remove
+
+        Returns
+        -------
+        None
+        """
+        n = len(prefix)
+        with self._lock:
+            for key in [k for k in self._entries.keys() if k[:n] == prefix]:
+                self._pop(key)
+
+    def clear(self):
+        """
+        Remove all cached entries
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._entries = OrderedDict()
+            self.nbytes = 0
+
+    def _pop(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[0].nbytes
+
+    def _evict(self):
+        while self.nbytes > self._max_bytes:
+            self._pop(next(iter(self._entries.keys())))
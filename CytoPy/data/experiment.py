@@ -782,7 +782,8 @@ class Experiment(mongoengine.Document):
                        verbose: bool = True,
                        processing_datetime: str or None = None,
                        collection_datetime: str or None = None,
-                       missing_error: str = "raise"):
+                       missing_error: str = "raise",
+                       compression: str or None = None):
         """
         Add a new sample (FileGroup) to this experiment
 
@@ -812,6 +813,9 @@ class Experiment(mongoengine.Document):
             AssertionError or "warn" to flag a UserWarning but continue execution.
         processing_datetime: str, optional
         collection_datetime: str, optional
+        compression: str, optional
+            If given (either 'gzip' or 'lzf'), event data is stored chunked and compressed.
+            See CytoPy.data.fcs.FileGroup for details.
 
         Returns
         --------
@@ -848,7 +852,8 @@ class Experiment(mongoengine.Document):
                             processing_datetime=processing_datetime,
                             data=fcs_file.event_data,
                             channels=[x.get("channel") for x in mappings],
-                            markers=[x.get("marker") for x in mappings])
+                            markers=[x.get("marker") for x in mappings],
+                            compression=compression)
         for ctrl_id, path in controls_path.items():
             feedback(f"Adding control file {ctrl_id}...")
             if isinstance(path, str):
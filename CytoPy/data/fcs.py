@@ -29,12 +29,13 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 from ..feedback import vprint
+from ..cache import ArrayCache
 from ..flow.tree import construct_tree
-from ..flow.transforms import apply_transform
+from ..flow.transforms import apply_transform, ELEMENTWISE_TRANSFORMS
 from ..flow.neighbours import knn, calculate_optimal_neighbours
-from ..flow.sampling import uniform_downsampling
+from ..flow.sampling import uniform_downsampling, uniform_sample_idx
 from .geometry import create_convex_hull
-from .population import Population, merge_populations, PolygonGeom
+from .population import Population, merge_populations, PolygonGeom, encode_index
 from warnings import warn
 from typing import List, Generator
 import pandas as pd
@@ -74,12 +75,402 @@ def _column_names(df: pd.DataFrame,
     -------
     Pandas.DataFrame
     """
+    df.columns = _column_labels(channels=channels, markers=markers, preference=preference)
+    return df
+
+
+def _column_labels(channels: list,
+                   markers: list,
+                   preference: str = "markers") -> list:
+    """
+    Given lists of channels and markers, generate the list of column names
+    according to the given preference. If the preferred name is missing for
+    a column, the alternative is used.
+
+    Parameters
+    ----------
+    channels: list
+    markers: list
+    preference: str
+        Valid values are: 'markers' or 'channels'
+
+    Returns
+    -------
+    list
+    """
     mappings = [{"channels": c, "markers": m} for c, m in zip(channels, markers)]
     assert preference in ["markers", "channels"], "preference should be either 'markers' or 'channels'"
     other = [x for x in ["markers", "channels"] if x != preference][0]
-    col_names = list(map(lambda x: x[preference] if x[preference] else x[other], mappings))
-    df.columns = col_names
-    return df
+    return list(map(lambda x: x[preference] if x[preference] else x[other], mappings))
+
+
+def _read_blocks(dataset: h5py.Dataset,
+                 rows: np.ndarray,
+                 col_sel: slice or list,
+                 out: np.ndarray,
+                 chunk_size: int) -> None:
+    """
+    Read the given (sorted, unique) rows of a HDF5 dataset into out, in blocks of 'chunk_size'
+    events spanning the rows; see _read_events
+
+    Parameters
+    ----------
+    dataset: h5py.Dataset
+    rows: Numpy.Array
+    col_sel: slice or list
+    out: Numpy.Array
+    chunk_size: int
+
+    Returns
+    -------
+    None
+    """
+    first = rows[0]
+    if dataset.chunks is not None:
+        # Align blocks to chunk boundaries so that no chunk is decompressed twice
+        chunk_size = max(1, chunk_size // dataset.chunks[0]) * dataset.chunks[0]
+        first = (first // dataset.chunks[0]) * dataset.chunks[0]
+    for start in range(first, rows[-1] + 1, chunk_size):
+        end = min(start + chunk_size, rows[-1] + 1)
+        i, j = np.searchsorted(rows, [start, end])
+        if i == j:
+            continue
+        block = dataset[start:end] if isinstance(col_sel, slice) else dataset[start:end, col_sel]
+        out[i:j] = block[rows[i:j] - start]
+
+
+def _read_events(dataset: h5py.Dataset,
+                 columns: np.ndarray or None = None,
+                 idx: np.ndarray or None = None,
+                 chunk_size: int = 100000,
+                 sparse_gap: int = 16) -> np.ndarray:
+    """
+    Read a selection of events from a HDF5 dataset of shape (n_events, n_columns), touching
+    only the requested columns and rows. Sparse selections of rows (no more than 'chunk_size'
+    rows, on average at least 'sparse_gap' rows apart) from uncompressed datasets are read
+    row by row, so only the requested rows are read from disk. Otherwise rows are read in blocks
+    of 'chunk_size' events spanning the requested index, so peak memory is bounded by the block
+    size plus the returned selection rather than the size of the full dataset (although every
+    block spanned by the index is read from disk).
+
+    Parameters
+    ----------
+    dataset: h5py.Dataset
+    columns: Numpy.Array (optional)
+        Integer positions of the columns to read; if not given, all columns are read.
+        Order of the returned columns follows the order given.
+    idx: Numpy.Array (optional)
+        Integer positions of the rows (events) to read; if not given, all rows are read.
+        Order of the returned rows follows the order given (duplicates are permitted)
+    chunk_size: int (default=100000)
+        Number of events read from disk at a time
+    sparse_gap: int (default=16)
+        Average spacing of the requested rows above which rows are read individually
+        rather than in blocks (uncompressed datasets only)
+
+    Returns
+    -------
+    Numpy.Array
+    """
+    n_events, n_columns = dataset.shape
+    col_sel, col_order = slice(None), None
+    if columns is not None:
+        columns = np.asarray(columns, dtype=np.int64)
+        # h5py requires increasing, unique indices for fancy selection
+        col_sel, col_order = np.unique(columns, return_inverse=True)
+        if col_sel.shape[0] == n_columns:
+            col_sel = slice(None)
+        else:
+            col_sel = list(col_sel)
+    if idx is None:
+        values = dataset[:] if isinstance(col_sel, slice) else dataset[:, col_sel]
+    else:
+        idx = np.asarray(idx, dtype=np.int64)
+        rows = np.unique(idx)
+        n_cols = n_columns if isinstance(col_sel, slice) else len(col_sel)
+        values = np.empty((rows.shape[0], n_cols), dtype=dataset.dtype)
+        if rows.shape[0] > 0:
+            assert rows[0] >= 0 and rows[-1] < n_events, "Index out of bounds for requested source"
+            sparse = rows.shape[0] <= chunk_size and rows.shape[0] * sparse_gap <= rows[-1] - rows[0] + 1
+            if dataset.compression is None and sparse:
+                # h5py permits a list selection on only one axis, so columns are selected in memory
+                values = dataset[rows]
+                if not isinstance(col_sel, slice):
+                    values = values[:, col_sel]
+            else:
+                _read_blocks(dataset=dataset, rows=rows, col_sel=col_sel, out=values, chunk_size=chunk_size)
+        values = values[np.searchsorted(rows, idx)]
+    if col_order is not None:
+        values = values[:, col_order]
+    return values
+
+
+# Shared by all FileGroups in the process and keyed by (HDF5 path, source, ...): decoded event
+# matrices and transformed columns (see FileGroup.data and FileGroup.load_population_df)
+event_cache = ArrayCache(max_bytes=2 ** 30)
+transform_cache = ArrayCache(max_bytes=2 ** 29)
+
+
+def _column_selection(channels: List[str],
+                      markers: List[str],
+                      columns: List[str] or None = None,
+                      preference: str = "markers") -> (list, np.ndarray or None):
+    """
+    Given the channels and markers of an event matrix, return the names of the requested columns
+    and their integer positions within the matrix.
+
+    Parameters
+    ----------
+    channels: list
+    markers: list
+    columns: list (optional)
+        Requested columns named according to the given preference; all columns if not given
+    preference: str
+        Valid values are: 'markers' or 'channels'
+
+    Returns
+    -------
+    list, Numpy.Array or None
+        Column names and column positions (None if all columns are requested)
+    """
+    col_names = _column_labels(channels=channels, markers=markers, preference=preference)
+    if columns is None:
+        return col_names, None
+    invalid = [c for c in columns if c not in col_names]
+    assert len(invalid) == 0, f"Invalid column(s) {invalid}, expected one of: {col_names}"
+    return list(columns), np.array([col_names.index(c) for c in columns], dtype=np.int64)
+
+
+def _memmap_events(path: str,
+                   dataset: h5py.Dataset) -> np.memmap or None:
+    """
+    Map an event dataset directly from its offset within the HDF5 file as a read-only
+    Numpy.memmap, such that no data is copied into memory; pages are read on access and
+    shared (via the OS page cache) by all processes mapping the same file. Only possible
+    for contiguous, uncompressed datasets; returns None otherwise.
+
+    Parameters
+    ----------
+    path: str
+        Path to the HDF5 file
+    dataset: h5py.Dataset
+
+    Returns
+    -------
+    Numpy.memmap or None
+    """
+    if dataset.chunks is not None or dataset.compression is not None:
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(path, mode="r", dtype=dataset.dtype, offset=offset, shape=dataset.shape)
+
+
+def _event_dataset_kwargs(shape: tuple,
+                          compression: str or None = None,
+                          compression_opts: int or None = None,
+                          chunks: tuple or None = None) -> dict:
+    """
+    Generate the keyword arguments for h5py.Group.create_dataset that define the storage layout
+    of an event matrix. If compression is None, an empty dictionary is returned and the data is
+    stored contiguous and uncompressed. Otherwise, the matrix is chunked by event block and column
+    block (by default, 65536 events of a single column, such that per-channel access only decompresses
+    the channel requested) and compressed with the given filter, following a byte shuffle.
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape of the event matrix (n_events, n_columns)
+    compression: str (optional)
+        Either 'gzip' or 'lzf'
+    compression_opts: int (optional)
+        Compression level for 'gzip' (0-9); ignored for 'lzf'
+    chunks: tuple (optional)
+        Chunk shape as (n_events, n_columns); defaults to (65536, 1)
+
+    Returns
+    -------
+    dict
+    """
+    if compression is None:
+        return {}
+    assert compression in ["gzip", "lzf"], "compression should be one of: 'gzip', 'lzf'"
+    chunks = chunks or (65536, 1)
+    assert len(chunks) == 2, "chunks should be a tuple of (n_events, n_columns)"
+    chunks = tuple(max(1, min(c, s)) for c, s in zip(chunks, shape))
+    kwargs = dict(chunks=chunks, compression=compression, shuffle=True)
+    if compression == "gzip":
+        kwargs["compression_opts"] = compression_opts if compression_opts is not None else 4
+    return kwargs
+
+
+def _create_event_dataset(f: h5py.Group,
+                          name: str,
+                          data: np.ndarray,
+                          block_size: int = 1000000,
+                          **kwargs) -> h5py.Dataset:
+    """
+    Create a dataset for an event matrix using the storage layout defined by the keyword
+    arguments (see _event_dataset_kwargs). Data given as a h5py.Dataset is copied across in
+    blocks of events so that migrating an existing file does not load the full matrix into memory.
+
+    Parameters
+    ----------
+    f: h5py.Group
+    name: str
+    data: Numpy.Array or h5py.Dataset
+    block_size: int (default=1000000)
+        Number of events copied at a time when data is a h5py.Dataset
+    kwargs:
+        Storage layout keyword arguments passed to create_dataset
+
+    Returns
+    -------
+    h5py.Dataset
+    """
+    if not isinstance(data, h5py.Dataset):
+        return f.create_dataset(name=name, data=data, **kwargs)
+    dataset = f.create_dataset(name=name, shape=data.shape, dtype=data.dtype, **kwargs)
+    if dataset.chunks is not None:
+        block_size = max(1, block_size // dataset.chunks[0]) * dataset.chunks[0]
+    for start in range(0, data.shape[0], block_size):
+        dataset[start:start + block_size] = data[start:start + block_size]
+    return dataset
+
+
+def _dataset_layout(dataset: h5py.Dataset) -> dict:
+    """
+    Given an existing event dataset, return the storage layout keyword arguments
+    (see _event_dataset_kwargs) that describe it.
+
+    Parameters
+    ----------
+    dataset: h5py.Dataset
+
+    Returns
+    -------
+    dict
+    """
+    if dataset.compression not in ["gzip", "lzf"]:
+        return {}
+    return {"compression": dataset.compression,
+            "compression_opts": dataset.compression_opts,
+            "chunks": dataset.chunks}
+
+
+def migrate_hdf5_layout(path: str,
+                        compression: str or None = "gzip",
+                        compression_opts: int or None = None,
+                        chunks: tuple or None = None,
+                        verbose: bool = True):
+    """
+    Rewrite an existing FileGroup HDF5 file so that the event data (primary and controls) follows the
+    given storage layout (see _event_dataset_kwargs); setting compression to None reverts to contiguous,
+    uncompressed storage. Population indexes, clusters, mappings and meta labels are copied as is. The
+    migrated file is written alongside the original and then replaces it, so disk space held by the old
+    layout is released.
+
+    Parameters
+    ----------
+    path: str
+        Path to the HDF5 file (see FileGroup.h5path)
+    compression: str (optional; default='gzip')
+        Either 'gzip', 'lzf' or None
+    compression_opts: int (optional)
+        Compression level for 'gzip'
+    chunks: tuple (optional)
+        Chunk shape as (n_events, n_columns); defaults to (65536, 1)
+    verbose: bool (default=True)
+
+    Returns
+    -------
+    None
+    """
+    feedback = vprint(verbose)
+    assert os.path.isfile(path), f"Could not locate HDF5 file {path}"
+    tmp_path = f"{path}.migrate"
+    with h5py.File(path, "r") as src, h5py.File(tmp_path, "w") as dst:
+        event_datasets = list(src["mappings"].keys()) if "mappings" in src.keys() else ["primary"]
+        for key, value in src.attrs.items():
+            dst.attrs[key] = value
+        for key in src.keys():
+            if key in event_datasets:
+                feedback(f"Migrating {key} event data...")
+                _create_event_dataset(dst,
+                                      name=key,
+                                      data=src[key],
+                                      **_event_dataset_kwargs(shape=src[key].shape,
+                                                              compression=compression,
+                                                              compression_opts=compression_opts,
+                                                              chunks=chunks))
+            else:
+                src.copy(src[key], dst, name=key)
+    os.replace(tmp_path, path)
+    event_cache.invalidate(path)
+    transform_cache.invalidate(path)
+    feedback(f"Migrated {path}")
+
+
+def _write_index(f: h5py.File,
+                 key: str,
+                 idx: np.ndarray):
+    """
+    Write an index of events to the HDF5 file, compressed with delta and run-length
+    encoding (see CytoPy.data.population.encode_index).
+
+    Parameters
+    ----------
+    f: h5py.File
+    key: str
+    idx: Numpy.Array
+
+    Returns
+    -------
+    None
+    """
+    dataset = f.create_dataset(key, data=encode_index(idx))
+    dataset.attrs["encoding"] = "rle"
+
+
+class _TrackedDict(dict):
+    """
+    Dictionary that records the keys set or deleted since it was last marked clean,
+    so that only those entries need to be written to disk
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed = set(self.keys())
+        self.deleted = set()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed.add(key)
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.deleted.add(key)
+        self.changed.discard(key)
+
+    def pop(self, key, *args):
+        if key in self:
+            self.deleted.add(key)
+            self.changed.discard(key)
+        return super().pop(key, *args)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self.deleted.update(self.keys())
+        self.changed = set()
+        super().clear()
+
+    def mark_clean(self):
+        self.changed = set()
+        self.deleted = set()
 
 
 class FileGroup(mongoengine.Document):
@@ -105,6 +496,12 @@ class FileGroup(mongoengine.Document):
         Date and time of sample collection
     processing_datetime: DateTime, optional
         Date and time of sample processing
+    compression: str, optional
+        Only used when creating a new FileGroup. If given (either 'gzip' or 'lzf'), event data is
+        stored chunked by event and column block and compressed; controls follow the layout of the
+        primary data. Existing files can be converted using migrate_storage.
+    compression_opts: int, optional
+        Compression level when compression is 'gzip'
     """
     primary_id = mongoengine.StringField(required=True)
     data_directory = mongoengine.StringField(required=True)
@@ -125,18 +522,27 @@ class FileGroup(mongoengine.Document):
         data = values.pop("data", None)
         channels = values.pop("channels", None)
         markers = values.pop("markers", None)
+        compression = values.pop("compression", None)
+        compression_opts = values.pop("compression_opts", None)
         self.columns_default = values.pop("columns_default", "markers")
         assert self.columns_default in ["markers", "channels"], \
             "columns_default must be one of: 'markers', 'channels'"
         super().__init__(*args, **values)
-        self.cell_meta_labels = {}
+        # Meta labels of an existing FileGroup are read on first access
+        self._cell_meta_labels = _TrackedDict() if data is not None else None
+        # Populations whose HDF5 records must be removed on next save (deleted or replaced)
+        self._stale_populations = set()
         if data is not None:
             assert not self.id, "This FileGroup has already been defined"
             assert channels is not None, "Must provide channels to create new FileGroup"
             assert markers is not None, "Must provide markers to create new FileGroup"
             self.save()
             self.h5path = os.path.join(self.data_directory, f"{self.id.__str__()}.hdf5")
-            self._init_new_file(data=data, channels=channels, markers=markers)
+            self._init_new_file(data=data,
+                                channels=channels,
+                                markers=markers,
+                                compression=compression,
+                                compression_opts=compression_opts)
         else:
             assert self.id is not None, "FileGroup has not been previously defined. Please provide primary data."
             self.h5path = os.path.join(self.data_directory, f"{self.id.__str__()}.hdf5")
@@ -147,11 +553,38 @@ class FileGroup(mongoengine.Document):
                 warn(f"Failed to load data for {self.primary_id} ({self.id}); "
                      f"data may be corrupt or missing; {str(err)}")
 
+    @property
+    def cell_meta_labels(self) -> dict:
+        if self._cell_meta_labels is None:
+            self._cell_meta_labels = _TrackedDict()
+            with h5py.File(self.h5path, "r") as f:
+                if "cell_meta_labels" in f.keys():
+                    for meta in f["cell_meta_labels"].keys():
+                        self._cell_meta_labels[meta] = f[f"cell_meta_labels/{meta}"][:]
+            self._cell_meta_labels.mark_clean()
+        return self._cell_meta_labels
+
+    @cell_meta_labels.setter
+    def cell_meta_labels(self, labels: dict):
+        if self._cell_meta_labels is None:
+            with h5py.File(self.h5path, "r") as f:
+                deleted = set(f["cell_meta_labels"].keys()) if "cell_meta_labels" in f.keys() else set()
+        else:
+            deleted = set(self._cell_meta_labels.keys()).union(self._cell_meta_labels.deleted)
+        self._cell_meta_labels = _TrackedDict(labels)
+        self._cell_meta_labels.deleted = deleted - set(labels.keys())
+
     def data(self,
              source: str,
-             sample_size: int or float or None = None) -> pd.DataFrame:
+             sample_size: int or float or None = None,
+             columns: List[str] or None = None,
+             idx: np.ndarray or None = None,
+             mmap: bool = False,
+             cache: bool = False) -> pd.DataFrame:
         """
-        Load the FileGroup dataframe for the desired source file.
+        Load the FileGroup dataframe for the desired source file. Only the requested columns
+        and events are read from disk, unless the event matrix is held in the event cache (see
+        CytoPy.cache.ArrayCache), in which case they are sliced from memory.
 
         Parameters
         ----------
@@ -159,18 +592,66 @@ class FileGroup(mongoengine.Document):
             Name of the file to load from e.g. either "primary" or the name of a control
         sample_size: int or float (optional)
             Sample the DataFrame
+        columns: list (optional)
+            Columns to load, named according to the columns_default of this FileGroup.
+            If not given, all columns are loaded.
+        idx: Numpy.Array (optional)
+            Integer index of the events to load e.g. the index of a Population. The
+            resulting DataFrame is indexed by these values. If not given, all events are loaded.
+        mmap: bool (default=False)
+            If True, the event matrix is memory mapped from the HDF5 file rather than read (the
+            event cache is bypassed). If all columns and events are requested, the DataFrame
+            returned is backed by the read-only memory map, so no data is copied and the pages
+            are shared between processes reading the same file. Only available for contiguous,
+            uncompressed storage; otherwise a warning is given and data is read as normal.
+        cache: bool (default=False)
+            If True and the event matrix is not already held in the event cache, the full matrix is
+            decoded and added to the cache (provided it fits within the budget of the cache), such
+            that subsequent requests for this source are served from memory
         Returns
         -------
         Pandas.DataFrame
         """
-        with h5py.File(self.h5path, "r") as f:
-            assert source in f.keys(), f"Invalid source, expected one of: {f.keys()}"
-            channels = [x.decode("utf-8") for x in f[f"mappings/{source}/channels"][:]]
-            markers = [x.decode("utf-8") for x in f[f"mappings/{source}/markers"][:]]
-            data = _column_names(df=pd.DataFrame(f[source][:]),
-                                 channels=channels,
-                                 markers=markers,
-                                 preference=self.columns_default)
+        cached = None if mmap else event_cache.get((self.h5path, source))
+        if cached is None:
+            with h5py.File(self.h5path, "r") as f:
+                assert source in f.keys(), f"Invalid source, expected one of: {f.keys()}"
+                channels = [x.decode("utf-8") for x in f[f"mappings/{source}/channels"][:]]
+                markers = [x.decode("utf-8") for x in f[f"mappings/{source}/markers"][:]]
+                col_names, col_idx = _column_selection(channels=channels,
+                                                       markers=markers,
+                                                       columns=columns,
+                                                       preference=self.columns_default)
+                mapped = _memmap_events(path=self.h5path, dataset=f[source]) if mmap else None
+                if mmap and mapped is None:
+                    warn(f"{source} is chunked or compressed and cannot be memory mapped; "
+                         f"see FileGroup.migrate_storage to convert to contiguous storage")
+                if mapped is not None:
+                    cached = (mapped, channels, markers)
+                elif not cache or not event_cache.fits(f[source].nbytes):
+                    events = _read_events(dataset=f[source], columns=col_idx, idx=idx)
+                else:
+                    # Decode the full matrix once and serve subsequent requests from memory
+                    cached = (_read_events(dataset=f[source]), channels, markers)
+                    event_cache.put((self.h5path, source), *cached)
+        if cached is not None:
+            events, channels, markers = cached
+            col_names, col_idx = _column_selection(channels=channels,
+                                                   markers=markers,
+                                                   columns=columns,
+                                                   preference=self.columns_default)
+            if idx is not None and col_idx is not None:
+                events = events[np.ix_(np.asarray(idx, dtype=np.int64), col_idx)]
+            elif idx is not None:
+                events = events[np.asarray(idx, dtype=np.int64)]
+            elif col_idx is not None:
+                events = events[:, col_idx]
+            elif not isinstance(events, np.memmap):
+                # Cached matrix is shared and read-only
+                events = events.copy()
+        data = pd.DataFrame(events, columns=col_names)
+        if idx is not None:
+            data.index = np.asarray(idx)
         if sample_size is not None:
             return uniform_downsampling(data=data,
                                         sample_size=sample_size)
@@ -179,7 +660,9 @@ class FileGroup(mongoengine.Document):
     def _init_new_file(self,
                        data: np.array,
                        channels: List[str],
-                       markers: List[str]):
+                       markers: List[str],
+                       compression: str or None = None,
+                       compression_opts: int or None = None):
         """
         Under the assumption that this FileGroup has not been previously defined,
         generate a HDF5 file and initialise the root Population
@@ -189,13 +672,23 @@ class FileGroup(mongoengine.Document):
         data: Numpy.Array
         channels: list
         markers: list
+        compression: str (optional)
+            If given, event data is stored chunked and compressed (see _event_dataset_kwargs)
+        compression_opts: int (optional)
 
         Returns
         -------
         None
         """
+        event_cache.invalidate(self.h5path)
+        transform_cache.invalidate(self.h5path)
         with h5py.File(self.h5path, "w") as f:
-            f.create_dataset(name="primary", data=data)
+            _create_event_dataset(f,
+                                  name="primary",
+                                  data=data,
+                                  **_event_dataset_kwargs(shape=data.shape,
+                                                          compression=compression,
+                                                          compression_opts=compression_opts))
             f.create_group("mappings")
             f.create_group("mappings/primary")
             f.create_dataset("mappings/primary/channels", data=np.array(channels, dtype='S'))
@@ -218,7 +711,8 @@ class FileGroup(mongoengine.Document):
                       channels: List[str],
                       markers: List[str]):
         """
-        Add a new control file to this FileGroup.
+        Add a new control file to this FileGroup. Event data is stored using the same
+        layout as the primary data.
 
         Parameters
         ----------
@@ -233,10 +727,18 @@ class FileGroup(mongoengine.Document):
         """
         with h5py.File(self.h5path, "a") as f:
             assert ctrl_id not in self.controls, f"Entry for {ctrl_id} already exists"
-            f.create_dataset(name=ctrl_id, data=data)
+            layout = _dataset_layout(f["primary"])
+            # Chunk shape of the primary data is clipped to its own shape, so use the default
+            layout.pop("chunks", None)
+            _create_event_dataset(f,
+                                  name=ctrl_id,
+                                  data=data,
+                                  **_event_dataset_kwargs(shape=data.shape, **layout))
             f.create_group(f"mappings/{ctrl_id}")
             f.create_dataset(f"mappings/{ctrl_id}/channels", data=np.array(channels, dtype='S'))
             f.create_dataset(f"mappings/{ctrl_id}/markers", data=np.array(markers, dtype='S'))
+        event_cache.invalidate(self.h5path, ctrl_id)
+        transform_cache.invalidate(self.h5path, ctrl_id)
         root = self.get_population(population_name="root")
         root.set_ctrl_index(**{ctrl_id: np.arange(0, data.shape[0])})
         self.controls.append(ctrl_id)
@@ -244,7 +746,9 @@ class FileGroup(mongoengine.Document):
 
     def _load_populations(self):
         """
-        Load indexes for existing populations from HDF5 file. This includes indexes for controls and clusters.
+        Check that indexes for existing populations (including those of controls and clusters)
+        are present in the HDF5 file. Indexes are not read here; each is read from disk when
+        first accessed (see Population.defer_index_loading).
 
         Returns
         -------
@@ -252,24 +756,18 @@ class FileGroup(mongoengine.Document):
         """
         assert self._hdf5_exists(), f"Could not locate FileGroup HDF5 record {self.h5path}"
         with h5py.File(self.h5path, "r") as f:
-            if "cell_meta_labels" in f.keys():
-                for meta in f["cell_meta_labels"].keys():
-                    self.cell_meta_labels[meta] = f[f"cell_meta_labels/{meta}"][:]
             for pop in self.populations:
                 k = f"/index/{pop.population_name}"
                 if k + "/primary" not in f.keys():
                     warn(f"Population index missing for {pop.population_name}!")
-                else:
-                    pop.index = f[k + "/primary"][:]
-                    ctrls = [x for x in f[k].keys() if x != "primary"]
-                    for c in ctrls:
-                        pop.set_ctrl_index(**{c: f[k + f"/{c}"][:]})
+                    continue
                 k = f"/clusters/{pop.population_name}"
-                for c in pop.clusters:
-                    if f"{c.cluster_id}_{c.tag}" not in f[k].keys():
-                        warn(f"Cluster index missing for {c.cluster_id}; tag {c.tag} in population {pop.population_name}!")
-                    else:
-                        c.index = f[k + f"/{c.cluster_id}_{c.tag}"][:]
+                missing = [c for c in pop.clusters if f"{c.cluster_id}_{c.tag}" not in f[k].keys()]
+                for c in missing:
+                    warn(f"Cluster index missing for {c.cluster_id}; tag {c.tag} in population {pop.population_name}!")
+                pop.defer_index_loading(h5path=self.h5path)
+                for c in missing:
+                    c.defer_index_loading(h5path=None, key=None)
 
     def add_population(self,
                        population: Population):
@@ -286,6 +784,7 @@ class FileGroup(mongoengine.Document):
         """
         err = f"Population with name '{population.population_name}' already exists"
         assert population.population_name not in self.tree.keys(), err
+        self._stale_populations.add(population.population_name)
         self.populations.append(population)
         self.tree[population.population_name] = anytree.Node(name=population.population_name,
                                                              parent=self.tree.get(population.parent))
@@ -294,6 +793,7 @@ class FileGroup(mongoengine.Document):
                                 ctrl: str,
                                 population: str,
                                 transform: str or dict or None = "logicle",
+                                columns: List[str] or None = None,
                                 **kwargs):
         """
         Load the DataFrame for the events pertaining to a single population from a
@@ -313,6 +813,8 @@ class FileGroup(mongoengine.Document):
             value given is a string, it should be the name of the transform method applied
             to ALL columns. If it is a dictionary, keys should correspond to column names
             and values the transform to apply to said column.
+        columns: list (optional)
+            If given, only these columns are loaded
         kwargs
             Additional keyword arguments passed to estimated_ctrl_population
 
@@ -326,12 +828,7 @@ class FileGroup(mongoengine.Document):
                  f"estimate population using KNN")
             self.estimate_ctrl_population(ctrl=ctrl, population=population, **kwargs)
         idx = self.get_population(population_name=population).ctrl_index.get(ctrl)
-        data = self.data(source=ctrl).loc[idx]
-        if isinstance(transform, dict):
-            data = apply_transform(data=data, features_to_transform=transform)
-        elif isinstance(transform, str):
-            data = apply_transform(data, transform_method=transform)
-        return data
+        return self._load_transformed(source=ctrl, transform=transform, columns=columns, idx=idx)
 
     def estimate_ctrl_population(self,
                                  ctrl: str,
@@ -381,7 +878,8 @@ class FileGroup(mongoengine.Document):
                            if d is not None}
         training_data = self.load_population_df(population=population.parent,
                                                 transform=transformations,
-                                                label_downstream_affiliations=False).copy()
+                                                label_downstream_affiliations=False,
+                                                columns=features).copy()
         training_data["labels"] = 0
         training_data.loc[population.index]["labels"] = 1
         labels = training_data["labels"].values
@@ -419,7 +917,8 @@ class FileGroup(mongoengine.Document):
     def load_population_df(self,
                            population: str,
                            transform: str or dict or None = "logicle",
-                           label_downstream_affiliations: bool = False) -> pd.DataFrame:
+                           label_downstream_affiliations: bool = False,
+                           columns: List[str] or None = None) -> pd.DataFrame:
         """
         Load the DataFrame for the events pertaining to a single population.
 
@@ -439,6 +938,8 @@ class FileGroup(mongoengine.Document):
             like: "CD4+ -> CD4+CD25+ -> CD4+CD25+CD45RA+" then the population label column
             will contain the name of the lowest possible "leaf" population that an event is
             assigned too.
+        columns: list (optional)
+            If given, only these columns are loaded (e.g. the x and y axis of a gate)
 
         Returns
         -------
@@ -446,16 +947,133 @@ class FileGroup(mongoengine.Document):
         """
         assert population in self.tree.keys(), f"Invalid population, {population} does not exist"
         idx = self.get_population(population_name=population).index
-        data = self.data(source="primary").loc[idx]
-        if isinstance(transform, dict):
-            data = apply_transform(data=data, features_to_transform=transform)
-        elif isinstance(transform, str):
-            data = apply_transform(data, transform_method=transform)
+        data = self._load_transformed(source="primary", transform=transform, columns=columns, idx=idx)
         if label_downstream_affiliations:
             return self._label_downstream_affiliations(parent=population,
                                                        data=data)
         return data
 
+    def load_population_sample(self,
+                               population: str,
+                               sample_size: int or float,
+                               transform: str or dict or None = "logicle",
+                               columns: List[str] or None = None,
+                               random_state: int or np.random.Generator or None = None) -> pd.DataFrame:
+        """
+        Load a uniform sample of the events pertaining to a single population. Events are sampled
+        from the population index before any data is loaded, such that only the sampled events are
+        read from disk (in blocks, without populating the event cache) and the event matrix is never
+        held in memory in full. Element-wise transforms (see CytoPy.flow.transforms.ELEMENTWISE_TRANSFORMS)
+        are applied to the sampled events; for any other transform the population is loaded in full,
+        transformed, and then sampled.
+
+        Parameters
+        ----------
+        population: str
+            Name of the desired population
+        sample_size: int or float
+            Number of events to sample, or if a float is given, the proportion of the population
+        transform: str or dict (optional)
+            Transform to apply, see load_population_df
+        columns: list (optional)
+            If given, only these columns are loaded
+        random_state: int or Numpy.random.Generator, optional
+            Seed or Generator for reproducible sampling
+
+        Returns
+        -------
+        Pandas.DataFrame
+        """
+        assert population in self.tree.keys(), f"Invalid population, {population} does not exist"
+        idx = self.get_population(population_name=population).index
+        sample = idx[uniform_sample_idx(n_events=idx.shape[0], sample_size=sample_size, random_state=random_state)]
+        methods = [transform] if isinstance(transform, str) else list((transform or {}).values())
+        if any(m not in ELEMENTWISE_TRANSFORMS for m in methods if m is not None):
+            data = self._load_transformed(source="primary", transform=transform, columns=columns, idx=idx)
+            return data.loc[sample]
+        data = self.data(source="primary", columns=columns, idx=sample)
+        if transform is None:
+            return data
+        if isinstance(transform, str):
+            return apply_transform(data, transform_method=transform)
+        return apply_transform(data=data,
+                               features_to_transform={c: method for c, method in transform.items()
+                                                      if c in data.columns})
+
+    def _load_transformed(self,
+                          source: str,
+                          transform: str or dict or None,
+                          columns: List[str] or None = None,
+                          idx: np.ndarray or None = None) -> pd.DataFrame:
+        """
+        Load events from the given source (see data) and apply the given transform (see
+        load_population_df). Element-wise transforms (see CytoPy.flow.transforms.ELEMENTWISE_TRANSFORMS)
+        are computed once for every event of a column and held in the transform cache, such that
+        subsequent loads of any population slice the transformed column rather than repeating the
+        transform. All other transforms are applied to the loaded events as normal.
+
+        Parameters
+        ----------
+        source: str
+        transform: str or dict (optional)
+        columns: list (optional)
+        idx: Numpy.Array (optional)
+
+        Returns
+        -------
+        Pandas.DataFrame
+        """
+        # Populations are repeatedly loaded in full when gating, so cache the event matrix
+        data = self.data(source=source, columns=columns, idx=idx, cache=columns is None)
+        if transform is None:
+            return data
+        if isinstance(transform, str):
+            if transform not in ELEMENTWISE_TRANSFORMS:
+                return apply_transform(data, transform_method=transform)
+            transform = {c: transform for c in data.columns}
+        transformed = {c: self._transformed_column(source=source, column=c, method=method)
+                       for c, method in transform.items()
+                       if method in ELEMENTWISE_TRANSFORMS and c in data.columns}
+        transformed = {c: values for c, values in transformed.items() if values is not None}
+        data = apply_transform(data=data,
+                               features_to_transform={c: method for c, method in transform.items()
+                                                      if c in data.columns and c not in transformed.keys()})
+        for c, values in transformed.items():
+            data[c] = values if idx is None else values[data.index.values]
+        return data
+
+    def _transformed_column(self,
+                            source: str,
+                            column: str,
+                            method: str) -> np.ndarray or None:
+        """
+        Return the given column, for every event of the given source, transformed with the given
+        element-wise method; retrieved from the transform cache if present, otherwise computed and
+        cached. Returns None if the column does not fit within the budget of the transform cache.
+
+        Parameters
+        ----------
+        source: str
+        column: str
+        method: str
+
+        Returns
+        -------
+        Numpy.Array or None
+        """
+        key = (self.h5path, source, self.columns_default, column, method)
+        cached = transform_cache.get(key)
+        if cached is not None:
+            return cached[0]
+        with h5py.File(self.h5path, "r") as f:
+            n_events = f[source].shape[0]
+        if not transform_cache.fits(n_events * np.dtype(np.float64).itemsize):
+            return None
+        values = apply_transform(self.data(source=source, columns=[column]),
+                                 transform_method=method)[column].values
+        transform_cache.put(key, values)
+        return values
+
     def _label_downstream_affiliations(self,
                                        parent: str,
                                        data: pd.DataFrame) -> pd.DataFrame:
@@ -589,6 +1207,7 @@ class FileGroup(mongoengine.Document):
         None
         """
         if populations == "all":
+            self._stale_populations.update([p for p in self.list_populations() if p != "root"])
             self.populations = [p for p in self.populations if p.population_name == "root"]
             self.tree = {name: node for name, node in self.tree.items() if name == "root"}
         else:
@@ -601,6 +1220,7 @@ class FileGroup(mongoengine.Document):
                      "populations listed for deletion and will therefore be deleted: "
                      f"{downstream_effects}")
             populations = list(set(list(downstream_effects) + populations))
+            self._stale_populations.update(populations)
             self.populations = [p for p in self.populations if p.population_name not in populations]
             for name in populations:
                 self.tree[name].parent = None
@@ -715,14 +1335,15 @@ class FileGroup(mongoengine.Document):
         assert same_parent or downstream, "Right population should share the same parent as the " \
                                           "left population or be downstream of the left population"
         new_population_name = new_population_name or f"subtract_{left.population_name}_{right.population_name}"
-        new_idx = np.array([x for x in left.index if x not in right.index])
+        new_idx = np.setdiff1d(left.index, right.index)
         x, y = left.geom.x, left.geom.y
         transform_x, transform_y = left.geom.transform_x, left.geom.transform_y
-        parent_data = self.load_population_df(population=left.parent,
-                                              transform={x: transform_x,
-                                                         y: transform_y})
-        x_values, y_values = create_convex_hull(x_values=parent_data.loc[new_idx][x].values,
-                                                y_values=parent_data.loc[new_idx][y].values)
+        new_data = self._load_transformed(source="primary",
+                                          transform={x: transform_x, y: transform_y},
+                                          columns=[x, y],
+                                          idx=new_idx)
+        x_values, y_values = create_convex_hull(x_values=new_data[x].values,
+                                                y_values=new_data[y].values)
         new_geom = PolygonGeom(x=x,
                                y=y,
                                transform_x=transform_x,
@@ -739,7 +1360,8 @@ class FileGroup(mongoengine.Document):
 
     def _write_populations(self):
         """
-        Write population data to disk.
+        Write population data to disk. Only indexes, clusters and meta labels that have changed since
+        they were last written are deleted and rewritten; records of deleted populations are removed.
 
         Returns
         -------
@@ -747,45 +1369,98 @@ class FileGroup(mongoengine.Document):
         """
         root_n = self.get_population("root").n
         with h5py.File(self.h5path, "a") as f:
-            if "cell_meta_labels" in f.keys():
-                for meta, labels in self.cell_meta_labels.items():
-                    ascii_labels = [x.encode("ascii", "ignore") for x in labels]
+            self._hdf_reset_population_data(f)
+            if self._cell_meta_labels is not None and "cell_meta_labels" in f.keys():
+                for meta in self.cell_meta_labels.changed:
+                    ascii_labels = [x.encode("ascii", "ignore") for x in self.cell_meta_labels[meta]]
                     f.create_dataset(f'/cell_meta_labels/{meta}', data=ascii_labels)
             for p in self.populations:
                 parent_n = self.get_population(p.parent).n
                 p.prop_of_parent = p.n / parent_n
                 p.prop_of_total = p.n / root_n
-                f.create_dataset(f'/index/{p.population_name}/primary', data=p.index)
-                for ctrl, idx in p.ctrl_index.items():
-                    f.create_dataset(f'/index/{p.population_name}/{ctrl}', data=idx)
                 for cluster in p.clusters:
                     cluster.prop_of_events = cluster.n / p.n
-                    f.create_dataset(f'/clusters/{p.population_name}/{cluster.cluster_id}_{cluster.tag}',
-                                     data=cluster.index)
+                # Populations added since the last save are written in full
+                stale = p.population_name in self._stale_populations
+                indexes = set(["primary"] + list(p.ctrl_index.keys())) if stale else p.dirty_indexes
+                for key in indexes:
+                    idx = p.index if key == "primary" else p.ctrl_index.get(key)
+                    _write_index(f, f'/index/{p.population_name}/{key}', idx)
+                if stale or p.dirty_clusters:
+                    existing = f[f"clusters/{p.population_name}"].keys() \
+                        if p.population_name in f["clusters"].keys() else []
+                    for cluster in p.clusters:
+                        key = f"{cluster.cluster_id}_{cluster.tag}"
+                        if key not in existing:
+                            _write_index(f, f'/clusters/{p.population_name}/{key}', cluster.index)
+        for p in self.populations:
+            p.mark_clean()
+        if self._cell_meta_labels is not None:
+            self.cell_meta_labels.mark_clean()
+        self._stale_populations = set()
 
-    def _hdf_reset_population_data(self):
+    def _hdf_reset_population_data(self,
+                                   f: h5py.File):
         """
-        For each population clear existing data ready for overwriting with
-        current data.
+        Clear existing data that is out of date, ready for writing the current data: records of deleted
+        (or replaced) populations, changed indexes, and clusters or controls that have been modified or
+        no longer exist.
+
+        Parameters
+        ----------
+        f: h5py.File
+            HDF5 file open for writing
 
         Returns
         -------
         None
         """
-        with h5py.File(self.h5path, "a") as f:
-            if "cell_meta_labels" in f.keys():
-                for meta in self.cell_meta_labels.keys():
-                    if meta in f["cell_meta_labels"]:
-                        del f[f"cell_meta_labels/{meta}"]
-            for p in self.populations:
-                if p.population_name in f["index"].keys():
-                    if "primary" in f[f"index/{p.population_name}"].keys():
-                        del f[f"index/{p.population_name}/primary"]
-                    for ctrl_id in p.ctrl_index.keys():
-                        if ctrl_id in f[f"index/{p.population_name}"].keys():
-                            del f[f"index/{p.population_name}/{ctrl_id}"]
-                if p.population_name in f["clusters"].keys():
-                    del f[f"clusters/{p.population_name}"]
+        if self._cell_meta_labels is not None and "cell_meta_labels" in f.keys():
+            for meta in self.cell_meta_labels.changed.union(self.cell_meta_labels.deleted):
+                if meta in f["cell_meta_labels"]:
+                    del f[f"cell_meta_labels/{meta}"]
+        for name in self._stale_populations:
+            for grp in ["index", "clusters"]:
+                if name in f[grp].keys():
+                    del f[f"{grp}/{name}"]
+        for p in self.populations:
+            if p.dirty_indexes and p.population_name in f["index"].keys():
+                ctrls = list(p.ctrl_index.keys())
+                for key in list(f[f"index/{p.population_name}"].keys()):
+                    if key in p.dirty_indexes or (key != "primary" and key not in ctrls):
+                        del f[f"index/{p.population_name}/{key}"]
+            if p.dirty_clusters and p.population_name in f["clusters"].keys():
+                current = {f"{c.cluster_id}_{c.tag}": c for c in p.clusters}
+                for key in list(f[f"clusters/{p.population_name}"].keys()):
+                    if key not in current.keys() or current[key].dirty:
+                        del f[f"clusters/{p.population_name}/{key}"]
+
+    def migrate_storage(self,
+                        compression: str or None = "gzip",
+                        compression_opts: int or None = None,
+                        chunks: tuple or None = None,
+                        verbose: bool = True):
+        """
+        Convert the event data of this FileGroup's HDF5 file to the given storage layout.
+        See CytoPy.data.fcs.migrate_hdf5_layout for details.
+
+        Parameters
+        ----------
+        compression: str (optional; default='gzip')
+            Either 'gzip', 'lzf' or None (contiguous and uncompressed)
+        compression_opts: int (optional)
+        chunks: tuple (optional)
+        verbose: bool (default=True)
+
+        Returns
+        -------
+        None
+        """
+        migrate_hdf5_layout(path=self.h5path,
+                            compression=compression,
+                            compression_opts=compression_opts,
+                            chunks=chunks,
+                            verbose=verbose)
 
     def population_stats(self,
                          population: str):
@@ -822,9 +1497,7 @@ class FileGroup(mongoengine.Document):
     def save(self, *args, **kwargs):
         # Calculate meta and save indexes to disk
         if self.populations:
-            # self._hdf_create_population_grps()
             # Populate h5path for populations
-            self._hdf_reset_population_data()
             self._write_populations()
         super().save(*args, **kwargs)
 
@@ -833,6 +1506,8 @@ class FileGroup(mongoengine.Document):
                *args,
                **kwargs):
         super().delete(*args, **kwargs)
+        event_cache.invalidate(self.h5path)
+        transform_cache.invalidate(self.h5path)
         if delete_hdf5_file:
             if os.path.isfile(self.h5path):
                 os.remove(self.h5path)
@@ -31,11 +31,12 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 from ..flow.transforms import apply_transform
+from ..cache import ArrayCache
 from .geometry import ThresholdGeom, PolygonGeom, inside_polygon, \
     create_convex_hull, create_polygon, polygon_overlap, ellipse_to_polygon, \
-    probablistic_ellipse
-from .population import Population, merge_multiple_populations, create_signature
-from ..flow.sampling import faithful_downsampling, density_dependent_downsampling, upsample_knn
+    probablistic_ellipse, points_in_polygon, inside_ellipse
+from .population import Population, merge_multiple_populations, create_signatures
+from ..flow.sampling import sample_idx, upsample_knn
 from ..flow.dim_reduction import dimensionality_reduction
 from shapely.geometry import Polygon as ShapelyPoly
 from shapely.ops import cascaded_union
@@ -53,6 +54,7 @@ from scipy.signal import savgol_filter
 import pandas as pd
 import numpy as np
 import mongoengine
+import hashlib
 
 __author__ = "Ross Burton"
 __copyright__ = "Copyright 2020, CytoPy"
@@ -63,6 +65,11 @@ __maintainer__ = "Ross Burton"
 __email__ = "burtonrj@cardiff.ac.uk"
 __status__ = "Production"
 
+# Densities estimated by ThresholdGate, keyed by (data fingerprint, kernel, bandwidth), such that
+# refitting a gate to the same data (e.g. when searching hyperparameters that do not alter the
+# density estimate) does not repeat the KDE
+kde_cache = ArrayCache(max_bytes=2 ** 26)
+
 
 class Child(mongoengine.EmbeddedDocument):
     """
@@ -209,6 +216,22 @@ class Gate(mongoengine.Document):
         if method not in ["manual", "density", "quantile"]:
             self.model = globals()[method](**self.method_kwargs)
 
+    # Attributes that are not fields but must survive copying and pickling of the gate
+    _state_attrs = ["model"]
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        for attr in self._state_attrs:
+            state[attr] = getattr(self, attr, None)
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        attrs = {attr: state.pop(attr, None) for attr in self._state_attrs}
+        super().__setstate__(state)
+        for attr, value in attrs.items():
+            setattr(self, attr, value)
+
     def _transform(self,
                    data: pd.DataFrame) -> pd.DataFrame:
         """
@@ -229,11 +252,12 @@ class Gate(mongoengine.Document):
         return apply_transform(data=data,
                                features_to_transform=transforms)
 
-    def _downsample(self,
-                    data: pd.DataFrame) -> pd.DataFrame or None:
+    def _downsample_idx(self,
+                        data: pd.DataFrame) -> np.ndarray:
         """
-        Perform down-sampling prior to gating. Returns down-sampled dataframe or
-        None if sampling method is undefined.
+        Perform down-sampling prior to gating, returning the row positions of the sample.
+        A seed can be given for reproducible sampling using the key "random_state"
+        in the sampling dictionary.
 
         Parameters
         ----------
@@ -241,30 +265,46 @@ class Gate(mongoengine.Document):
 
         Returns
         -------
-        Pandas.DataFrame or None
+        Numpy.Array
         """
-        data = data.copy()
-        if self.sampling.get("method", None) == "uniform":
+        method = self.sampling.get("method", None)
+        random_state = self.sampling.get("random_state", None)
+        features = [f for f in [self.x, self.y] if f is not None]
+        if method == "uniform":
             n = self.sampling.get("n", None) or self.sampling.get("frac", None)
             assert n is not None, "Must provide 'n' or 'frac' for uniform downsampling"
-            if isinstance(n, int):
-                return data.sample(n=n)
-            elif isinstance(n, float):
-                return data.sample(frac=n)
-            else:
+            if not isinstance(n, (int, float)):
                 raise ValueError("Sampling parameter 'n' must be an integer or float")
-        if self.sampling.get("method", None) == "density":
+            return sample_idx(data=data, method=method, sample_size=n, random_state=random_state)
+        if method == "density":
             kwargs = {k: v for k, v in self.sampling.items()
-                      if k not in  ["method", "features"]}
-            features = [f for f in [self.x, self.y] if f is not None]
-            return density_dependent_downsampling(data=data,
-                                                  features=features,
-                                                  **kwargs)
-        if self.sampling.get("method", None) == "faithful":
-            h = self.sampling.get("h", 0.01)
-            return faithful_downsampling(data=data.values, h=h)
+                      if k not in ["method", "features", "random_state", "verbose",
+                                   "upsample_scoring", "knn_kwargs"]}
+            return sample_idx(data=data, method=method, features=features, random_state=random_state, **kwargs)
+        if method == "faithful":
+            return sample_idx(data=data,
+                              method=method,
+                              features=features,
+                              random_state=random_state,
+                              h=self.sampling.get("h", 0.01))
         raise ValueError("Invalid downsample method, should be one of: 'uniform', 'density' or 'faithful'")
 
+    def _downsample(self,
+                    data: pd.DataFrame) -> pd.DataFrame or None:
+        """
+        Perform down-sampling prior to gating. Returns down-sampled dataframe, retaining
+        the original row index.
+
+        Parameters
+        ----------
+        data: Pandas.DataFrame
+
+        Returns
+        -------
+        Pandas.DataFrame or None
+        """
+        return data.iloc[self._downsample_idx(data=data)]
+
     def _upsample(self,
                   data: pd.DataFrame,
                   sample: pd.DataFrame,
@@ -611,10 +651,9 @@ class ThresholdGate(Gate):
             thresholds = self._quantile_gate(data=data)
         else:
             for d in dims:
-                x_grid, p = (FFTKDE(kernel=self.method_kwargs.get("kernel", "gaussian"),
-                                    bw=self.method_kwargs.get("bw", "silverman"))
-                             .fit(data[d].values)
-                             .evaluate())
+                x_grid, p = kde(x=data[d].values,
+                                kernel=self.method_kwargs.get("kernel", "gaussian"),
+                                bw=self.method_kwargs.get("bw", "silverman"))
                 peaks = find_peaks(p=p,
                                    min_peak_threshold=self.method_kwargs.get("min_peak_threshold", 0.05),
                                    peak_boundary=self.method_kwargs.get("peak_boundary", 0.1))
@@ -684,13 +723,14 @@ class ThresholdGate(Gate):
         y_threshold = None
         if len(thresholds) > 1:
             y_threshold = thresholds[1]
-        data = apply_threshold(data=data,
-                               x=self.x, x_threshold=thresholds[0],
-                               y=self.y, y_threshold=y_threshold)
-        for definition, df in data.items():
+        labels, definitions = threshold_labels(data=data,
+                                               x=self.x, x_threshold=thresholds[0],
+                                               y=self.y, y_threshold=y_threshold)
+        signatures = create_signatures(data=data, labels=labels, n_labels=len(definitions))
+        for definition, signature in zip(definitions, signatures):
             self.add_child(ChildThreshold(name=definition,
                                           definition=definition,
-                                          signature=create_signature(data=df),
+                                          signature=signature,
                                           geom=ThresholdGeom(x_threshold=thresholds[0],
                                                              y_threshold=y_threshold)))
         return None
@@ -720,12 +760,14 @@ class ThresholdGate(Gate):
         y_threshold = None
         if len(thresholds) == 2:
             y_threshold = thresholds[1]
-        results = apply_threshold(data=data,
-                                  x=self.x,
-                                  y=self.y,
-                                  x_threshold=thresholds[0],
-                                  y_threshold=y_threshold)
-        pops = self._generate_populations(data=results,
+        labels, definitions = threshold_labels(data=data,
+                                               x=self.x,
+                                               y=self.y,
+                                               x_threshold=thresholds[0],
+                                               y_threshold=y_threshold)
+        pops = self._generate_populations(data=data,
+                                          labels=labels,
+                                          definitions=definitions,
                                           x_threshold=thresholds[0],
                                           y_threshold=y_threshold)
         return self._match_to_children(new_populations=pops)
@@ -752,28 +794,33 @@ class ThresholdGate(Gate):
         self._xy_in_dataframe(data=data)
         data = self._transform(data=data)
         data = self._dim_reduction(data=data)
-        if self.y is not None:
-            data = threshold_2d(data=data,
-                                x=self.x,
-                                y=self.y,
-                                x_threshold=self.children[0].geom.x_threshold,
-                                y_threshold=self.children[0].geom.y_threshold)
-        else:
-            data = threshold_1d(data=data, x=self.x, x_threshold=self.children[0].geom.x_threshold)
+        labels, definitions = threshold_labels(data=data,
+                                               x=self.x,
+                                               y=self.y,
+                                               x_threshold=self.children[0].geom.x_threshold,
+                                               y_threshold=self.children[0].geom.y_threshold)
         return self._generate_populations(data=data,
+                                          labels=labels,
+                                          definitions=definitions,
                                           x_threshold=self.children[0].geom.x_threshold,
                                           y_threshold=self.children[0].geom.y_threshold)
 
     def _generate_populations(self,
-                              data: dict,
+                              data: pd.DataFrame,
+                              labels: np.array,
+                              definitions: List[str],
                               x_threshold: float,
                               y_threshold: float or None) -> list:
         """
-        Generate populations from a standard dictionary of dataframes that have had thresholds applied.
+        Generate populations from the label array produced by applying thresholds to a dataframe
+        (see threshold_labels).
 
         Parameters
         ----------
         data: Pandas.DataFrame
+        labels: Numpy.array
+            Position of each event's definition in definitions (-1 for events not assigned)
+        definitions: list
         x_threshold: float
         y_threshold: float (optional)
 
@@ -783,13 +830,15 @@ class ThresholdGate(Gate):
             List of Population objects
         """
         pops = list()
-        for definition, df in data.items():
+        signatures = create_signatures(data=data, labels=labels, n_labels=len(definitions))
+        for i, (definition, signature) in enumerate(zip(definitions, signatures)):
+            idx = data.index.values[np.flatnonzero(labels == i)]
             pops.append(Population(population_name=definition,
                                    definition=definition,
                                    parent=self.parent,
-                                   n=df.shape[0],
-                                   index=df.index.values,
-                                   signature=create_signature(data=df),
+                                   n=idx.shape[0],
+                                   index=idx,
+                                   signature=signature,
                                    geom=ThresholdGeom(x=self.x,
                                                       y=self.y,
                                                       transform_x=self.transformations.get("x", None),
@@ -864,9 +913,31 @@ class PolygonGate(Gate):
         super().__init__(*args, **values)
         assert self.y is not None, "Polygon gate expects a y-axis variable"
 
+    def _population_masks(self,
+                          data: pd.DataFrame,
+                          polygons: List[ShapelyPoly]) -> np.ndarray:
+        """
+        Given a dataframe and a list of Polygon shapes, return a boolean mask of shape
+        (n_events, n_polygons) specifying which events fall within each polygon.
+
+        Parameters
+        ----------
+        data: Pandas.DataFrame
+        polygons: list
+
+        Returns
+        -------
+        Numpy.Array
+        """
+        if len(polygons) == 0:
+            return np.zeros((data.shape[0], 0), dtype=bool)
+        xy = data[[self.x, self.y]].values
+        return np.column_stack([points_in_polygon(xy, poly) for poly in polygons])
+
     def _generate_populations(self,
                               data: pd.DataFrame,
-                              polygons: List[ShapelyPoly]) -> List[Population]:
+                              polygons: List[ShapelyPoly],
+                              masks: np.ndarray or None = None) -> List[Population]:
         """
         Given a dataframe and a list of Polygon shapes as generated from the '_fit' method, generate a
         list of Population objects.
@@ -875,15 +946,21 @@ class PolygonGate(Gate):
         ----------
         data: Pandas.DataFrame
         polygons: list
+        masks: Numpy.Array, optional
+            Boolean mask of shape (n_events, n_polygons) specifying membership of each event
+            to each polygon. If not given, membership is computed from the polygons
 
         Returns
         -------
         List
             List of Population objects
         """
+        if masks is None:
+            masks = self._population_masks(data=data, polygons=polygons)
         pops = list()
-        for name, poly in zip(ascii_uppercase, polygons):
-            pop_df = inside_polygon(df=data, x=self.x, y=self.y, poly=poly)
+        signatures = create_signatures(data=data, labels=masks)
+        for i, (name, poly) in enumerate(zip(ascii_uppercase, polygons)):
+            idx = data.index.values[masks[:, i]]
             geom = PolygonGeom(x=self.x,
                                y=self.y,
                                transform_x=self.transformations.get("x", None),
@@ -892,10 +969,10 @@ class PolygonGate(Gate):
                                y_values=poly.exterior.xy[1])
             pops.append(Population(population_name=name,
                                    parent=self.parent,
-                                   n=pop_df.shape[0],
+                                   n=idx.shape[0],
                                    geom=geom,
-                                   index=pop_df.index.values,
-                                   signature=create_signature(pop_df)))
+                                   index=idx,
+                                   signature=signatures[i]))
         return pops
 
     def label_children(self,
@@ -1013,6 +1090,24 @@ class PolygonGate(Gate):
         hulls = [x for x in hulls if len(x[0]) > 0]
         return [create_polygon(*x) for x in hulls]
 
+    def _fit_masks(self,
+                   data: pd.DataFrame) -> (List[ShapelyPoly], np.ndarray):
+        """
+        Fit gate to the given data and return geometric polygons for captured populations along with
+        a boolean mask of shape (n_events, n_polygons) specifying which events of data fall within
+        each polygon.
+
+        Parameters
+        ----------
+        data: Pandas.DataFrame
+
+        Returns
+        -------
+        List, Numpy.Array
+        """
+        polygons = self._fit(data=data)
+        return polygons, self._population_masks(data=data, polygons=polygons)
+
     def fit(self,
             data: pd.DataFrame) -> None:
         """
@@ -1032,14 +1127,11 @@ class PolygonGate(Gate):
         assert len(self.children) == 0, "Gate is already defined, call 'reset_gate' to clear children"
         data = self._transform(data=data)
         data = self._dim_reduction(data=data)
-        polygons = self._fit(data=data)
-        for name, poly in zip(ascii_uppercase, polygons):
-            poly_df = inside_polygon(df=data,
-                                     x=self.x,
-                                     y=self.y,
-                                     poly=poly)
+        polygons, masks = self._fit_masks(data=data)
+        signatures = create_signatures(data=data, labels=masks)
+        for i, (name, poly) in enumerate(zip(ascii_uppercase, polygons)):
             self.add_child(ChildPolygon(name=name,
-                                        signature=create_signature(data=poly_df),
+                                        signature=signatures[i],
                                         geom=PolygonGeom(x_values=poly.exterior.xy[0].tolist(),
                                                          y_values=poly.exterior.xy[1].tolist())))
 
@@ -1063,8 +1155,10 @@ class PolygonGate(Gate):
         assert len(self.children) > 0, "No children defined for gate, call 'fit' before calling 'fit_predict'"
         data = self._transform(data=data)
         data = self._dim_reduction(data=data)
+        polygons, masks = self._fit_masks(data=data)
         return self._match_to_children(self._generate_populations(data=data.copy(),
-                                                                  polygons=self._fit(data=data)))
+                                                                  polygons=polygons,
+                                                                  masks=masks))
 
     def predict(self,
                 data: pd.DataFrame) -> List[Population]:
@@ -1143,6 +1237,7 @@ class EllipseGate(PolygonGate):
         Keyword arguments for initiation of the above method.
     """
     children = mongoengine.EmbeddedDocumentListField(ChildPolygon)
+    _state_attrs = ["model", "conf"]
 
     def __init__(self, *args, **values):
         method = values.get("method", None)
@@ -1153,14 +1248,15 @@ class EllipseGate(PolygonGate):
         assert method in valid, f"Elliptical gating method should be one of {valid}"
         super().__init__(*args, **values)
 
-    def _manual(self) -> ShapelyPoly:
+    def _manual_ellipse(self) -> tuple:
         """
         Wrapper for manual elliptical gating. Searches method kwargs for centroid, width, height, and angle,
-        and returns polygon.
+        and returns them as a tuple.
 
         Returns
         -------
-        Shapely.geometry.Polygon
+        tuple
+            (centroid, width, height, angle)
         """
         centroid = self.method_kwargs.get("centroid", None)
         width = self.method_kwargs.get("width", None)
@@ -1172,11 +1268,54 @@ class EllipseGate(PolygonGate):
             "Centroid should be a list of two float values"
         assert all(isinstance(x, float) for x in [width, height, angle]), \
             "Width, height, and angle should be of type float"
+        return centroid, width, height, angle
+
+    def _manual(self) -> ShapelyPoly:
+        """
+        Wrapper for manual elliptical gating. Searches method kwargs for centroid, width, height, and angle,
+        and returns polygon.
+
+        Returns
+        -------
+        Shapely.geometry.Polygon
+        """
+        centroid, width, height, angle = self._manual_ellipse()
         return ellipse_to_polygon(centroid=centroid,
                                   width=width,
                                   height=height,
                                   angle=angle)
 
+    def _probabilistic(self) -> bool:
+        """
+        Returns True if populations are defined by ellipses (manual or derived from the covariance
+        of mixture components) rather than the convex hull of clusters
+        """
+        return self.method == "manual" or self.method_kwargs.get("probabilistic_ellipse", True)
+
+    def _fit_ellipses(self,
+                      data: pd.DataFrame) -> List[tuple]:
+        """
+        Internal method for fitting gate to the given data and returning the parameters of the
+        ellipses for captured populations.
+
+        Parameters
+        ----------
+        data: Pandas.DataFrame
+
+        Returns
+        -------
+        list
+            List of tuples (centroid, width, height, angle)
+        """
+        if self.method == "manual":
+            return [self._manual_ellipse()]
+        self._xy_in_dataframe(data=data)
+        if self.sampling.get("method", None) is not None:
+            data = self._downsample(data=data)
+        self.model.fit_predict(data[[self.x, self.y]])
+        return [(centroid, *probablistic_ellipse(covar, conf=self.conf))
+                for centroid, covar in zip(self.model.means_, self.model.covariances_)]
+
     def _fit(self,
              data: pd.DataFrame) -> List[ShapelyPoly]:
         """
@@ -1192,17 +1331,37 @@ class EllipseGate(PolygonGate):
         list
             List of Shapely polygon's
         """
-        if not self.method_kwargs.get("probabilistic_ellipse", True):
+        if not self._probabilistic():
             return super()._fit(data=data)
-        self._xy_in_dataframe(data=data)
-        if self.sampling.get("method", None) is not None:
-            data = self._downsample(data=data)
-        self.model.fit_predict(data[[self.x, self.y]])
-        ellipses = [probablistic_ellipse(covar, conf=self.conf)
-                    for covar in self.model.covariances_]
-        polygons = [ellipse_to_polygon(centroid, *ellipse)
-                    for centroid, ellipse in zip(self.model.means_, ellipses)]
-        return polygons
+        return [ellipse_to_polygon(*ellipse) for ellipse in self._fit_ellipses(data=data)]
+
+    def _fit_masks(self,
+                   data: pd.DataFrame) -> (List[ShapelyPoly], np.ndarray):
+        """
+        Fit gate to the given data and return geometric polygons for captured populations along with
+        a boolean mask of shape (n_events, n_polygons) specifying which events of data fall within
+        each population. Membership is tested analytically against the fitted ellipses rather than
+        their polygon approximation.
+
+        Parameters
+        ----------
+        data: Pandas.DataFrame
+
+        Returns
+        -------
+        List, Numpy.Array
+        """
+        if not self._probabilistic():
+            return super()._fit_masks(data=data)
+        ellipses = self._fit_ellipses(data=data)
+        polygons = [ellipse_to_polygon(*ellipse) for ellipse in ellipses]
+        centroids, widths, heights, angles = zip(*ellipses)
+        masks = inside_ellipse(data[[self.x, self.y]].values,
+                               center=np.array(centroids, dtype=np.float64).reshape(-1, 2),
+                               width=np.array(widths),
+                               height=np.array(heights),
+                               angle=np.array(angles))
+        return polygons, masks
 
 
 def merge_children(children: list) -> Child or ChildThreshold or ChildPolygon:
@@ -1316,9 +1475,8 @@ def threshold_1d(data: pd.DataFrame,
         Negative population (less than threshold) and positive population (greater than or equal to threshold)
         in a dictionary as so: {'-': Pandas.DataFrame, '+': Pandas.DataFrame}
     """
-    data = data.copy()
-    return {"+": data[data[x] >= x_threshold],
-            "-": data[data[x] < x_threshold]}
+    labels, definitions = threshold_labels(data=data, x=x, x_threshold=x_threshold)
+    return {d: data.iloc[np.flatnonzero(labels == i)] for i, d in enumerate(definitions)}
 
 
 def threshold_2d(data: pd.DataFrame,
@@ -1346,11 +1504,98 @@ def threshold_2d(data: pd.DataFrame,
     -------
     dict
     """
-    data = data.copy()
-    return {"++": data[(data[x] >= x_threshold) & (data[y] >= y_threshold)],
-            "--": data[(data[x] < x_threshold) & (data[y] < y_threshold)],
-            "+-": data[(data[x] >= x_threshold) & (data[y] < y_threshold)],
-            "-+": data[(data[x] < x_threshold) & (data[y] >= y_threshold)]}
+    labels, definitions = threshold_labels(data=data, x=x, x_threshold=x_threshold, y=y, y_threshold=y_threshold)
+    return {d: data.iloc[np.flatnonzero(labels == i)] for i, d in enumerate(definitions)}
+
+
+def threshold_labels(data: pd.DataFrame,
+                     x: str,
+                     x_threshold: float,
+                     y: str or None = None,
+                     y_threshold: float or None = None) -> (np.array, List[str]):
+    """
+    Apply the given threshold(s) and return, for each event, which side of the threshold(s)
+    it falls on as a single int8 label array, along with the definition each label refers to;
+    the label of an event is the position of its definition in the returned list. Definitions
+    are ordered as the keys returned by threshold_1d ('+', '-') or threshold_2d ('++', '--', '+-', '-+').
+    Events that cannot be compared to the threshold(s) (e.g. NaN) are labelled -1.
+
+    Parameters
+    ----------
+    data: Pandas.DataFrame
+    x: str
+    x_threshold: float
+    y: str (optional)
+    y_threshold: float (optional)
+
+    Returns
+    -------
+    Numpy.Array, List
+        Label array and list of definitions
+    """
+    x_values = data[x].values
+    x_pos = x_values >= x_threshold
+    valid = x_pos | (x_values < x_threshold)
+    if y is None:
+        labels = np.where(x_pos, 0, 1).astype(np.int8)
+        labels[~valid] = -1
+        return labels, ["+", "-"]
+    assert y_threshold is not None, "2D threshold requires y_threshold"
+    y_values = data[y].values
+    y_pos = y_values >= y_threshold
+    valid &= y_pos | (y_values < y_threshold)
+    # Quadrant code (2 * x positive + y positive) mapped to the position of its definition
+    labels = np.array([1, 3, 2, 0], dtype=np.int8)[2 * x_pos.astype(np.int8) + y_pos]
+    labels[~valid] = -1
+    return labels, ["++", "--", "+-", "-+"]
+
+
+def _fingerprint(x: np.array) -> str:
+    """
+    Digest of the contents of an array, used to identify identical data in caches
+
+    Parameters
+    ----------
+    x: Numpy.Array
+
+    Returns
+    -------
+    str
+    """
+    x = np.ascontiguousarray(x)
+    digest = hashlib.blake2b(x.view(np.uint8).reshape(-1), digest_size=16)
+    digest.update(str((x.dtype.str, x.shape)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def kde(x: np.array,
+        kernel: str = "gaussian",
+        bw: str or float = "silverman") -> (np.array, np.array):
+    """
+    Estimate the probability density of a one dimensional array using KDEpy.FFTKDE, returning
+    the grid and the density evaluated upon it. Results are held in the KDE cache (keyed by
+    a fingerprint of the data, the kernel and the bandwidth) and the arrays returned are
+    read-only, as they may be shared between calls.
+
+    Parameters
+    ----------
+    x: Numpy.Array
+    kernel: str (default="gaussian")
+    bw: str or float (default="silverman")
+
+    Returns
+    -------
+    Numpy.Array, Numpy.Array
+        x grid, probability vector
+    """
+    key = (_fingerprint(x), kernel, bw)
+    cached = kde_cache.get(key)
+    if cached is None:
+        x_grid, p = FFTKDE(kernel=kernel, bw=bw).fit(x).evaluate()
+        cached = (np.vstack([x_grid, p]),)
+        if kde_cache.fits(cached[0].nbytes):
+            kde_cache.put(key, cached[0])
+    return cached[0][0], cached[0][1]
 
 
 def find_peaks(p: np.array,
@@ -1554,21 +1799,20 @@ def update_threshold(population: Population,
     None
     """
     if population.geom.y_threshold is None:
-        new_data = threshold_1d(data=parent_data,
-                                x=population.geom.x,
-                                x_threshold=x_threshold).get(population.definition)
-        population.index = new_data.index.values
+        labels, definitions = threshold_labels(data=parent_data,
+                                               x=population.geom.x,
+                                               x_threshold=x_threshold)
+        population.index = parent_data.index.values[labels == definitions.index(population.definition)]
         population.geom.x_threshold = x_threshold
     else:
         assert y_threshold is not None, "2D threshold requires y_threshold"
-        new_data = threshold_2d(data=parent_data,
-                                x=population.geom.x,
-                                x_threshold=x_threshold,
-                                y=population.geom.y,
-                                y_threshold=y_threshold)
-        definitions = population.definition.split(",")
-        new_data = pd.concat([new_data.get(d) for d in definitions])
-        population.index = new_data.index.values
+        labels, definitions = threshold_labels(data=parent_data,
+                                               x=population.geom.x,
+                                               x_threshold=x_threshold,
+                                               y=population.geom.y,
+                                               y_threshold=y_threshold)
+        keep = [definitions.index(d) for d in population.definition.split(",")]
+        population.index = parent_data.index.values[np.isin(labels, keep)]
         population.geom.x_threshold = x_threshold
         population.geom.y_threshold = y_threshold
         _reset_population(population)
@@ -35,6 +35,9 @@ from .gate import Gate, ThresholdGate, PolygonGate, EllipseGate, ThresholdGeom,
 from ..flow.gate_search import hyperparameter_gate
 from .experiment import Experiment
 from .fcs import FileGroup
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import cpu_count
+from collections import deque, defaultdict, Counter
 from datetime import datetime
 import pandas as pd
 import mongoengine
@@ -247,7 +250,9 @@ class GatingStrategy(mongoengine.Document):
     def add_hyperparameter_grid(self,
                                 gate_name: str,
                                 params: dict,
-                                cost: str or None = None):
+                                cost: str or None = None,
+                                search: str = "grid",
+                                search_kwargs: dict or None = None):
         """
         Add a hyperparameter grid to search which applying the given gate to new data.
         This hyperparameter grid should correspond to valid hyperparameters for the
@@ -278,9 +283,14 @@ class GatingStrategy(mongoengine.Document):
         gate_name: str
             Gate to define hyperparameter grid for
         params: dict
-            Grid of hyperparameters to be searched
+            Grid of hyperparameters to be searched; each value must be a list of parameter values
+            (for random search, combinations are sampled from these lists)
         cost: str
             What to be minimised to choose optimal hyperparameters
+        search: str (default="grid")
+            Search strategy; one of "grid", "random" or "halving" (see CytoPy.flow.gate_search.hyperparameter_gate)
+        search_kwargs: dict (optional)
+            Additional keyword arguments for the search strategy e.g. n_iter for random search
 
         Returns
         -------
@@ -301,8 +311,11 @@ class GatingStrategy(mongoengine.Document):
               "hyperparameter and each value a list of parameter values"
         assert isinstance(params, dict), err
         assert all([isinstance(x, list) for x in params.values()]), err
+        assert search in ["grid", "random", "halving"], "search should be one of: 'grid', 'random' or 'halving'"
         self.hyperparameter_search[gate_name] = {"grid": params,
-                                                 "cost": cost}
+                                                 "cost": cost,
+                                                 "search": search,
+                                                 "search_kwargs": search_kwargs or {}}
 
     def apply_gate(self,
                    gate: str or Gate or ThresholdGate or PolygonGate or EllipseGate,
@@ -312,7 +325,8 @@ class GatingStrategy(mongoengine.Document):
                    create_plot_kwargs: dict or None = None,
                    plot_gate_kwargs: dict or None = None,
                    hyperparam_search: bool = True,
-                   overwrite_method_kwargs: dict or None = None):
+                   overwrite_method_kwargs: dict or None = None,
+                   njobs: int = 1):
         """
         Apply a gate to the associated FileGroup. The gate must be previously defined;
         children associated and labeled. Either a Gate object can be provided or the name
@@ -339,6 +353,9 @@ class GatingStrategy(mongoengine.Document):
         overwrite_method_kwargs: dict, optional
             If a dictionary is provided (and hyperparameter search isn't defined for this gate)
             then method parameters are overwritten with these new parameters.
+        njobs: int (default=1)
+            Number of threads used to search the hyperparameter grid (see CytoPy.flow.gate_search);
+            -1 will use all available cores
         Returns
         -------
         Matplotlib.Axes or None
@@ -357,16 +374,11 @@ class GatingStrategy(mongoengine.Document):
         original_method_kwargs = gate.method_kwargs.copy()
         if overwrite_method_kwargs is not None:
             gate.method_kwargs = overwrite_method_kwargs
-        if gate.gate_name in self.hyperparameter_search.keys() and hyperparam_search:
-            populations = hyperparameter_gate(gate=gate,
-                                              grid=self.hyperparameter_search.get(gate.gate_name).get("grid"),
-                                              cost=self.hyperparameter_search.get(gate.gate_name).get("cost"),
-                                              parent=parent_data,
-                                              verbose=verbose)
-        elif gate.ctrl is None:
-            populations = gate.fit_predict(data=parent_data)
-        else:
-            populations = self._control_gate(gate=gate)
+        populations = self._fit_gate(gate=gate,
+                                     parent_data=parent_data,
+                                     verbose=verbose,
+                                     hyperparam_search=hyperparam_search,
+                                     njobs=njobs)
         for p in populations:
             self.filegroup.add_population(population=p)
         if verbose:
@@ -381,15 +393,69 @@ class GatingStrategy(mongoengine.Document):
         gate.method_kwargs = original_method_kwargs
         return None
 
+    def _fit_gate(self,
+                  gate: Gate or ThresholdGate or PolygonGate or EllipseGate,
+                  parent_data: pd.DataFrame,
+                  verbose: bool = True,
+                  hyperparam_search: bool = True,
+                  njobs: int = 1) -> list:
+        """
+        Fit a gate to the given parent data and return the resulting populations, without
+        modifying the population tree of the associated FileGroup. Hyperparameter search is
+        performed if defined for this gate and requested, otherwise if the gate has a control
+        it is fitted to control data (see _control_gate).
+
+        Parameters
+        ----------
+        gate: Gate or ThresholdGate or PolygonGate or EllipseGate
+        parent_data: Pandas.DataFrame
+        verbose: bool (default=True)
+        hyperparam_search: bool (default=True)
+        njobs: int (default=1)
+            Number of threads used to search the hyperparameter grid
+
+        Returns
+        -------
+        list
+            List of Populations
+        """
+        if gate.gate_name in self.hyperparameter_search.keys() and hyperparam_search:
+            search = self.hyperparameter_search.get(gate.gate_name)
+            return hyperparameter_gate(gate=gate,
+                                       grid=search.get("grid"),
+                                       cost=search.get("cost"),
+                                       parent=parent_data,
+                                       verbose=verbose,
+                                       njobs=njobs,
+                                       search=search.get("search", "grid"),
+                                       **search.get("search_kwargs", {}))
+        if gate.ctrl is None:
+            return gate.fit_predict(data=parent_data)
+        return self._control_gate(gate=gate, parent_data=parent_data)
+
     def apply_all(self,
-                  verbose: bool = True):
+                  verbose: bool = True,
+                  njobs: int = 1,
+                  search_njobs: int = 1):
         """
-        Apply all the gates associated to this GatingStrategy
+        Apply all the gates associated to this GatingStrategy. Gates and actions are ordered by
+        the populations they require (the parent of a gate or the left and right populations of an
+        action) and the populations they generate. Each gate is fitted as soon as its parent population
+        exists, so gates that do not depend upon one another (e.g. sibling gates sharing a parent) are
+        fitted concurrently. The data of a parent population is loaded once and shared by all gates
+        applied to it. Only the fitting of gates is performed by worker threads; loading (or estimating)
+        control populations, updating the children of control gates and modifying the population tree
+        are performed in the calling thread.
 
         Parameters
         ----------
         verbose: bool (default=True)
             If True, print feedback to stdout
+        njobs: int (default=1)
+            Number of threads used to fit gates concurrently; -1 will use all available cores.
+        search_njobs: int (default=1)
+            Number of threads used to search hyperparameter grids (see CytoPy.flow.gate_search);
+            ignored, and searches performed in a single thread, if gates are fitted concurrently
 
         Returns
         -------
@@ -401,41 +467,87 @@ class GatingStrategy(mongoengine.Document):
         assert len(self.gates) > 0, "No gates to apply"
         err = "One or more of the populations generated from this gating strategy are already " \
               "presented in the population tree"
-        assert all([x not in self.list_populations() for x in populations_created]), err
-        gates_to_apply = list(self.gates)
-        actions_to_apply = list(self.actions)
-        i = 0
-        iteration_limit = len(gates_to_apply) * 100
+        existing_populations = set(self.list_populations())
+        assert all([x not in existing_populations for x in populations_created]), err
+        if njobs < 0:
+            njobs = cpu_count()
+        nodes = {("gate", g.gate_name): g for g in self.gates}
+        nodes.update({("action", a.action_name): a for a in self.actions})
+        # Populations each gate/action is waiting upon and the gates/actions waiting upon each population
+        requires = {key: {node.parent} if key[0] == "gate" else {node.left, node.right}
+                    for key, node in nodes.items()}
+        requires = {key: pops.difference(existing_populations) for key, pops in requires.items()}
+        waiting = defaultdict(list)
+        for key, pops in requires.items():
+            for p in pops:
+                waiting[p].append(key)
+        ready = deque([key for key, pops in requires.items() if len(pops) == 0])
+        parent_data = dict()
+        gates_per_parent = Counter([g.parent for g in self.gates])
+
+        def populations_generated(population_names: list):
+            for name in population_names:
+                for key in waiting.pop(name, []):
+                    requires[key].discard(name)
+                    if len(requires[key]) == 0:
+                        ready.append(key)
+
         feedback("=====================================================")
-        while len(gates_to_apply) > 0:
-            if i >= len(gates_to_apply):
-                i = 0
-            gate = gates_to_apply[i]
-            if gate.parent in self.list_populations():
-                if self.filegroup.population_stats(gate.parent).get("n") <= 3:
-                    raise ValueError(f"Insufficient events in parent population {gate.parent}")
-                feedback(f"------ Applying {gate.gate_name} ------")
-                self.apply_gate(gate=gate,
-                                plot=False,
-                                verbose=verbose,
-                                add_to_strategy=False)
-                feedback("----------------------------------------")
-                gates_to_apply = [g for g in gates_to_apply if g.gate_name != gate.gate_name]
-            actions_applied_this_loop = list()
-            for a in actions_to_apply:
-                if a.left in self.list_populations() and a.right in self.list_populations():
-                    feedback(f"------ Applying {a.action_name} ------")
-                    self.apply_action(action=a,
-                                      print_stats=verbose,
-                                      add_to_strategy=False)
+        with ThreadPoolExecutor(max_workers=njobs) as executor:
+            futures = dict()
+            while len(ready) > 0 or len(futures) > 0:
+                while len(ready) > 0:
+                    node = nodes[ready.popleft()]
+                    if isinstance(node, Action):
+                        feedback(f"------ Applying {node.action_name} ------")
+                        self.apply_action(action=node,
+                                          print_stats=verbose,
+                                          add_to_strategy=False)
+                        feedback("----------------------------------------")
+                        populations_generated([node.new_population_name or
+                                               f"{node.method}_{node.left}_{node.right}"])
+                        continue
+                    if self.filegroup.population_stats(node.parent).get("n") <= 3:
+                        raise ValueError(f"Insufficient events in parent population {node.parent}")
+                    if node.parent not in parent_data:
+                        parent_data[node.parent] = self.filegroup.load_population_df(population=node.parent,
+                                                                                     transform=None,
+                                                                                     label_downstream_affiliations=False)
+                    feedback(f"------ Applying {node.gate_name} ------")
+                    if node.ctrl is not None and node.gate_name not in self.hyperparameter_search.keys():
+                        # Fit control data first; children are updated once fitted (see _control_gate)
+                        future = executor.submit(node.fit_predict, data=self._ctrl_parent_data(gate=node))
+                        futures[future] = (node, True)
+                        continue
+                    future = executor.submit(self._fit_gate,
+                                             gate=node,
+                                             parent_data=parent_data[node.parent],
+                                             verbose=verbose,
+                                             njobs=1 if njobs > 1 else search_njobs)
+                    futures[future] = (node, False)
+                if len(futures) == 0:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    gate, is_ctrl = futures.pop(future)
+                    populations = future.result()
+                    if is_ctrl:
+                        self._update_ctrl_children(gate=gate, populations=populations)
+                        future = executor.submit(gate.fit_predict, data=parent_data[gate.parent])
+                        futures[future] = (gate, False)
+                        continue
+                    for p in populations:
+                        self.filegroup.add_population(population=p)
+                    if verbose:
+                        gate_stats(gate=gate, parent_data=parent_data[gate.parent], populations=populations)
                     feedback("----------------------------------------")
-                    actions_applied_this_loop.append(a.action_name)
-            actions_to_apply = [a for a in actions_to_apply
-                                if a.action_name not in actions_applied_this_loop]
-            i += 1
-            iteration_limit -= 1
-            assert iteration_limit > 0, "Maximum number of iterations reached. This means that one or more parent " \
-                                        "populations are not being identified."
+                    gates_per_parent[gate.parent] -= 1
+                    if gates_per_parent[gate.parent] == 0:
+                        parent_data.pop(gate.parent)
+                    populations_generated([p.population_name for p in populations])
+        not_applied = [key[1] for key, pops in requires.items() if len(pops) > 0]
+        assert len(not_applied) == 0, f"The following gates/actions could not be applied because one or more " \
+                                      f"parent populations were not identified: {not_applied}"
 
     def delete_actions(self,
                        action_name: str):
@@ -716,7 +828,8 @@ class GatingStrategy(mongoengine.Document):
         transforms = [gate.transformations.get(x, None) for x in ["x", "y"]]
         transforms = {k: v for k, v in zip([gate.x, gate.y], transforms) if k is not None}
         parent = self.filegroup.load_population_df(population=gate.parent,
-                                                   transform=transforms)
+                                                   transform=transforms,
+                                                   columns=list(transforms.keys()))
         for child in gate.children:
             pop = self.filegroup.get_population(population_name=child.name)
             if isinstance(pop.geom, ThresholdGeom):
@@ -758,7 +871,8 @@ class GatingStrategy(mongoengine.Document):
                                                [pop.geom.transform_x, pop.geom.transform_y])
                           if k is not None}
             parent = self.filegroup.load_population_df(population=pop.parent,
-                                                       transform=transforms)
+                                                       transform=transforms,
+                                                       columns=list(transforms.keys()))
             if isinstance(pop.geom, ThresholdGeom):
                 update_threshold(population=pop,
                                  parent_data=parent,
@@ -771,7 +885,8 @@ class GatingStrategy(mongoengine.Document):
                                y_values=pop.geom.y_values)
 
     def _control_gate(self,
-                      gate: Gate or ThresholdGate or PolygonGate or EllipseGate):
+                      gate: Gate or ThresholdGate or PolygonGate or EllipseGate,
+                      parent_data: pd.DataFrame or None = None):
         """
         Internal method for applying a gate using control data. Will first attempt to fetch the parent
         population for the control data (see CytoPy.data.fcs.FileGroup.load_ctrl_population_df)
@@ -781,18 +896,62 @@ class GatingStrategy(mongoengine.Document):
         Parameters
         ----------
         gate: Gate or ThresholdGate or PolygonGate or EllipseGate
+        parent_data: Pandas.DataFrame (optional)
+            Parent population from the primary data; loaded from the associated FileGroup if not given
 
         Returns
         -------
         list
             List of Populations
         """
-        assert gate.ctrl in self.filegroup.controls, f"FileGroup does not have data for {gate.ctrl}"
-        ctrl_parent_data = self.filegroup.load_ctrl_population_df(ctrl=gate.ctrl,
-                                                                  population=gate.parent,
-                                                                  transform=None)
+        ctrl_parent_data = self._ctrl_parent_data(gate=gate)
         # Fit control data
-        populations = gate.fit_predict(data=ctrl_parent_data)
+        self._update_ctrl_children(gate=gate, populations=gate.fit_predict(data=ctrl_parent_data))
+        # Predict original data
+        if parent_data is None:
+            parent_data = self.filegroup.load_population_df(population=gate.parent,
+                                                            transform=None,
+                                                            label_downstream_affiliations=False)
+        return gate.fit_predict(data=parent_data)
+
+    def _ctrl_parent_data(self,
+                          gate: Gate or ThresholdGate or PolygonGate or EllipseGate) -> pd.DataFrame:
+        """
+        Load the parent population of the given gate from the control data the gate
+        is fitted to (see CytoPy.data.fcs.FileGroup.load_ctrl_population_df). If the control
+        population has not been previously estimated this will modify the population tree of
+        the associated FileGroup.
+
+        Parameters
+        ----------
+        gate: Gate or ThresholdGate or PolygonGate or EllipseGate
+
+        Returns
+        -------
+        Pandas.DataFrame
+        """
+        assert gate.ctrl in self.filegroup.controls, f"FileGroup does not have data for {gate.ctrl}"
+        return self.filegroup.load_ctrl_population_df(ctrl=gate.ctrl,
+                                                      population=gate.parent,
+                                                      transform=None)
+
+    @staticmethod
+    def _update_ctrl_children(gate: Gate or ThresholdGate or PolygonGate or EllipseGate,
+                              populations: list):
+        """
+        Update the geometries of the children of a gate with those of the populations
+        estimated from control data.
+
+        Parameters
+        ----------
+        gate: Gate or ThresholdGate or PolygonGate or EllipseGate
+        populations: list
+            Populations generated by fitting the gate to control data
+
+        Returns
+        -------
+        None
+        """
         updated_children = list()
         for p in populations:
             eq_child = [c for c in gate.children if c.name == p.population_name]
@@ -801,11 +960,6 @@ class GatingStrategy(mongoengine.Document):
             eq_child.geom = p.geom
             updated_children.append(eq_child)
         gate.children = updated_children
-        # Predict original data
-        parent_data = self.filegroup.load_population_df(population=gate.parent,
-                                                        transform=None,
-                                                        label_downstream_affiliations=False)
-        return gate.fit_predict(data=parent_data)
 
     def save(self,
              save_strategy: bool = True,
@@ -30,13 +30,12 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import numpy as np
 import pandas as pd
-from multiprocessing import Pool, cpu_count
 from warnings import warn
-from functools import partial
 from matplotlib.patches import Ellipse
+from matplotlib.path import Path
 from scipy import linalg, stats
 from scipy.spatial.qhull import ConvexHull, QhullError
-from shapely.geometry import Polygon, Point
+from shapely.geometry import Polygon
 import mongoengine
 
 __author__ = "Ross Burton"
@@ -107,17 +106,38 @@ class PolygonGeom(PopulationGeometry):
         return create_polygon(self.x_values, self.y_values)
 
 
-def point_in_poly(coords: np.array,
-                  poly: Polygon):
-    point = Point(coords)
-    return poly.contains(point)
+def points_in_polygon(xy: np.array,
+                      poly: Polygon) -> np.array:
+    """
+    Return a boolean mask specifying which points (rows of a two dimensional matrix of x,y
+    coordinates) fall within a Polygon. Evaluated for all points at once by ray casting
+    (see matplotlib.path.Path.contains_points) against the exterior of the polygon; points
+    within any interior (hole) of the polygon are excluded.
+
+    Parameters
+    ----------
+    xy: Numpy.array
+        two dimensional matrix (x,y)
+    poly: shapely.geometry.Polygon
+
+    Returns
+    -------
+    Numpy.array
+        Boolean mask of shape (n_points,)
+    """
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    if poly.is_empty:
+        return np.zeros(xy.shape[0], dtype=bool)
+    mask = Path(np.asarray(poly.exterior.coords)).contains_points(xy)
+    for interior in poly.interiors:
+        mask &= ~Path(np.asarray(interior.coords)).contains_points(xy)
+    return mask
 
 
 def inside_polygon(df: pd.DataFrame,
                    x: str,
                    y: str,
-                   poly: Polygon,
-                   njobs: int = -1):
+                   poly: Polygon):
     """
     Return rows in dataframe who's values for x and y are contained in some polygon coordinate shape
 
@@ -131,21 +151,13 @@ def inside_polygon(df: pd.DataFrame,
         name of y-axis plane
     poly: shapely.geometry.Polygon
         Polygon object to search
-    njobs: int
-        Number of jobs to run in parallel, by default uses all available cores
 
     Returns
     --------
     Pandas.DataFrame
         Masked DataFrame containing only those rows that fall within the Polygon
     """
-    if njobs < 0:
-        njobs = cpu_count()
-    xy = df[[x, y]].values
-    f = partial(point_in_poly, poly=poly)
-    with Pool(njobs) as pool:
-        mask = list(pool.map(f, xy))
-    return df.iloc[mask]
+    return df[points_in_polygon(df[[x, y]].values, poly)]
 
 
 def polygon_overlap(poly1: Polygon,
@@ -191,56 +203,54 @@ def create_polygon(x: list,
 
 
 def inside_ellipse(data: np.array,
-                   center: tuple,
-                   width: int or float,
-                   height: int or float,
-                   angle: int or float) -> object:
+                   center: tuple or np.array,
+                   width: int or float or np.array,
+                   height: int or float or np.array,
+                   angle: int or float or np.array) -> np.array:
     """
     Return mask of two dimensional matrix specifying if a data point (row) falls
-    within an ellipse
+    within an ellipse. Multiple ellipses can be evaluated at once by providing a
+    (n_ellipses, 2) array of centers and arrays of widths, heights and angles, in
+    which case the mask returned is of shape (n_events, n_ellipses)
 
     Parameters
     -----------
     data: Numpy.array
         two dimensional matrix (x,y)
-    center: tuple
-        x,y coordinate corresponding to center of elipse
-    width: int or float
+    center: tuple or Numpy.array
+        x,y coordinate corresponding to center of elipse, or array of coordinates of shape (n_ellipses, 2)
+    width: int or float or Numpy.array
         semi-major axis of eplipse
-    height: int or float
+    height: int or float or Numpy.array
         semi-minor axis of elipse
-    angle: int or float
+    angle: int or float or Numpy.array
         angle of ellipse
 
     Returns
     --------
     Numpy.array
-        numpy array of indices for values inside specified ellipse
+        boolean mask of shape (n_events,), or (n_events, n_ellipses) if multiple ellipses are given
     """
+    data = np.asarray(data, dtype=np.float64)
+    center = np.asarray(center, dtype=np.float64)
+    batch = center.ndim == 2
+    center = center.reshape(-1, 2)
+    width, height, angle = [np.asarray(x, dtype=np.float64).reshape(-1) for x in [width, height, angle]]
+
     cos_angle = np.cos(np.radians(180. - angle))
     sin_angle = np.sin(np.radians(180. - angle))
 
-    x = data[:, 0]
-    y = data[:, 1]
-
-    xc = x - center[0]
-    yc = y - center[1]
+    xc = data[:, [0]] - center[:, 0]
+    yc = data[:, [1]] - center[:, 1]
 
     xct = xc * cos_angle - yc * sin_angle
     yct = xc * sin_angle + yc * cos_angle
 
     rad_cc = (xct ** 2 / (width / 2.) ** 2) + (yct ** 2 / (height / 2.) ** 2)
-
-    in_ellipse = []
-
-    for r in rad_cc:
-        if r <= 1.:
-            # point in ellipse
-            in_ellipse.append(True)
-        else:
-            # point not in ellipse
-            in_ellipse.append(False)
-    return in_ellipse
+    in_ellipse = rad_cc <= 1.
+    if batch:
+        return in_ellipse
+    return in_ellipse[:, 0]
 
 
 def probablistic_ellipse(covariances: np.array,
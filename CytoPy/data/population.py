@@ -31,7 +31,6 @@ TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-from ..flow.transforms import scaler
 from .geometry import PopulationGeometry, ThresholdGeom, PolygonGeom
 from functools import reduce
 from shapely.ops import unary_union
@@ -40,6 +39,7 @@ from _warnings import warn
 import numpy as np
 import pandas as pd
 import mongoengine
+import h5py
 
 __author__ = "Ross Burton"
 __copyright__ = "Copyright 2020, CytoPy"
@@ -80,16 +80,61 @@ class Cluster(mongoengine.EmbeddedDocument):
 
     def __init__(self, *args, **kwargs):
         self._index = kwargs.pop("index", None)
+        # Tracks whether the index has changed since it was last written to disk
+        self._dirty = self._index is not None
+        # HDF5 file and key from which the index is read on first access
+        self._h5path, self._h5key = None, None
         super().__init__(*args, **kwargs)
 
     @property
     def index(self):
+        if self._index is None and self._h5path is not None:
+            with h5py.File(self._h5path, "r") as f:
+                self._index = _read_index(f, self._h5key)
         return self._index
 
     @index.setter
     def index(self, idx: np.array or list):
         self.n = len(idx)
         self._index = np.array(idx)
+        self._dirty = True
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    def defer_index_loading(self,
+                            h5path: str or None,
+                            key: str or None):
+        """
+        Discard any index held in memory and instead read the index from the given
+        HDF5 file when it is first accessed.
+
+        Parameters
+        ----------
+        h5path: str
+            Path to the HDF5 file of the FileGroup this cluster belongs to; if None, the
+            index is missing from disk and will remain None
+        key: str
+            Key of the cluster index within the HDF5 file
+
+        Returns
+        -------
+        None
+        """
+        self._h5path, self._h5key = h5path, key
+        self._index = None
+        self._dirty = False
+
+    def mark_clean(self):
+        """
+        Flag the index of this cluster as in sync with disk
+
+        Returns
+        -------
+        None
+        """
+        self._dirty = False
 
 
 class Population(mongoengine.EmbeddedDocument):
@@ -144,10 +189,20 @@ class Population(mongoengine.EmbeddedDocument):
         # If the Population existed previously, fetched the index
         self._index = kwargs.pop("index", None)
         self._ctrl_index = kwargs.pop("ctrl_index", dict())
+        # Names of the indexes ("primary" or control ID) that have changed since last written to disk
+        self._dirty_indexes = set(self._ctrl_index.keys())
+        if self._index is not None:
+            self._dirty_indexes.add("primary")
+        self._dirty_clusters = False
+        # HDF5 file and group from which indexes are read on first access
+        self._h5path, self._h5key = None, None
         super().__init__(*args, **kwargs)
 
     @property
     def index(self):
+        if self._index is None and self._h5path is not None:
+            with h5py.File(self._h5path, "r") as f:
+                self._index = _read_index(f, f"{self._h5key}/primary")
         return self._index
 
     @index.setter
@@ -155,15 +210,84 @@ class Population(mongoengine.EmbeddedDocument):
         assert isinstance(idx, np.ndarray), "idx should be type numpy.array"
         self.n = len(idx)
         self._index = np.array(idx)
+        self._dirty_indexes.add("primary")
 
     @property
     def ctrl_index(self):
+        if self._ctrl_index is None:
+            with h5py.File(self._h5path, "r") as f:
+                self._ctrl_index = {k: _read_index(f, f"{self._h5key}/{k}")
+                                    for k in f[self._h5key].keys() if k != "primary"}
         return self._ctrl_index
 
     def set_ctrl_index(self, **kwargs):
         for k, v in kwargs.items():
             assert isinstance(v, np.ndarray), "ctrl_idx should be type numpy.array"
-            self._ctrl_index[k] = v
+            self.ctrl_index[k] = v
+            self._dirty_indexes.add(k)
+
+    def defer_index_loading(self,
+                            h5path: str):
+        """
+        Discard any indexes held in memory and instead read them from the given HDF5 file
+        when first accessed; the primary index, control indexes and each cluster index are
+        read independently. Clusters are expected to have been written to the file.
+
+        Parameters
+        ----------
+        h5path: str
+            Path to the HDF5 file of the FileGroup this population belongs to
+
+        Returns
+        -------
+        None
+        """
+        self._h5path, self._h5key = h5path, f"/index/{self.population_name}"
+        self._index, self._ctrl_index = None, None
+        for c in self.clusters:
+            c.defer_index_loading(h5path=h5path,
+                                  key=f"/clusters/{self.population_name}/{c.cluster_id}_{c.tag}")
+        self.mark_clean()
+
+    @property
+    def dirty_indexes(self) -> set:
+        """
+        Names of the indexes ("primary" or control ID) that have changed since they were
+        last written to disk
+
+        Returns
+        -------
+        set
+        """
+        return self._dirty_indexes
+
+    @property
+    def dirty_clusters(self) -> bool:
+        """
+        True if clusters have been added, removed or modified since last written to disk
+
+        Returns
+        -------
+        bool
+        """
+        return self._dirty_clusters or any([c.dirty for c in self.clusters])
+
+    @property
+    def dirty(self) -> bool:
+        return len(self._dirty_indexes) > 0 or self.dirty_clusters
+
+    def mark_clean(self):
+        """
+        Flag the indexes and clusters of this population as in sync with disk
+
+        Returns
+        -------
+        None
+        """
+        self._dirty_indexes = set()
+        self._dirty_clusters = False
+        for c in self.clusters:
+            c.mark_clean()
 
     def add_cluster(self,
                     cluster: Cluster):
@@ -181,6 +305,7 @@ class Population(mongoengine.EmbeddedDocument):
         _id, tag = cluster.cluster_id, cluster.tag
         self.clusters = [c for c in self.clusters if sum([c.tag == tag, c.cluster_id == _id]) != 2]
         self.clusters.append(cluster)
+        self._dirty_clusters = True
 
     def delete_cluster(self,
                        cluster_id: str or None = None,
@@ -207,6 +332,7 @@ class Population(mongoengine.EmbeddedDocument):
             self.clusters = [c for c in self.clusters if c.tag != tag]
         elif meta_label:
             self.clusters = [c for c in self.clusters if c.meta_label != meta_label]
+        self._dirty_clusters = True
 
     def delete_all_clusters(self,
                             clusters: list or str = "all"):
@@ -226,6 +352,7 @@ class Population(mongoengine.EmbeddedDocument):
             self.clusters = [c for c in self.clusters if c.cluster_id not in clusters]
         else:
             self.clusters = []
+        self._dirty_clusters = True
 
     def list_clusters(self,
                       tag: str or None = None,
@@ -326,6 +453,80 @@ def _check_transforms_dimensions(left: Population,
     assert left.geom.y == right.geom.y, "Y dimension differs between left and right populations"
 
 
+def encode_index(idx: np.ndarray) -> np.ndarray:
+    """
+    Compress an index of events using delta and run-length encoding. The index is treated as a
+    set (it is sorted and duplicates are removed) and described as runs of consecutive events,
+    each run given as the gap from the end of the previous run and the length of the run. The
+    result is a (2, n_runs) array cast to the smallest unsigned integer type that can hold it;
+    for a gated population this is typically orders of magnitude smaller than the int64 index.
+
+    Parameters
+    ----------
+    idx: Numpy.Array
+
+    Returns
+    -------
+    Numpy.Array
+        Array of shape (2, n_runs); the first row is the gaps and the second the run lengths
+    """
+    idx = np.unique(np.asarray(idx, dtype=np.int64))
+    if idx.shape[0] == 0:
+        return np.zeros((2, 0), dtype=np.uint8)
+    assert idx[0] >= 0, "Index should not contain negative values"
+    breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+    starts = idx[np.concatenate([[0], breaks])]
+    ends = idx[np.concatenate([breaks - 1, [idx.shape[0] - 1]])] + 1
+    runs = np.vstack([starts - np.concatenate([[0], ends[:-1]]), ends - starts])
+    return runs.astype(np.min_scalar_type(runs.max()))
+
+
+def decode_index(runs: np.ndarray) -> np.ndarray:
+    """
+    Decode an index compressed using encode_index.
+
+    Parameters
+    ----------
+    runs: Numpy.Array
+        Array of shape (2, n_runs) as generated by encode_index
+
+    Returns
+    -------
+    Numpy.Array
+        Sorted int64 index of events
+    """
+    gaps, lengths = np.asarray(runs, dtype=np.int64)
+    if lengths.shape[0] == 0:
+        return np.array([], dtype=np.int64)
+    ends = np.cumsum(gaps + lengths)
+    starts = ends - lengths
+    # Step between consecutive events is 1 within a run and jumps to the next start between runs
+    steps = np.ones(lengths.sum(), dtype=np.int64)
+    steps[0] = starts[0]
+    steps[np.cumsum(lengths)[:-1]] = starts[1:] - ends[:-1] + 1
+    return np.cumsum(steps)
+
+
+def _read_index(f: h5py.File,
+                key: str) -> np.ndarray:
+    """
+    Read an index of events from a HDF5 file. Indexes written before run-length encoding
+    was introduced are stored as plain arrays and are returned as is.
+
+    Parameters
+    ----------
+    f: h5py.File
+    key: str
+
+    Returns
+    -------
+    Numpy.Array
+    """
+    if f[key].attrs.get("encoding", None) == "rle":
+        return decode_index(f[key][:])
+    return f[key][:]
+
+
 def _merge_index(left: Population,
                  right: Population) -> np.ndarray:
     """
@@ -340,7 +541,7 @@ def _merge_index(left: Population,
     -------
     Numpy.Array
     """
-    return np.unique(np.concatenate([left.index, right.index], axis=0), axis=0)
+    return np.union1d(left.index, right.index)
 
 
 def _merge_signatures(left: Population,
@@ -514,15 +715,140 @@ def create_signature(data: pd.DataFrame,
     if data.shape[0] == 0:
         warn("Cannot generate signature for empty dataframe")
         return {}
-    data = pd.DataFrame(scaler(data=data.values, scale_method="norm", return_scaler=False),
-                        columns=data.columns,
-                        index=data.index)
     if idx is None:
-        idx = data.index.values
-    # ToDo this should be more robust
-    for x in ["Time", "time"]:
-        if x in data.columns:
-            data.drop(x, 1, inplace=True)
+        return create_signatures(data=data,
+                                 labels=np.zeros(data.shape[0], dtype=np.int8),
+                                 n_labels=1,
+                                 summary_method=summary_method)[0]
+    # Data is scaled as a whole and then summarised for the events in idx
+    return create_signatures(data=data,
+                             labels=data.index.isin(idx).reshape(-1, 1),
+                             summary_method=summary_method,
+                             normalise="data")[0]
+
+
+def _signature_groups(labels: np.array,
+                      n_labels: int or None) -> List[np.array]:
+    """
+    Row positions for each group of events described by labels (see create_signatures).
+
+    Parameters
+    ----------
+    labels: Numpy.array
+    n_labels: int (optional)
+
+    Returns
+    -------
+    List
+        List of integer arrays, one per group
+    """
+    if labels.ndim == 2:
+        groups = [np.flatnonzero(labels[:, i]) for i in range(labels.shape[1])]
+    else:
+        if n_labels is None:
+            n_labels = int(labels.max()) + 1 if labels.shape[0] > 0 else 0
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(n_labels + 1), side="left")
+        groups = [order[bounds[i]:bounds[i + 1]] for i in range(n_labels)]
+    return groups
+
+
+def _minmax(x: np.array,
+            fit: np.array or None = None) -> np.array:
+    """
+    Min-max scale a vector as per MinMaxScaler (ranges close to zero are treated as 1)
+
+    Parameters
+    ----------
+    x: Numpy.array
+    fit: Numpy.array (optional)
+        Values the scaler is fitted to, defaults to x
+
+    Returns
+    -------
+    Numpy.array
+    """
+    fit = x if fit is None else fit
+    data_min = np.nanmin(fit)
+    data_range = np.nanmax(fit) - data_min
+    if data_range < 10 * np.finfo(x.dtype).eps:
+        data_range = 1.
+    scale = 1. / data_range
+    return x * scale + (-data_min * scale)
+
+
+def create_signatures(data: pd.DataFrame,
+                      labels: np.array,
+                      n_labels: int or None = None,
+                      summary_method: callable or None = None,
+                      normalise: str = "group",
+                      max_events: int or None = None,
+                      random_state: int or None = None) -> List[dict]:
+    """
+    Generate a signature (see create_signature) for each of multiple groups of events in a dataframe
+    in a single pass over the columns of the dataframe, without copying the dataframe or any subset of it.
+
+    Groups are described by labels, either as an integer array giving the group of each event (row),
+    where events with a negative label are excluded, or as a boolean array of shape (n_events, n_groups),
+    where groups may overlap.
+
+    Parameters
+    ----------
+    data: Pandas.DataFrame
+    labels: Numpy.array
+        Integer label for each event or boolean mask of shape (n_events, n_groups)
+    n_labels: int (optional)
+        Number of groups when labels is an integer array; signatures are returned for labels 0 to
+        n_labels - 1. If not given, inferred from the largest label
+    summary_method: callable (optional)
+        Function to use to summarise columns, defaults is Numpy.median
+    normalise: str (default="group")
+        How events are min-max scaled prior to summarising:
+            * group - scaler fitted to the events of each group, equivalent to calling
+            create_signature on each subset of the dataframe
+            * data - scaler fitted once to all events in the dataframe, equivalent to calling
+            create_signature with the index of each group
+    max_events: int (optional)
+        If given, groups with more events than this are summarised from a uniform random
+        subset of max_events events; gives approximate medians/quantiles for very large populations.
+        Scaling is always fitted to all events
+    random_state: int (optional)
+        Seed for the subset of events taken when max_events is given
+
+    Returns
+    -------
+    List
+        List of signature dictionaries, one per group
+    """
+    if normalise not in ["group", "data"]:
+        raise ValueError("normalise should be one of: 'group' or 'data'")
+    labels = np.asarray(labels)
+    assert labels.shape[0] == data.shape[0], "labels must be the same length as data"
     summary_method = summary_method or np.median
-    signature = data.loc[idx].apply(summary_method)
-    return {x[0]: x[1] for x in zip(signature.index, signature.values)}
\ No newline at end of file
+    groups = _signature_groups(labels=labels, n_labels=n_labels)
+    for g in groups:
+        if g.shape[0] == 0:
+            warn("Cannot generate signature for empty dataframe")
+    subsets = [None for _ in groups]
+    if max_events is not None:
+        rng = np.random.default_rng(random_state)
+        subsets = [rng.choice(g.shape[0], size=max_events, replace=False) if g.shape[0] > max_events else None
+                   for g in groups]
+    signatures = [dict() for _ in groups]
+    # ToDo this should be more robust
+    columns = [x for x in data.columns if x not in ["Time", "time"]]
+    for c in columns:
+        # Summaries must be float64 to be encoded by Mongo
+        values = data[c].values.astype(np.float64, copy=False)
+        if normalise == "data":
+            values = _minmax(values)
+        for i, (g, subset) in enumerate(zip(groups, subsets)):
+            if g.shape[0] == 0:
+                continue
+            if normalise == "group":
+                v = values[g]
+                v = _minmax(v if subset is None else v[subset], fit=v)
+            else:
+                v = values[g if subset is None else g[subset]]
+            signatures[i][c] = summary_method(v)
+    return signatures
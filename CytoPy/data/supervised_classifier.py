@@ -36,7 +36,7 @@ from ..flow.transforms import scaler
 from ..flow import supervised
 from ..flow import sampling
 from .experiment import Experiment, FileGroup
-from .population import Population, create_signature
+from .population import Population, create_signatures
 from imblearn.over_sampling import RandomOverSampler
 from sklearn.model_selection import train_test_split, KFold, learning_curve, \
     BaseCrossValidator, GridSearchCV, RandomizedSearchCV
@@ -280,7 +280,7 @@ class CellClassifier(mongoengine.Document):
         else:
             if "h" not in kwargs.keys():
                 warn("Parameter 'h' not given for faithful downsampling, defaulting to 0.01")
-            x = sampling.faithful_downsampling(data=x, h=kwargs.get("h", 0.01))
+            x = x.iloc[sampling.faithful_downsampling(data=x.drop("y", axis=1).values, h=kwargs.get("h", 0.01))]
         y = x["y"].values
         x.drop("y", inplace=True)
         return x, y
@@ -481,7 +481,8 @@ class CellClassifier(mongoengine.Document):
                                      x: pd.DataFrame,
                                      y_pred: np.ndarray,
                                      root_population: str,
-                                     target: FileGroup):
+                                     target: FileGroup,
+                                     signature: dict):
         """
         For single class multi-label classification some cells will
         not be associated to any particular population (these are
@@ -500,6 +501,8 @@ class CellClassifier(mongoengine.Document):
             Starting point of analysis and parent population
         target: FileGroup
             Target FileGroup for which Populations are being predicted
+        signature: dict
+            Signature of unclassified cells (see CytoPy.data.population.create_signatures)
 
         Returns
         -------
@@ -511,7 +514,7 @@ class CellClassifier(mongoengine.Document):
                                          n=len(idx),
                                          parent=root_population,
                                          warnings=["supervised_classification"],
-                                         signature=create_signature(data=x, idx=idx)))
+                                         signature=signature))
 
     def predict(self,
                 experiment: Experiment,
@@ -556,11 +559,19 @@ class CellClassifier(mongoengine.Document):
         x = target.load_population_df(population=root_population,
                                       transform=self.transform)[self.features]
         y_pred, y_score = self._predict(x=x, threshold=threshold)
-        if not self.multi_class:
+        # Features are scaled once and signatures generated for all predicted populations together
+        if self.multi_class:
+            signatures = create_signatures(data=x, labels=y_pred.astype(bool), normalise="data")
+        else:
+            signatures = create_signatures(data=x,
+                                           labels=y_pred,
+                                           n_labels=len(self.target_populations) + 1,
+                                           normalise="data")
             self._add_unclassified_population(x=x,
                                               y_pred=y_pred,
                                               root_population=root_population,
-                                              target=target)
+                                              target=target,
+                                              signature=signatures[0])
         for i, pop in enumerate(self.target_populations):
             if self.multi_class:
                 idx = x.index.values[np.where(y_pred[:, i + 1] == 1)[0]]
@@ -571,7 +582,7 @@ class CellClassifier(mongoengine.Document):
                                              n=len(idx),
                                              parent=root_population,
                                              warnings=["supervised_classification"],
-                                             signature=create_signature(data=x, idx=idx)))
+                                             signature=signatures[i + 1]))
         if return_predictions:
             return target, {"y_pred": y_pred, "y_score": y_score}
         return target
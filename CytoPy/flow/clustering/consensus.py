@@ -28,9 +28,9 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 from ...feedback import progress_bar
-from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 import numpy as np
-import bisect
 
 __author__ = "Ross Burton"
 __copyright__ = "Copyright 2020, CytoPy"
@@ -42,12 +42,35 @@ __email__ = "burtonrj@cardiff.ac.uk"
 __status__ = "Production"
 
 
+def cdf_area(consensus_matrix: np.array) -> float:
+    """
+    Area under the empirical CDF of the entries of a consensus matrix (see paper)
+
+    Parameters
+    ----------
+    consensus_matrix: Numpy.array
+
+    Returns
+    -------
+    float
+    """
+    hist, bins = np.histogram(consensus_matrix.ravel(), density=True)
+    return float(np.sum(np.cumsum(hist) * np.diff(bins)))
+
+
 class ConsensusCluster:
     """
     Implementation of Consensus clustering, following the paper
     https://link.springer.com/content/pdf/10.1023%2FA%3A1023949509487.pdf
     Code is adapted from https://github.com/ZigaSajovic/Consensus_Clustering
 
+    For each resample, co-occurrence of observations in the same cluster is counted by the product
+    of a one-hot matrix of cluster labels with its transpose (Z @ Z.T), and co-sampling of observations
+    by the outer product of a resample indicator vector. Consensus matrices are held in float32 and
+    only the consensus matrix of the current number of clusters and of the best number of clusters
+    found so far are kept in memory. Resamples for each number of clusters can be clustered across
+    a pool of threads (see njobs).
+
     Parameters
     ----------
     cluster :
@@ -60,8 +83,13 @@ class ConsensusCluster:
         number of resamplings for each cluster number
     resample_proportion :
         percentage to sample
+    njobs :
+        number of threads used to cluster resamples (default=1); -1 will use all available cores
+    random_state :
+        seed for resampling
     Mk:
-        consensus matrices for each k (OTE: every consensus matrix is retained)
+        consensus matrix for the best number of clusters (NOTE: consensus matrices of other numbers
+        of clusters are not retained)
     Ak :
         area under CDF for each number of clusters (see paper)
     deltaK :
@@ -74,7 +102,9 @@ class ConsensusCluster:
                  largest_cluster_n: int,
                  n_resamples: int,
                  resample_proportion: float = 0.5,
-                 verbose: bool = True):
+                 verbose: bool = True,
+                 njobs: int = 1,
+                 random_state: int or None = None):
         assert 0 <= resample_proportion <= 1, "proportion has to be between 0 and 1"
         self.verbose = verbose
         self.cluster_ = cluster
@@ -82,13 +112,17 @@ class ConsensusCluster:
         self.L_ = smallest_cluster_n
         self.K_ = largest_cluster_n
         self.H_ = n_resamples
+        self.njobs = cpu_count() if njobs < 0 else njobs
+        self.random_state = random_state
         self.Mk = None
         self.Ak = None
         self.deltaK = None
         self.bestK = None
 
     @staticmethod
-    def _internal_resample(data: np.array, proportion: float) -> (np.array, np.array):
+    def _internal_resample(data: np.array,
+                           proportion: float,
+                           rng: np.random.Generator or None = None) -> (np.array, np.array):
         """Resampling array
         Parameters
         ----------
@@ -96,15 +130,66 @@ class ConsensusCluster:
             data to be resampled
         proportion : float
             percentage to resample
+        rng : Numpy.random.Generator (optional)
+            random generator to sample with
         Returns
         -------
         Numpy.array, Numpy.array
             Resampled indices and numpy array of resampled data
         """
-        resampled_indices = np.random.choice(
-            range(data.shape[0]), size=int(data.shape[0]*proportion), replace=False)
+        rng = rng or np.random.default_rng()
+        resampled_indices = rng.choice(data.shape[0], size=int(data.shape[0]*proportion), replace=False)
         return resampled_indices, data[resampled_indices, :]
 
+    def _consensus_matrix(self,
+                          data: np.array,
+                          k: int,
+                          seed: np.random.SeedSequence,
+                          executor: ThreadPoolExecutor or None = None) -> np.array:
+        """Consensus matrix for a given number of clusters; the proportion of resamples containing
+        both observations in which the two observations are clustered together
+        Parameters
+        ----------
+        data : Numpy.array
+        k : int
+            number of clusters
+        seed : Numpy.random.SeedSequence
+            seed from which the seed of each resample is spawned
+        executor : ThreadPoolExecutor (optional)
+            if given, resamples are clustered using this pool of threads
+        Returns
+        -------
+        Numpy.array
+            Consensus matrix of shape (n, n) (float32)
+        """
+        n = data.shape[0]
+
+        def cluster_resample(resample_seed: np.random.SeedSequence):
+            resampled_indices, resample_data = self._internal_resample(data,
+                                                                       self.resample_proportion_,
+                                                                       np.random.default_rng(resample_seed))
+            return resampled_indices, self.cluster_(n_clusters=k).fit_predict(resample_data)
+
+        seeds = seed.spawn(self.H_)
+        if executor is None:
+            results = map(cluster_resample, seeds)
+        else:
+            results = executor.map(cluster_resample, seeds)
+        connectivity = np.zeros((n, n), dtype=np.float32)
+        indicator = np.zeros((n, n), dtype=np.float32)
+        for resampled_indices, labels in results:
+            _, labels = np.unique(labels, return_inverse=True)
+            # One-hot cluster membership of each observation (rows of observations not resampled are zero)
+            z = np.zeros((n, labels.max() + 1), dtype=np.float32)
+            z[resampled_indices, labels] = 1
+            connectivity += z @ z.T
+            sampled = np.zeros(n, dtype=np.float32)
+            sampled[resampled_indices] = 1
+            indicator += np.outer(sampled, sampled)
+        connectivity /= indicator + 1e-8
+        np.fill_diagonal(connectivity, 1)  # always with self
+        return connectivity
+
     def fit(self, data: np.array) -> None:
         """Fits a consensus matrix for each number of clusters
         Parameters
@@ -115,48 +200,45 @@ class ConsensusCluster:
         -------
         None
         """
-        # Init a connectivity matrix and an indicator matrix with zeros
-        Mk = np.zeros((self.K_-self.L_, data.shape[0], data.shape[0]))
-        Is = np.zeros((data.shape[0],)*2)
-        for k in progress_bar(range(self.L_, self.K_), verbose=self.verbose):  # for each number of clusters
-            i_ = k-self.L_
-            for h in range(self.H_):  # resample H times
-                resampled_indices, resample_data = self._internal_resample(
-                    data, self.resample_proportion_)
-                Mh = self.cluster_(n_clusters=k).fit_predict(resample_data)
-                # find indexes of elements from same clusters with bisection
-                # on sorted array => this is more efficient than brute force search
-                id_clusts = np.argsort(Mh)
-                sorted_ = Mh[id_clusts]
-                for i in range(k):  # for each cluster
-                    #
-                    ia = bisect.bisect_left(sorted_, i)
-                    ib = bisect.bisect_right(sorted_, i)
-                    is_ = id_clusts[ia:ib]
-                    ids_ = np.array(list(combinations(is_, 2))).T
-                    # sometimes only one element is in a cluster (no combinations)
-                    if ids_.size != 0:
-                        Mk[i_, ids_[0], ids_[1]] += 1
-                # increment counts
-                ids_2 = np.array(list(combinations(resampled_indices, 2))).T
-                Is[ids_2[0], ids_2[1]] += 1
-            Mk[i_] /= Is+1e-8  # consensus matrix
-            # Mk[i_] is upper triangular (with zeros on diagonal), we now make it symmetric
-            Mk[i_] += Mk[i_].T
-            Mk[i_, range(data.shape[0]), range(
-                data.shape[0])] = 1  # always with self
-            Is.fill(0)  # reset counter
-        self.Mk = Mk
-        # fits areas under the CDFs
-        self.Ak = np.zeros(self.K_-self.L_)
-        for i, m in enumerate(Mk):
-            hist, bins = np.histogram(m.ravel(), density=True)
-            self.Ak[i] = np.sum(h*(b-a) for b, a, h in zip(bins[1:], bins[:-1], np.cumsum(hist)))
+        seeds = np.random.SeedSequence(self.random_state).spawn(self.K_ - self.L_)
+        self.Ak = np.zeros(self.K_ - self.L_)
+        previous, best = None, None
+        executor = ThreadPoolExecutor(max_workers=self.njobs) if self.njobs > 1 else None
+        try:
+            for k in progress_bar(range(self.L_, self.K_), verbose=self.verbose):  # for each number of clusters
+                i_ = k - self.L_
+                current = self._consensus_matrix(data=data, k=k, seed=seeds[i_], executor=executor)
+                # fits area under the CDF
+                self.Ak[i_] = cdf_area(current)
+                if i_ == 0:
+                    best = current
+                else:
+                    # keep the consensus matrix of the best number of clusters found so far
+                    delta_k = self._delta_k(self.Ak[:i_ + 1])
+                    if np.argmax(delta_k) == i_ - 1:
+                        best = previous
+                previous = current
+        finally:
+            if executor is not None:
+                executor.shutdown()
         # fits differences between areas under CDFs
-        self.deltaK = np.array([(Ab-Aa)/Aa if i > 2 else Aa
-                                for Ab, Aa, i in zip(self.Ak[1:], self.Ak[:-1], range(self.L_, self.K_-1))])
+        self.deltaK = self._delta_k(self.Ak)
         self.bestK = np.argmax(self.deltaK) + \
             self.L_ if self.deltaK.size > 0 else self.L_
+        self.Mk = best
+
+    def _delta_k(self, ak: np.array) -> np.array:
+        """Differences between areas under CDFs
+        Parameters
+        ----------
+        ak : Numpy.array
+            areas under CDF for consecutive numbers of clusters, starting from the smallest
+        Returns
+        -------
+        Numpy.array
+        """
+        return np.array([(Ab-Aa)/Aa if i > 2 else Aa
+                         for Ab, Aa, i in zip(ak[1:], ak[:-1], range(self.L_, self.K_-1))])
 
     def predict(self):
         """Predicts on the consensus matrix, for best found cluster number
@@ -165,7 +247,7 @@ class ConsensusCluster:
             Clustering predictions
         """
         assert self.Mk is not None, "First run fit"
-        return self.cluster_(n_clusters=self.bestK).fit_predict(1-self.Mk[self.bestK-self.L_])
+        return self.cluster_(n_clusters=self.bestK).fit_predict(1-self.Mk)
 
     def predict_data(self, data: np.array):
         """Predicts on the data, for best found cluster number
@@ -178,4 +260,4 @@ class ConsensusCluster:
             Clustering predictions
         """
         assert self.Mk is not None, "First run fit"
-        return self.cluster_(n_clusters=self.bestK).fit_predict(data)
\ No newline at end of file
+        return self.cluster_(n_clusters=self.bestK).fit_predict(data)
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 """
 Here you will find CytoPy's implementation of the FlowSOM algorithm, which
-relies on the MiniSOM library for self-organising maps. The work was
+uses either a native, vectorised self-organising map (SOM) or the MiniSOM library
+for self-organising maps. The work was
 adapted from https://github.com/Hatchin/FlowSOM for integration with CytoPy and
 the database architecture.
 
@@ -30,9 +31,12 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 from ...feedback import progress_bar, vprint
 from .consensus import ConsensusCluster
 from sklearn.preprocessing import MinMaxScaler
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from warnings import warn
 from minisom import MiniSom
 import pandas as pd
+import numpy as np
 
 __author__ = "Ross Burton"
 __copyright__ = "Copyright 2020, CytoPy"
@@ -44,6 +48,371 @@ __email__ = "burtonrj@cardiff.ac.uk"
 __status__ = "Production"
 
 
+def winning_nodes(data: np.array,
+                  weights: np.array,
+                  chunk_size: int = 10000,
+                  njobs: int = 1,
+                  verbose: bool = True) -> np.array:
+    """
+    Find the best matching unit (the node of minimum euclidean distance) for each event, given
+    the flattened weights of a SOM (one row per node). Events are processed in chunks of rows;
+    for each chunk the squared distance to every node is computed by matrix multiplication
+    (|w|^2 - 2x.w, dropping the constant |x|^2) and the minimum taken, so memory is bounded
+    by chunk_size x number of nodes. Chunks can be distributed across a pool of threads (see njobs).
+
+    Parameters
+    ----------
+    data: Numpy.Array
+        Events to assign, shape (n_events, n_features)
+    weights: Numpy.Array
+        Flattened SOM weights, shape (n_nodes, n_features)
+    chunk_size: int (default=10000)
+        Number of events per chunk
+    njobs: int (default=1)
+        Number of threads; -1 will use all available cores
+    verbose: bool (default=True)
+        Show progress bar
+
+    Returns
+    -------
+    Numpy.Array
+        Index of the winning node (in weights) for each event
+    """
+    if njobs < 0:
+        njobs = cpu_count()
+    weights_t = -2 * weights.T
+    weights_norm = np.einsum("ij,ij->i", weights, weights)
+
+    def nearest(x: np.array):
+        dist = x @ weights_t
+        dist += weights_norm
+        return np.argmin(dist, axis=1)
+
+    chunks = [data[i:i + chunk_size] for i in range(0, data.shape[0], chunk_size)]
+    if njobs == 1 or len(chunks) <= 1:
+        results = [nearest(c) for c in progress_bar(chunks, verbose=verbose)]
+    else:
+        with ThreadPoolExecutor(max_workers=njobs) as executor:
+            results = list(progress_bar(executor.map(nearest, chunks), verbose=verbose, total=len(chunks)))
+    if len(results) == 0:
+        return np.array([], dtype=np.int64)
+    return np.concatenate(results)
+
+
+def _decay(value: float,
+           t: int,
+           max_iter: int,
+           method: str,
+           minimum: float = 0.) -> float:
+    """
+    Decay a training parameter (learning rate or sigma) of a self-organising map
+
+    Parameters
+    ----------
+    value: float
+        Initial value
+    t: int
+        Current iteration
+    max_iter: int
+        Total number of iterations
+    method: str
+        "asymptotic" decays the value asymptotically to 1/3 of its original value (as MiniSom's
+        asymptotic_decay), "linear" decays linearly to the given minimum
+    minimum: float (default=0.)
+        Final value for linear decay
+
+    Returns
+    -------
+    float
+    """
+    if method == "asymptotic":
+        return value / (1 + t / (max_iter / 2))
+    return value + t * (minimum - value) / max_iter
+
+
+class SOM:
+    """
+    Self-organising map trained with a vectorised minibatch algorithm, as a faster alternative
+    to MiniSom for FlowSOM. For each minibatch, the best matching units (BMUs) of all events are found
+    in matrix form (see winning_nodes) and every node is moved toward the mean of the events of the
+    minibatch, weighted by the neighbourhood function centred on each event's BMU:
+
+        w += learning_rate * (sum(h(bmu, w) * x) / sum(h(bmu, w)) - w)
+
+    (with a learning rate of 1 this is the batch SOM algorithm of Kohonen). Events are first summed
+    per BMU, so the neighbourhood is only evaluated between nodes; for the gaussian, bubble and triangle
+    functions, which are products of a function of each grid axis, it is applied one axis at a time.
+    Minibatches can be split across threads, each finding BMUs for a share of the events.
+    All random operations (initialisation and the order of events in each epoch) are seeded.
+
+    Parameters
+    ----------
+    x: int
+        Number of nodes along the first dimension of the map
+    y: int
+        Number of nodes along the second dimension of the map
+    input_len: int
+        Number of features
+    sigma: float (default=1.0)
+        Spread of the neighbourhood function
+    learning_rate: float (default=0.5)
+        Initial learning rate
+    neighborhood_function: str (default="gaussian")
+        One of "gaussian", "mexican_hat", "bubble" or "triangle"
+    decay_function: str (default="asymptotic")
+        How learning rate and sigma decay over training; "asymptotic" (to 1/3 of their initial values)
+        or "linear" (learning rate to zero, sigma to one)
+    random_seed: int (optional)
+    """
+    def __init__(self,
+                 x: int,
+                 y: int,
+                 input_len: int,
+                 sigma: float = 1.0,
+                 learning_rate: float = 0.5,
+                 neighborhood_function: str = "gaussian",
+                 decay_function: str = "asymptotic",
+                 random_seed: int or None = None):
+        if neighborhood_function not in ["gaussian", "mexican_hat", "bubble", "triangle"]:
+            raise ValueError('neighborhood_function must be one of "gaussian", "mexican_hat", "bubble", '
+                             'or "triangle"')
+        if decay_function not in ["asymptotic", "linear"]:
+            raise ValueError('decay_function must be one of "asymptotic" or "linear"')
+        self.x = x
+        self.y = y
+        self.input_len = input_len
+        self.sigma = sigma
+        self.learning_rate = learning_rate
+        self.neighborhood_function = neighborhood_function
+        self.decay_function = decay_function
+        self._rng = np.random.default_rng(random_seed)
+        weights = self._rng.random((x * y, input_len)) * 2 - 1
+        self._weights = weights / np.linalg.norm(weights, axis=-1, keepdims=True)
+        # Grid position of each node, in the order of the flattened weights
+        self._coords = np.indices((x, y)).reshape(2, -1).T.astype(float)
+
+    def get_weights(self) -> np.array:
+        """
+        Returns the weights of the map, shape (x, y, input_len)
+
+        Returns
+        -------
+        Numpy.Array
+        """
+        return self._weights.reshape(self.x, self.y, self.input_len)
+
+    def random_weights_init(self,
+                            data: np.array) -> None:
+        """
+        Initialise weights by picking random events from data
+
+        Parameters
+        ----------
+        data: Numpy.Array
+
+        Returns
+        -------
+        None
+        """
+        self._weights = data[self._rng.integers(data.shape[0], size=self.x * self.y)].astype(float)
+
+    def pca_weights_init(self,
+                         data: np.array) -> None:
+        """
+        Initialise weights to span the first two principal components of data (as MiniSom)
+
+        Parameters
+        ----------
+        data: Numpy.Array
+
+        Returns
+        -------
+        None
+        """
+        assert self.input_len > 1, "The data needs at least 2 features for pca initialization"
+        eigvals, eigvecs = np.linalg.eigh(np.cov(data, rowvar=False))
+        order = np.argsort(eigvals)[::-1]
+        c1, c2 = np.meshgrid(np.linspace(-1, 1, self.x), np.linspace(-1, 1, self.y), indexing="ij")
+        self._weights = (np.mean(data, axis=0) +
+                         c1.reshape(-1, 1) * eigvecs[:, order[0]] +
+                         c2.reshape(-1, 1) * eigvecs[:, order[1]])
+
+    def _axis_neighborhood(self,
+                           n: int,
+                           sigma: float) -> np.array:
+        """
+        Neighbourhood function between the positions of a single axis of the grid, for the
+        neighbourhood functions that are the product of a function of each axis
+
+        Parameters
+        ----------
+        n: int
+            Number of nodes along the axis
+        sigma: float
+
+        Returns
+        -------
+        Numpy.Array
+            Array of shape (n, n)
+        """
+        d = np.arange(n)[:, None] - np.arange(n)[None, :]
+        if self.neighborhood_function == "gaussian":
+            return np.exp(-d ** 2 / (2 * sigma * sigma))
+        if self.neighborhood_function == "bubble":
+            return (np.abs(d) < sigma).astype(float)
+        return np.clip(sigma - np.abs(d), 0, None)
+
+    def neighborhood(self,
+                     bmus: np.array,
+                     sigma: float) -> np.array:
+        """
+        Neighbourhood function centred on each of the given nodes, evaluated for every node of the map
+
+        Parameters
+        ----------
+        bmus: Numpy.Array
+            Index of the centre nodes (in the flattened weights)
+        sigma: float
+
+        Returns
+        -------
+        Numpy.Array
+            Array of shape (len(bmus), number of nodes)
+        """
+        dx = self._coords[bmus, 0][:, None] - self._coords[:, 0]
+        dy = self._coords[bmus, 1][:, None] - self._coords[:, 1]
+        if self.neighborhood_function == "gaussian":
+            return np.exp(-(dx ** 2 + dy ** 2) / (2 * sigma * sigma))
+        if self.neighborhood_function == "mexican_hat":
+            p = dx ** 2 + dy ** 2
+            d = 2 * sigma * sigma
+            return np.exp(-p / d) * (1 - 2 / d * p)
+        if self.neighborhood_function == "bubble":
+            return ((np.abs(dx) < sigma) & (np.abs(dy) < sigma)).astype(float)
+        return np.clip(sigma - np.abs(dx), 0, None) * np.clip(sigma - np.abs(dy), 0, None)
+
+    def winner(self,
+               x: np.array) -> tuple:
+        """
+        Coordinates of the winning node for a single event
+
+        Parameters
+        ----------
+        x: Numpy.Array
+
+        Returns
+        -------
+        tuple
+        """
+        node = winning_nodes(data=np.asarray(x).reshape(1, -1), weights=self._weights, njobs=1, verbose=False)[0]
+        return np.unravel_index(node, (self.x, self.y))
+
+    def _bmu_sums(self,
+                  data: np.array) -> (np.array, np.array):
+        """
+        Sum of events and number of events for each node, where each event is assigned to
+        its best matching unit
+
+        Parameters
+        ----------
+        data: Numpy.Array
+
+        Returns
+        -------
+        Numpy.Array, Numpy.Array
+        """
+        n_nodes = self.x * self.y
+        bmus = winning_nodes(data=data, weights=self._weights, chunk_size=data.shape[0], njobs=1, verbose=False)
+        sums = np.stack([np.bincount(bmus, weights=data[:, i], minlength=n_nodes)
+                         for i in range(self.input_len)], axis=1)
+        return sums, np.bincount(bmus, minlength=n_nodes).astype(float)
+
+    def _neighborhood_sums(self,
+                           sums: np.array,
+                           counts: np.array,
+                           sigma: float) -> (np.array, np.array):
+        """
+        Neighbourhood weighted sum of events and total neighbourhood weight for each node, given
+        the sum and number of events for which each node is the BMU
+
+        Parameters
+        ----------
+        sums: Numpy.Array
+        counts: Numpy.Array
+        sigma: float
+
+        Returns
+        -------
+        Numpy.Array, Numpy.Array
+        """
+        if self.neighborhood_function == "mexican_hat":
+            active = np.flatnonzero(counts)
+            h = self.neighborhood(bmus=active, sigma=sigma)
+            return h.T @ sums[active], h.T @ counts[active]
+        hx = self._axis_neighborhood(self.x, sigma)
+        hy = self._axis_neighborhood(self.y, sigma)
+        sums = np.einsum("ai,ijd->ajd", hx, sums.reshape(self.x, self.y, self.input_len))
+        sums = np.einsum("bj,ajd->abd", hy, sums).reshape(-1, self.input_len)
+        counts = (hx @ counts.reshape(self.x, self.y) @ hy.T).ravel()
+        return sums, counts
+
+    def train(self,
+              data: np.array,
+              epochs: int = 3,
+              batch_size: int = 500,
+              njobs: int = 1,
+              verbose: bool = True) -> None:
+        """
+        Train the map. Each epoch passes over all events of data once, in a random order, in
+        minibatches of batch_size events; the learning rate and sigma decay after every minibatch.
+
+        Parameters
+        ----------
+        data: Numpy.Array
+        epochs: int (default=3)
+        batch_size: int (default=500)
+            Number of events per weight update
+        njobs: int (default=1)
+            Number of threads each minibatch is split across; -1 will use all available cores
+        verbose: bool (default=True)
+            Show progress bar
+
+        Returns
+        -------
+        None
+        """
+        assert data.shape[1] == self.input_len, f"Received {data.shape[1]} features, expected {self.input_len}"
+        if njobs < 0:
+            njobs = cpu_count()
+        data = np.asarray(data, dtype=float)
+        n_batches = int(np.ceil(data.shape[0] / batch_size))
+        max_iter = epochs * n_batches
+        executor = ThreadPoolExecutor(max_workers=njobs) if njobs > 1 else None
+        try:
+            for epoch in progress_bar(range(epochs), verbose=verbose):
+                order = self._rng.permutation(data.shape[0])
+                for i in range(n_batches):
+                    t = epoch * n_batches + i
+                    learning_rate = _decay(self.learning_rate, t, max_iter, self.decay_function, minimum=0.)
+                    sigma = _decay(self.sigma, t, max_iter, self.decay_function, minimum=1.)
+                    batch = data[order[i * batch_size:(i + 1) * batch_size]]
+                    if executor is None:
+                        sums, counts = self._bmu_sums(data=batch)
+                    else:
+                        blocks = np.array_split(batch, min(njobs, batch.shape[0]))
+                        results = list(executor.map(self._bmu_sums, blocks))
+                        sums = np.sum([r[0] for r in results], axis=0)
+                        counts = np.sum([r[1] for r in results], axis=0)
+                    sums, counts = self._neighborhood_sums(sums=sums, counts=counts, sigma=sigma)
+                    # Nodes outside the neighbourhood of every BMU in this minibatch are not updated
+                    updated = counts > 1e-8
+                    self._weights[updated] += learning_rate * (sums[updated] / counts[updated, None] -
+                                                               self._weights[updated])
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+
 class FlowSOM:
     """
     Python implementation of FlowSOM algorithm, adapted from https://github.com/Hatchin/FlowSOM
@@ -98,7 +467,12 @@ class FlowSOM:
               learning_rate: float = 0.5,
               batch_size: int = 500,
               seed: int = 42,
-              weight_init: str = 'random'):
+              weight_init: str = 'random',
+              engine: str = 'minisom',
+              minibatch_size: int = 500,
+              epochs: int = 3,
+              decay_function: str = 'asymptotic',
+              njobs: int = 1):
 
         """Train self-organising map.
         Parameters
@@ -110,23 +484,45 @@ class FlowSOM:
         learning_rate : float, (default=0.5)
             alters the rate at which weights are updated
         batch_size : int, (default=500)
-            size of batches used in training (alters number of total iterations)
+            total number of (single event) training iterations (MiniSom engine only)
         seed : int, (default=42)
             random seed
         weight_init : str, (default='random')
             how to initialise weights: either 'random' or 'pca' (Initializes the weights to span the
             first two principal components)
+        engine : str, (default='minisom')
+            either 'minisom', to train with MiniSom, or 'native', to train with CytoPy's vectorised
+            minibatch SOM (see SOM); the native engine does not reproduce the weights of MiniSom
+        minibatch_size : int, (default=500)
+            number of events per weight update (native engine only)
+        epochs : int, (default=3)
+            number of passes over the data (native engine only)
+        decay_function : str, (default='asymptotic')
+            decay of learning rate and sigma, either 'asymptotic' or 'linear' (native engine only)
+        njobs : int, (default=1)
+            number of threads used for training; -1 will use all available cores (native engine only)
         Returns
         -------
         None
         """
-
-        som = MiniSom(som_dim[0],
+        if engine == 'native':
+            som = SOM(som_dim[0],
                       som_dim[1],
-                      self.dims, sigma=sigma,
+                      self.dims,
+                      sigma=sigma,
                       learning_rate=learning_rate,
                       neighborhood_function=self.nf,
+                      decay_function=decay_function,
                       random_seed=seed)
+        elif engine == 'minisom':
+            som = MiniSom(som_dim[0],
+                          som_dim[1],
+                          self.dims, sigma=sigma,
+                          learning_rate=learning_rate,
+                          neighborhood_function=self.nf,
+                          random_seed=seed)
+        else:
+            raise ValueError('engine must be one of "native" or "minisom"')
         if weight_init == 'random':
             som.random_weights_init(self.data)
         elif weight_init == 'pca':
@@ -140,7 +536,10 @@ class FlowSOM:
             som.random_weights_init(self.data)
 
         self.print("------------- Training SOM -------------")
-        som.train_batch(self.data, batch_size, verbose=True)  # random training
+        if engine == 'native':
+            som.train(self.data, epochs=epochs, batch_size=minibatch_size, njobs=njobs, verbose=self.verbose)
+        else:
+            som.train_batch(self.data, batch_size, verbose=True)  # random training
         self.xn = som_dim[0]
         self.yn = som_dim[1]
         self.map = som
@@ -154,7 +553,9 @@ class FlowSOM:
                      min_n: int = 5,
                      max_n: int = 50,
                      iter_n: int = 10,
-                     resample_proportion: float = 0.5):
+                     resample_proportion: float = 0.5,
+                     njobs: int = 1,
+                     random_state: int or None = None):
         """Perform meta-clustering. Implementation of Consensus clustering, following the paper
         https://link.springer.com/content/pdf/10.1023%2FA%3A1023949509487.pdf
         Parameters
@@ -170,6 +571,10 @@ class FlowSOM:
             the iteration times for each number of clusters
         resample_proportion : float, (Default value = 0.5)
             within (0, 1), the proportion of re-sampling when computing clustering
+        njobs : int, (Default value = 1)
+            number of threads used to cluster resamples; -1 will use all available cores
+        random_state : int, optional
+            seed for resampling
         Returns
         -------
         None
@@ -182,7 +587,9 @@ class FlowSOM:
                                     max_n,
                                     iter_n,
                                     resample_proportion=resample_proportion,
-                                    verbose=self.verbose)
+                                    verbose=self.verbose,
+                                    njobs=njobs,
+                                    random_state=random_state)
         cluster_.fit(self.flatten_weights)  # fitting SOM weights into clustering algorithm
 
         self.meta_map = cluster_
@@ -192,12 +599,21 @@ class FlowSOM:
         self.meta_flatten = cluster_.predict_data(self.flatten_weights)
         self.meta_class = self.meta_flatten.reshape(self.xn, self.yn)
 
-    def predict(self):
+    def predict(self,
+                chunk_size: int = 10000,
+                njobs: int = 1):
         """
         Predict the cluster allocation for each cell in the associated dataset.
         (Requires that train and meta_cluster have been called previously)
+        Each cell is assigned to its closest SOM node in batches (see winning_nodes)
+        and then given the meta-cluster of that node.
+
         Parameters
         ----------
+        chunk_size: int (default=10000)
+            Number of cells assigned to nodes at a time
+        njobs: int (default=1)
+            Number of threads; -1 will use all available cores
         Returns
         -------
         Numpy.array
@@ -207,12 +623,12 @@ class FlowSOM:
                   'by meta_cluster'
         assert self.map is not None, err_msg
         assert self.meta_class is not None, err_msg
-        labels = []
         self.print('---------- Predicting Labels ----------')
-        for i in progress_bar(range(len(self.data)), verbose=self.verbose):
-            xx = self.data[i, :]  # fetch the sample data
-            winner = self.map.winner(xx)  # make prediction, prediction = the closest entry location in the SOM
-            c = self.meta_class[winner]  # from the location info get cluster info
-            labels.append(c)
+        winners = winning_nodes(data=self.data,
+                                weights=self.flatten_weights,
+                                chunk_size=chunk_size,
+                                njobs=njobs,
+                                verbose=self.verbose)
+        labels = self.meta_flatten[winners]
         self.print('---------------------------------------')
         return labels
@@ -44,6 +44,7 @@ from ..transforms import scaler
 from .consensus import ConsensusCluster
 from .flowsom import FlowSOM
 from multiprocessing import Pool, cpu_count
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.cluster import *
 from sklearn.mixture import *
 from hdbscan import HDBSCAN
@@ -63,11 +64,181 @@ __email__ = "burtonrj@cardiff.ac.uk"
 __status__ = "Production"
 
 
+def _sample_worker(func: callable,
+                   shm_name: str,
+                   shape: tuple,
+                   dtype: np.dtype,
+                   bounds: tuple):
+    """
+    Executed within a worker process; attach to the shared feature matrix, copy the rows
+    of a single sample (given by bounds as start and end row) and call func on them.
+
+    Parameters
+    ----------
+    func: callable
+    shm_name: str
+        Name of the SharedMemory block holding the feature matrix
+    shape: tuple
+    dtype: Numpy.dtype
+    bounds: tuple
+
+    Returns
+    -------
+    object
+        Return value of func
+    """
+    from multiprocessing.shared_memory import SharedMemory
+    shm = SharedMemory(name=shm_name)
+    try:
+        shared = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        x = shared[bounds[0]:bounds[1]].copy()
+        del shared
+    finally:
+        shm.close()
+    return func(x)
+
+
+def _cluster_samples(data: pd.DataFrame,
+                     features: list,
+                     func: callable,
+                     njobs: int = 1,
+                     verbose: bool = True) -> (np.ndarray, dict):
+    """
+    Apply a clustering function to each biological sample (grouped on 'sample_id') independently.
+    The feature space is ordered by sample and, if njobs is not 1, placed in shared memory
+    so that samples are distributed across a pool of processes without pickling each
+    sample's data (on Python versions prior to 3.8, where shared memory is unavailable, each
+    sample is instead pickled to its worker). func should be a picklable callable (i.e. a module level function, or
+    functools.partial of one) that takes a Numpy array and returns a tuple of
+    (labels, additional output).
+
+    Parameters
+    ----------
+    data: Pandas.DataFrame
+    features: list
+        Columns to perform clustering on
+    func: callable
+    njobs: int (default=1)
+        Number of processes; -1 will use all available cores
+    verbose: bool (default=True)
+        If True, provides a progress bar
+
+    Returns
+    -------
+    Numpy.array, dict
+        Cluster labels in the order of rows in data (NaN for rows without a sample_id) and additional
+        output of func for each sample
+    """
+    groups = data.groupby("sample_id").indices
+    sample_ids = list(groups.keys())
+    if len(sample_ids) == 0:
+        return np.full(data.shape[0], np.nan), {}
+    order = np.concatenate([groups[_id] for _id in sample_ids])
+    ends = np.cumsum([len(groups[_id]) for _id in sample_ids])
+    bounds = list(zip(np.concatenate([[0], ends[:-1]]), ends))
+    values = data[features].to_numpy(dtype=float)
+    if njobs < 0:
+        njobs = cpu_count()
+    njobs = min(njobs, len(sample_ids))
+    if njobs <= 1:
+        x = values[order]
+        results = [func(x[start:end]) for start, end in progress_bar(bounds, verbose=verbose)]
+        return _collect_labels(data, order, sample_ids, results)
+    try:
+        from multiprocessing.shared_memory import SharedMemory
+    except ImportError:
+        # Python < 3.8; fall back to pickling each sample to its worker
+        with ProcessPoolExecutor(max_workers=njobs) as executor:
+            results = list(progress_bar(executor.map(func, (values[order[start:end]] for start, end in bounds)),
+                                        verbose=verbose,
+                                        total=len(bounds)))
+        return _collect_labels(data, order, sample_ids, results)
+    shape = (order.shape[0], values.shape[1])
+    shm = SharedMemory(create=True, size=max(int(np.prod(shape)) * values.itemsize, 1))
+    try:
+        np.take(values, order, axis=0, out=np.ndarray(shape, dtype=values.dtype, buffer=shm.buf))
+        worker = partial(_sample_worker, func, shm.name, shape, values.dtype)
+        with ProcessPoolExecutor(max_workers=njobs) as executor:
+            results = list(progress_bar(executor.map(worker, bounds),
+                                        verbose=verbose,
+                                        total=len(bounds)))
+    finally:
+        shm.close()
+        shm.unlink()
+    return _collect_labels(data, order, sample_ids, results)
+
+
+def _collect_labels(data: pd.DataFrame,
+                    order: np.ndarray,
+                    sample_ids: list,
+                    results: list) -> (np.ndarray, dict):
+    """
+    Restore the per-sample results of _cluster_samples to the original row order of data
+
+    Parameters
+    ----------
+    data: Pandas.DataFrame
+    order: Numpy.array
+        Row positions of data ordered by sample
+    sample_ids: list
+    results: list
+        (labels, additional output) for each sample, in the order of sample_ids
+
+    Returns
+    -------
+    Numpy.array, dict
+    """
+    sorted_labels = np.concatenate([labels for labels, _ in results])
+    labels = np.full(data.shape[0], np.nan) if len(order) < data.shape[0] else np.empty_like(sorted_labels)
+    labels[order] = sorted_labels
+    return labels, {_id: output for _id, (_, output) in zip(sample_ids, results)}
+
+
+def _sklearn_labels(x: np.ndarray,
+                    method: str,
+                    **kwargs):
+    """
+    Fit a Scikit-Learn (or alike) model to a single sample; see sklearn_clustering
+
+    Parameters
+    ----------
+    x: Numpy.array
+    method: str
+    kwargs:
+        Additional keyword arguments passed when initialising Scikit-learn model
+
+    Returns
+    -------
+    Numpy.array, None
+    """
+    return globals()[method](**kwargs).fit_predict(x), None
+
+
+def _phenograph_labels(x: np.ndarray,
+                       **kwargs):
+    """
+    Cluster a single sample with PhenoGraph; see phenograph_clustering
+
+    Parameters
+    ----------
+    x: Numpy.array
+    kwargs:
+        Additional keyword arguments passed when calling phenograph.cluster
+
+    Returns
+    -------
+    Numpy.array, (scipy.sparse.base.spmatrix, float)
+    """
+    communities, graph, q = phenograph.cluster(x, **kwargs)
+    return communities, (graph, q)
+
+
 def sklearn_clustering(data: pd.DataFrame,
                        features: list,
                        verbose: bool,
                        method: str,
                        global_clustering: bool = False,
+                       njobs: int = 1,
                        **kwargs):
     """
     Perform high-dimensional clustering of single cell data using
@@ -76,7 +247,8 @@ def sklearn_clustering(data: pd.DataFrame,
     we support HDBSCAN). Clustering is performed either on the entire dataframe
     (if global_clustering is True) or on each biological sample, in which case a
     column should be provided called 'sample_id' which this function will group on
-    and perform clustering in turn. In both cases, the clustering labels are assigned
+    and perform clustering on each sample independently, optionally distributed across
+    a pool of processes (see njobs). In both cases, the clustering labels are assigned
     to a new column named 'cluster_id'.
 
     Parameters
@@ -91,6 +263,9 @@ def sklearn_clustering(data: pd.DataFrame,
     global_clustering: bool (default=False)
         Whether to cluster the whole dataframe or group on 'sample_id' and cluster
         groups
+    njobs: int (default=1)
+        Number of processes used to cluster samples when global_clustering is False;
+        -1 will use all available cores
     kwargs:
         Additional keyword arguments passed when initialising Scikit-learn model
 
@@ -101,12 +276,15 @@ def sklearn_clustering(data: pd.DataFrame,
     """
     assert method in globals().keys(), \
         "Not a recognised method from the Scikit-Learn cluster/mixture modules or HDBSCAN"
-    model = globals()[method](**kwargs)
     if global_clustering:
+        model = globals()[method](**kwargs)
         data["cluster_id"] = model.fit_predict(data[features])
         return data, None, None
-    for _id, df in progress_bar(data.groupby("sample_id"), verbose=verbose):
-        data.loc[df.index, ["cluster_id"]] = model.fit_predict(df[features])
+    data["cluster_id"], _ = _cluster_samples(data=data,
+                                             features=features,
+                                             func=partial(_sklearn_labels, method=method, **kwargs),
+                                             njobs=njobs,
+                                             verbose=verbose)
     return data, None, None
 
 
@@ -114,6 +292,7 @@ def phenograph_clustering(data: pd.DataFrame,
                           features: list,
                           verbose: bool,
                           global_clustering: bool = False,
+                          njobs: int = 1,
                           **kwargs):
     """
     Perform high-dimensional clustering of single cell data using the popular
@@ -121,8 +300,9 @@ def phenograph_clustering(data: pd.DataFrame,
 
     Clustering is performed either on the entire dataframe (if global_clustering is True)
     or on each biological sample, in which case a column should be provided called 'sample_id'
-    which this function will group on and perform clustering in turn. In both cases,
-    the clustering labels are assigned to a new column named 'cluster_id'.
+    which this function will group on and perform clustering on each sample independently,
+    optionally distributed across a pool of processes (see njobs). In both cases, the clustering
+    labels are assigned to a new column named 'cluster_id'.
 
     Parameters
     ----------
@@ -134,6 +314,10 @@ def phenograph_clustering(data: pd.DataFrame,
     global_clustering: bool (default=False)
         Whether to cluster the whole dataframe or group on 'sample_id' and cluster
         groups
+    njobs: int (default=1)
+        Number of processes used to cluster samples when global_clustering is False;
+        -1 will use all available cores. If greater than 1, PhenoGraph is run with n_jobs=1
+        within each process unless n_jobs is given in kwargs
     kwargs:
         Additional keyword arguments passed when calling phenograph.cluster
 
@@ -143,22 +327,21 @@ def phenograph_clustering(data: pd.DataFrame,
         Modified dataframe with clustering IDs assigned to the column 'cluster_id', sparse graph
         matrix, and modularity score for communities (Q)
     """
-    _print = vprint(verbose=verbose)
-    data["cluster_id"] = None
     if global_clustering:
         communities, graph, q = phenograph.cluster(data[features], **kwargs)
         data["cluster_id"] = communities
         return data, graph, q
-    graphs = dict()
-    q = dict()
-    for _id, df in data.groupby("sample_id"):
-        _print(f"----- Clustering {_id} -----")
-        communities, graph, q_ = phenograph.cluster(df[features], **kwargs)
-        graphs[_id], q[_id] = graph, q_
-        df["cluster_id"] = communities
-        data.loc[df.index, ["cluster_id"]] = df.cluster_id
-        _print("-----------------------------")
-        _print("\n")
+    if njobs < 0:
+        njobs = cpu_count()
+    if njobs > 1:
+        kwargs["n_jobs"] = kwargs.get("n_jobs", 1)
+    data["cluster_id"], output = _cluster_samples(data=data,
+                                                  features=features,
+                                                  func=partial(_phenograph_labels, **kwargs),
+                                                  njobs=njobs,
+                                                  verbose=verbose)
+    graphs = {_id: graph for _id, (graph, _) in output.items()}
+    q = {_id: q_ for _id, (_, q_) in output.items()}
     return data, graphs, q
 
 
@@ -183,6 +366,38 @@ def _asign_metalabels(data: pd.DataFrame,
     return pd.merge(data, metadata[["sample_id", "cluster_id", "meta_label"]], on=["sample_id", "cluster_id"])
 
 
+def _affine_normalise(summary: pd.DataFrame,
+                      grouped: pd.core.groupby.DataFrameGroupBy,
+                      norm_method: str):
+    """
+    Normalise a per-group summary (median or mean) as if the data had been scaled
+    within each group prior to summarising. MinMax ('norm') and standard scaling are
+    affine transformations for which the median and mean are equivariant, so only the
+    group statistics are required. Scales close to zero are replaced by 1, as in Scikit-Learn.
+
+    Parameters
+    ----------
+    summary: Pandas.DataFrame
+        Summary of each group, indexed by group
+    grouped: Pandas.DataFrameGroupBy
+        Grouped data the summary was generated from
+    norm_method: str
+        Either 'norm' or 'standard'
+
+    Returns
+    -------
+    Pandas.DataFrame
+    """
+    if norm_method == "norm":
+        loc = grouped.min()
+        scale = grouped.max() - loc
+    else:
+        loc = grouped.mean()
+        scale = grouped.std(ddof=0)
+    scale = scale.where(scale >= 10 * np.finfo(float).eps, 1.)
+    return (summary - loc) / scale
+
+
 def _meta_preprocess(data: pd.DataFrame,
                      features: list,
                      summary_method: str = "median",
@@ -194,7 +409,9 @@ def _meta_preprocess(data: pd.DataFrame,
     and would therefore return the mean of each cluster).
 
     Optionally, data can be normalised prior to applying summary method. To do so provide a
-    valid scaling method (see CytoPy.flow.transform.scaler).
+    valid scaling method (see CytoPy.flow.transform.scaler). Data is normalised within each
+    cluster of each sample; for 'norm' and 'standard' (without additional keyword arguments) the
+    normalisation is applied to the summary directly (see _affine_normalise).
 
     Parameters
     ----------
@@ -214,21 +431,22 @@ def _meta_preprocess(data: pd.DataFrame,
     Pandas.DataFrame
         Summarised dataframe
     """
-    if norm_method is not None:
+    keys = ["sample_id", "cluster_id"]
+    summary_method = "mean" if summary_method == "mean" else "median"
+    if norm_method is not None and (norm_method not in ["norm", "standard"] or kwargs):
         norm_method = partial(scaler, scale_method=norm_method, return_scaler=False, **kwargs)
-        data = (data.groupby(["sample_id", "cluster_id"])[features]
-                .apply(lambda x: pd.DataFrame(norm_method(x), columns=features))
-                .reset_index())
-    summary = list()
-    for _id, df in data.groupby(["sample_id", "cluster_id"]):
-        f = np.median
-        if summary_method == "mean":
-            f = np.mean
-        x = pd.DataFrame(df[features].apply(f, axis=0)).T
-        x["sample_id"] = _id[0]
-        x["cluster_id"] = _id[1]
-        summary.append(x)
-    metadata = pd.concat(summary)
+        x = data[features].to_numpy(dtype=float)
+        for idx in data.groupby(keys).indices.values():
+            x[idx] = norm_method(x[idx])
+        normalised = pd.DataFrame(x, columns=features, index=data.index)
+        normalised[keys] = data[keys].values
+        data = normalised
+        norm_method = None
+    grouped = data.groupby(keys)[features]
+    metadata = grouped.agg(summary_method)
+    if norm_method is not None:
+        metadata = _affine_normalise(metadata, grouped, norm_method)
+    metadata = metadata.reset_index()
     metadata["meta_label"] = None
     return metadata
 
@@ -453,6 +671,47 @@ def _flowsom_clustering(data: pd.DataFrame,
     return cluster
 
 
+def _flowsom_labels(x: np.ndarray,
+                    features: list,
+                    verbose: bool,
+                    meta_cluster_class: object,
+                    init_kwargs: dict or None = None,
+                    training_kwargs: dict or None = None,
+                    meta_cluster_kwargs: dict or None = None,
+                    njobs: int = 1):
+    """
+    Train FlowSOM on a single sample and predict the meta-cluster of each cell;
+    see flowsom_clustering
+
+    Parameters
+    ----------
+    x: Numpy.array
+    features: list
+    verbose: bool
+    meta_cluster_class: object
+    init_kwargs: dict, optional
+    training_kwargs: dict, optional
+    meta_cluster_kwargs: dict, optional
+    njobs: int (default=1)
+        Number of threads used by FlowSOM for training and meta-clustering (unless specified
+        in training_kwargs or meta_cluster_kwargs) and prediction
+
+    Returns
+    -------
+    Numpy.array, None
+    """
+    training_kwargs = {"njobs": njobs, **(training_kwargs or {})}
+    meta_cluster_kwargs = {"njobs": njobs, **(meta_cluster_kwargs or {})}
+    cluster = _flowsom_clustering(data=pd.DataFrame(x, columns=features),
+                                  features=features,
+                                  verbose=verbose,
+                                  meta_cluster_class=meta_cluster_class,
+                                  init_kwargs=init_kwargs,
+                                  training_kwargs=training_kwargs,
+                                  meta_cluster_kwargs=meta_cluster_kwargs)
+    return cluster.predict(njobs=njobs), None
+
+
 def flowsom_clustering(data: pd.DataFrame,
                        features: list,
                        verbose: bool,
@@ -460,7 +719,8 @@ def flowsom_clustering(data: pd.DataFrame,
                        global_clustering: bool = False,
                        init_kwargs: dict or None = None,
                        training_kwargs: dict or None = None,
-                       meta_cluster_kwargs: dict or None = None):
+                       meta_cluster_kwargs: dict or None = None,
+                       njobs: int = 1):
     """
     Perform high-dimensional clustering of single cell data using the popular
     FlowSOM algorithm (https://pubmed.ncbi.nlm.nih.gov/25573116/). For details
@@ -468,8 +728,10 @@ def flowsom_clustering(data: pd.DataFrame,
 
     Clustering is performed either on the entire dataframe (if global_clustering is True)
     or on each biological sample, in which case a column should be provided called 'sample_id'
-    which this function will group on and perform clustering in turn. In both cases,
-    the clustering labels are assigned to a new column named 'cluster_id'.
+    which this function will group on and perform clustering on each sample independently,
+    optionally distributed across a pool of processes (see njobs). In both cases, the clustering
+    labels are assigned to a new column named 'cluster_id'.
+
     Parameters
     ----------
     data: Pandas.DataFrame
@@ -492,6 +754,10 @@ def flowsom_clustering(data: pd.DataFrame,
     meta_cluster_kwargs: dict, optional
         Additional meta_cluster keyword parameters for FlowSOM
         (see CytoPy.flow.clustering.flowsom.FlowSOM.meta_cluster)
+    njobs: int (default=1)
+        Number of processes used to cluster samples when global_clustering is False;
+        -1 will use all available cores. Each sample is trained, meta-clustered and
+        predicted using a single thread (unless specified in training_kwargs or meta_cluster_kwargs)
 
     Returns
     -------
@@ -508,18 +774,20 @@ def flowsom_clustering(data: pd.DataFrame,
                                       meta_cluster_kwargs=meta_cluster_kwargs)
         data["cluster_id"] = cluster.predict()
         return data, None, None
-    vprint_ = vprint(verbose)
-    for _id, df in data.groupby("sample_id"):
-        vprint_(f"----- Clustering {_id} -----")
-        cluster = _flowsom_clustering(data=df,
-                                      features=features,
-                                      verbose=verbose,
-                                      meta_cluster_class=meta_cluster_class,
-                                      init_kwargs=init_kwargs,
-                                      training_kwargs=training_kwargs,
-                                      meta_cluster_kwargs=meta_cluster_kwargs)
-        df["cluster_id"] = cluster.predict()
-        data.loc[df.index, ["cluster_id"]] = df.cluster_id
+    if njobs < 0:
+        njobs = cpu_count()
+    func = partial(_flowsom_labels,
+                   features=features,
+                   verbose=verbose and njobs == 1,
+                   meta_cluster_class=meta_cluster_class,
+                   init_kwargs=init_kwargs,
+                   training_kwargs=training_kwargs,
+                   meta_cluster_kwargs=meta_cluster_kwargs)
+    data["cluster_id"], _ = _cluster_samples(data=data,
+                                             features=features,
+                                             func=func,
+                                             njobs=njobs,
+                                             verbose=verbose)
     return data, None, None
 
 
@@ -1,9 +1,14 @@
 from ..data.gate import PolygonGate, ThresholdGate, EllipseGate, ChildPolygon, ChildThreshold
+from ..data.population import Population
 from ..feedback import vprint, progress_bar
-from sklearn.model_selection import ParameterGrid
+from .sampling import uniform_sample_idx
+from sklearn.model_selection import ParameterGrid, ParameterSampler
 from scipy.spatial.distance import euclidean, cityblock
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from functools import partial
 from warnings import warn
+import copy
 import pandas as pd
 import numpy as np
 
@@ -32,14 +37,8 @@ def common_features(target_signature: dict,
 def signature_distance(method: str,
                        search_space: list,
                        target: ChildPolygon or ChildThreshold):
-    assert hasattr(target, "signature"), "Invalid child populations for manhattan or euclidean dist; " \
-                                         "requires 'signature' attribute"
-    f = {"euclidean": euclidean, "manhattan": cityblock}.get(method, cityblock)
-    idx = np.argmin([f(signature_to_vector(target.signature,
-                                           filter=common_features(target.signature, p.signature)),
-                       signature_to_vector(p.signature,
-                                           filter=common_features(target.signature, p.signature)))
-                     for p in search_space])
+    method = method if method == "euclidean" else "manhattan"
+    idx = np.argmin([population_cost(target=target, population=p, method=method) for p in search_space])
     return search_space[int(idx)]
 
 
@@ -60,6 +59,72 @@ def remove_null_populations(population_grid):
     return updated_grid
 
 
+def population_cost(target: ChildPolygon or ChildThreshold,
+                    population: Population,
+                    method: str) -> float:
+    """
+    Cost of matching a Population to a Child of a Gate using the defined method; see
+    hyperparameter_gate for valid methods.
+
+    Parameters
+    ----------
+    target: ChildThreshold or ChildPolygon
+        Child population definition
+    population: Population
+    method: str
+
+    Returns
+    -------
+    float
+    """
+    if method in ["euclidean", "manhattan"]:
+        assert hasattr(target, "signature"), "Invalid child populations for manhattan or euclidean dist; " \
+                                             "requires 'signature' attribute"
+        f = {"euclidean": euclidean, "manhattan": cityblock}.get(method)
+        features = common_features(target.signature, population.signature)
+        return f(signature_to_vector(target.signature, filter=features),
+                 signature_to_vector(population.signature, filter=features))
+    if method == "threshold_dist":
+        if target.geom.y_threshold:
+            return (abs(target.geom.x_threshold - population.geom.x_threshold) +
+                    abs(target.geom.y_threshold - population.geom.y_threshold))
+        return abs(target.geom.x_threshold - population.geom.x_threshold)
+    if method == "hausdorff":
+        return target.geom.shape.hausdorff_distance(population.geom.shape)
+    raise ValueError("Unrecognised cost metrix; should be either euclidean, manhattan, threshold_dict "
+                     "or hausdorff")
+
+
+def grid_point_cost(gate: PolygonGate or ThresholdGate or EllipseGate,
+                    populations: list,
+                    method: str) -> float:
+    """
+    Total cost of the Populations generated under one set of hyperparameter conditions; the
+    sum, over the children of the gate, of the cost of the best matching Population. Returns
+    infinity if any child is unmatched.
+
+    Parameters
+    ----------
+    gate: PolygonGate or ThresholdGate or EllipseGate
+    populations: list
+        Populations generated from the fitted gate under one set of hyperparameter conditions
+    method: str
+
+    Returns
+    -------
+    float
+    """
+    populations = [p for p in populations if p.n >= 3]
+    total = 0.
+    for child in gate.children:
+        costs = [population_cost(target=child, population=p, method=method)
+                 for p in populations if p.population_name == child.name]
+        if len(costs) == 0:
+            return np.inf
+        total += min(costs)
+    return total
+
+
 def cost_func(target: ChildPolygon or ChildThreshold,
               populations: list,
               method: str):
@@ -88,23 +153,9 @@ def cost_func(target: ChildPolygon or ChildThreshold,
     if len(search_space) == 0:
         warn(f"No populations generated for target population {target.name}")
         return None
-    if method in ["euclidean", "manhattan"]:
-        return signature_distance(method=method, search_space=search_space, target=target)
-    if method == "threshold_dist":
-        if target.geom.y_threshold:
-            idx = np.argmin([abs(target.geom.x_threshold - p.geom.x_threshold) +
-                             abs(target.geom.y_threshold - p.geom.y_threshold)
-                             for p in search_space])
-            return search_space[int(idx)]
-        idx = np.argmin([abs(target.geom.x_threshold - p.geom.x_threshold)
-                         for p in search_space])
-        return search_space[int(idx)]
-    if method == "hausdorff":
-        idx = np.argmin([target.geom.shape.hausdorff_distance(p.geom.shape)
-                         for p in search_space])
-        return search_space[int(idx)]
-    raise ValueError("Unrecognised cost metrix; should be either euclidean, manhattan, threshold_dict "
-                     "or hausdorff")
+    idx = np.argmin([population_cost(target=target, population=p, method=method)
+                     for p in search_space])
+    return search_space[int(idx)]
 
 
 def fit_gate(updated_params: dict,
@@ -160,17 +211,124 @@ def optimal_populations(population_grid: list,
     return list(map(f, gate.children))
 
 
+def fit_grid(gate: PolygonGate or ThresholdGate or EllipseGate,
+             grid: list,
+             data: pd.DataFrame,
+             njobs: int = 1,
+             verbose: bool = True) -> list:
+    """
+    Fit the gate to the given data under each set of hyperparameters in grid, returning
+    the resulting Populations in the order of the grid. If njobs is not 1, grid points are
+    fitted in a pool of threads, each fitting its own copy of the gate, with the data
+    shared (read-only) between threads.
+
+    Parameters
+    ----------
+    gate: PolygonGate or ThresholdGate or EllipseGate
+    grid: list
+        List of parameter dictionaries
+    data: Pandas.DataFrame
+    njobs: int (default=1)
+        Number of threads; -1 will use all available cores
+    verbose: bool (default=True)
+        Show a progress bar
+
+    Returns
+    -------
+    List
+        List of nested lists, each containing the populations generated from the fitted gate
+        under one set of hyperparameter conditions
+    """
+    if njobs < 0:
+        njobs = cpu_count()
+    if njobs == 1:
+        fitter = partial(fit_gate, gate=gate, data=data)
+        return [fitter(params) for params in progress_bar(grid, verbose=verbose, total=len(grid))]
+
+    def fitter(params: dict) -> list:
+        return fit_gate(updated_params=params, gate=copy.deepcopy(gate), data=data)
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        return list(progress_bar(executor.map(fitter, grid), verbose=verbose, total=len(grid)))
+
+
+def successive_halving(gate: PolygonGate or ThresholdGate or EllipseGate,
+                       grid: list,
+                       cost: str,
+                       parent: pd.DataFrame,
+                       factor: int = 3,
+                       min_events: int = 1000,
+                       njobs: int = 1,
+                       random_state: int or np.random.Generator or None = None,
+                       verbose: bool = True) -> list:
+    """
+    Successive halving search of a hyperparameter grid. Every candidate is fitted to a
+    uniform sample of the parent data and scored by the given cost (see grid_point_cost);
+    the best 1/factor candidates are kept and refitted to a sample 'factor' times larger.
+    This is repeated until a single candidate remains or the sample would exceed the parent
+    data, at which point the remaining candidates are fitted to the full parent data.
+
+    Parameters
+    ----------
+    gate: PolygonGate or ThresholdGate or EllipseGate
+    grid: list
+        List of parameter dictionaries
+    cost: str
+        Method used to score candidates; see hyperparameter_gate
+    parent: Pandas.DataFrame
+    factor: int (default=3)
+        Proportion of candidates discarded, and growth of the sample, each round
+    min_events: int (default=1000)
+        Minimum number of events in the sample of the first round
+    njobs: int (default=1)
+        Number of threads; -1 will use all available cores
+    random_state: int or Numpy.random.Generator, optional
+        Seed or Generator for sampling of the parent data
+    verbose: bool (default=True)
+
+    Returns
+    -------
+    List
+        Populations generated on the full parent data by the remaining candidates, see fit_grid
+    """
+    assert factor > 1, "factor must be greater than 1"
+    feedback = vprint(verbose)
+    rng = np.random.default_rng(random_state)
+    n_events = parent.shape[0]
+    n_rounds = int(np.ceil(np.log(len(grid)) / np.log(factor))) if len(grid) > 1 else 0
+    sample_size = max(min_events, n_events // factor ** n_rounds)
+    while len(grid) > 1 and sample_size < n_events:
+        feedback(f"Scoring {len(grid)} candidates on {sample_size} events...")
+        sample = parent.iloc[uniform_sample_idx(n_events=n_events, sample_size=sample_size, random_state=rng)]
+        scores = [grid_point_cost(gate=gate, populations=pops, method=cost)
+                  for pops in fit_grid(gate=gate, grid=grid, data=sample, njobs=njobs, verbose=verbose)]
+        keep = np.argsort(scores, kind="stable")[:int(np.ceil(len(grid) / factor))]
+        grid = [grid[i] for i in keep]
+        sample_size *= factor
+    feedback(f"Fitting {len(grid)} candidates to {n_events} events...")
+    return fit_grid(gate=gate, grid=grid, data=parent, njobs=njobs, verbose=verbose)
+
+
 def hyperparameter_gate(gate: ThresholdGate or PolygonGate or EllipseGate,
                         grid: dict,
                         cost: str,
                         parent: pd.DataFrame,
-                        verbose: bool = True) -> list:
+                        verbose: bool = True,
+                        njobs: int = 1,
+                        search: str = "grid",
+                        n_iter: int = 10,
+                        factor: int = 3,
+                        min_events: int = 1000,
+                        random_state: int or None = None) -> list:
     """
     Fit a Gate to some parent data whilst searching the hyperparameter space (grid)
     for the optimal 'fit' as defined by minimising some cost (e.g. the distance between the
-    originally defined gate and the newly generated gate). Populations from all possible
-    combinations of hyperparameters will be generated and then populations matched
-    according to the minimal cost.
+    originally defined gate and the newly generated gate). Populations from the combinations
+    of hyperparameters searched will be generated and then populations matched according to the
+    minimal cost. The search strategy is one of:
+        * "grid" (default): every combination of hyperparameters is fitted to the parent data
+        * "random": n_iter combinations are sampled from the grid and fitted to the parent data
+        * "halving": successive halving; all combinations are scored on a sample of the parent data
+          and only the best are refitted on progressively larger samples (see successive_halving)
 
     Parameters
     ----------
@@ -204,6 +362,20 @@ def hyperparameter_gate(gate: ThresholdGate or PolygonGate or EllipseGate,
         Parent data that the gate is 'fitted' too
     verbose: bool (default=True)
         Whether to provide feedback to stdout
+    njobs: int (default=1)
+        Number of threads used to fit the gate across the parameter grid; -1 will use all
+        available cores. Each thread fits its own copy of the gate and the parent data is
+        shared (read-only) between threads. Populations are collected in the order of the grid.
+    search: str (default="grid")
+        Search strategy; one of "grid", "random" or "halving"
+    n_iter: int (default=10)
+        Number of combinations sampled for random search
+    factor: int (default=3)
+        For successive halving, proportion of candidates discarded each round
+    min_events: int (default=1000)
+        For successive halving, minimum number of events in the first round
+    random_state: int (optional)
+        Seed for random search and successive halving
 
     Returns
     -------
@@ -215,14 +387,27 @@ def hyperparameter_gate(gate: ThresholdGate or PolygonGate or EllipseGate,
     original_kwargs = gate.method_kwargs.copy()
     grid = grid.copy()
 
-    grid = ParameterGrid(grid)
+    if search in ["grid", "halving"]:
+        grid = list(ParameterGrid(grid))
+    elif search == "random":
+        grid = list(ParameterSampler(grid, n_iter=n_iter, random_state=random_state))
+    else:
+        raise ValueError("Invalid search strategy, should be one of: 'grid', 'random' or 'halving'")
     feedback(f"Grid space: {len(grid)}")
 
-    fitter = partial(fit_gate, gate=gate, data=parent)
     feedback("Fitting gates across parameter grid...")
-    populations = list()
-    for params in progress_bar(grid, verbose=verbose, total=len(grid)):
-        populations.append(fitter(params))
+    if search == "halving":
+        populations = successive_halving(gate=gate,
+                                         grid=grid,
+                                         cost=cost,
+                                         parent=parent,
+                                         factor=factor,
+                                         min_events=min_events,
+                                         njobs=njobs,
+                                         random_state=random_state,
+                                         verbose=verbose)
+    else:
+        populations = fit_grid(gate=gate, grid=grid, data=parent, njobs=njobs, verbose=verbose)
     feedback("Matching optimal populations...")
     populations = remove_null_populations(population_grid=populations)
     pops = optimal_populations(population_grid=populations,
@@ -32,8 +32,8 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 from .neighbours import calculate_optimal_neighbours, knn
 from ..feedback import vprint
 from sklearn.neighbors import BallTree, KDTree
-from multiprocessing import Pool, cpu_count
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from warnings import warn
 import pandas as pd
 import numpy as np
@@ -48,13 +48,80 @@ __email__ = "burtonrj@cardiff.ac.uk"
 __status__ = "Production"
 
 
+def _rng(random_state: int or np.random.Generator or None = None) -> np.random.Generator:
+    """
+    Returns a Numpy random Generator; if random_state is already a Generator it is returned unchanged,
+    otherwise it is used as a seed.
+
+    Parameters
+    ----------
+    random_state: int or Numpy.random.Generator, optional
+
+    Returns
+    -------
+    Numpy.random.Generator
+    """
+    return np.random.default_rng(random_state)
+
+
+def _sample_size(n_events: int,
+                 sample_size: int or float) -> int:
+    """
+    Convert the requested sample size to a number of events; if a float is given it is
+    treated as the proportion of n_events.
+
+    Parameters
+    ----------
+    n_events: int
+    sample_size: int or float
+
+    Returns
+    -------
+    int
+    """
+    if isinstance(sample_size, int):
+        return sample_size
+    if isinstance(sample_size, float):
+        return int(round(n_events * sample_size))
+    raise ValueError("sample_size should be an int or float value")
+
+
+def uniform_sample_idx(n_events: int,
+                       sample_size: int or float,
+                       random_state: int or np.random.Generator or None = None) -> np.array:
+    """
+    Uniform downsampling returning the sorted row positions of the sample, such that
+    a DataFrame can be sliced with DataFrame.iloc and the same sample reused.
+
+    Parameters
+    ----------
+    n_events: int
+        Number of events (rows) to sample from
+    sample_size: int or float
+        Size of sample required. If a float is given will return a sample
+        of this proportion.
+    random_state: int or Numpy.random.Generator, optional
+        Seed or Generator for reproducible sampling
+
+    Returns
+    -------
+    Numpy.Array
+    """
+    n = _sample_size(n_events=n_events, sample_size=sample_size)
+    if n >= n_events:
+        if isinstance(sample_size, int):
+            warn(f"Number of observations larger than requested sample size {sample_size}, "
+                 f"returning complete data (n={n_events})")
+        return np.arange(n_events)
+    return np.sort(_rng(random_state).choice(n_events, size=n, replace=False))
+
+
 def uniform_downsampling(data: pd.DataFrame,
                          sample_size: int or float,
-                         **kwargs):
+                         random_state: int or np.random.Generator or None = None):
     """
-    Uniform downsampling. Wraps the Pandas DataFrame sample method
-    with some additional error handling for when the requested sample
-    size is invalid.
+    Uniform downsampling with some additional error handling for when the requested
+    sample size is invalid. See uniform_sample_idx.
 
     Parameters
     ----------
@@ -62,60 +129,112 @@ def uniform_downsampling(data: pd.DataFrame,
     sample_size: int or float
         Size of sample required. If a float is given will return a sample
         of this proportion.
-    kwargs:
-        Additional keyword arguments passed to Pandas.DataFrame.sample
+    random_state: int or Numpy.random.Generator, optional
+        Seed or Generator for reproducible sampling
 
     Returns
     -------
     Pandas.DataFrame
     """
-    if isinstance(sample_size, int):
-        if sample_size >= data.shape[0]:
-            warn(f"Number of observations larger than requested sample size {sample_size}, "
-                 f"returning complete data (n={data.shape[0]})")
-            return data
-        return data.sample(n=sample_size, **kwargs)
-    if isinstance(sample_size, float):
-        return data.sample(frac=sample_size, **kwargs)
-    raise ValueError("sample_size should be an int or float value")
+    idx = uniform_sample_idx(n_events=data.shape[0], sample_size=sample_size, random_state=random_state)
+    if idx.shape[0] == data.shape[0]:
+        return data
+    return data.iloc[idx]
 
 
 def faithful_downsampling(data: np.array,
-                          h: float):
+                          h: float,
+                          batch_size: int = 10000,
+                          random_state: int or np.random.Generator or None = None) -> np.array:
     """
     An implementation of faithful downsampling as described in:  Zare H, Shooshtari P, Gupta A, Brinkman R.
     Data reduction for spectral clustering to analyze high throughput flow cytometry data.
     BMC Bioinformatics 2010;11:403
 
+    Events are visited in random order; an event that has not yet been registered becomes
+    a representative and registers all events within radius h of itself. Radius queries
+    are performed in batches of unregistered events. The row positions of the
+    representatives are returned, such that the sample can be taken with
+    DataFrame.iloc and the original row index is retained.
+
     Parameters
     -----------
     data: Numpy.array
         numpy array to be down-sampled
     h: float
         radius for nearest neighbours search
+    batch_size: int (default=10000)
+        Number of events per batch of radius queries
+    random_state: int or Numpy.random.Generator, optional
+        Seed or Generator for reproducible sampling
 
     Returns
     --------
     Numpy.array
-        Down-sampled array
+        Sorted row positions of sampled events
     """
-    communities = None
-    registered = np.zeros(data.shape[0])
+    data = np.asarray(data)
+    registered = np.zeros(data.shape[0], dtype=bool)
+    representatives = list()
     tree = BallTree(data)
-    while not all([x == 1 for x in registered]):
-        i_ = np.random.choice(np.where(registered == 0)[0])
-        registered[i_] = 1
-        registering_idx = tree.query_radius(data[i_].reshape(1, -1), r=h)[0]
-        registering_idx = [t for t in registering_idx if t != i_]
-        registered[registering_idx] = 1
-        if communities is None:
-            communities = data[registering_idx]
-        else:
-            communities = np.unique(np.concatenate((communities, data[registering_idx]), 0), axis=0)
-    return communities
-
-
-def prob_downsample(local_d: int,
+    order = _rng(random_state).permutation(data.shape[0])
+    for start in range(0, order.shape[0], batch_size):
+        candidates = order[start:start + batch_size]
+        candidates = candidates[~registered[candidates]]
+        if candidates.shape[0] == 0:
+            continue
+        neighbours = tree.query_radius(data[candidates], r=h)
+        for i, registering_idx in zip(candidates, neighbours):
+            if registered[i]:
+                continue
+            representatives.append(i)
+            registered[registering_idx] = True
+    return np.sort(np.array(representatives, dtype=int))
+
+
+def sample_idx(data: pd.DataFrame,
+               method: str,
+               features: list or None = None,
+               random_state: int or np.random.Generator or None = None,
+               **kwargs) -> np.array:
+    """
+    Unified interface for downsampling that returns the sorted row positions of the sample
+    rather than a copy of the data. The sample can be taken with DataFrame.iloc, retaining
+    the original row index, and reused across calls.
+
+    Parameters
+    ----------
+    data: Pandas.DataFrame
+    method: str
+        One of 'uniform', 'density' or 'faithful'
+    features: list (defaults to all columns)
+        Name of columns to be used as features in down-sampling algorithm (ignored for uniform sampling)
+    random_state: int or Numpy.random.Generator, optional
+        Seed or Generator for reproducible sampling
+    kwargs:
+        Additional keyword arguments passed to uniform_sample_idx (e.g. sample_size),
+        density_sample_idx or faithful_downsampling (e.g. h)
+
+    Returns
+    -------
+    Numpy.Array
+
+    Raises
+    ------
+    ValueError
+        Invalid method
+    """
+    if method == "uniform":
+        return uniform_sample_idx(n_events=data.shape[0], random_state=random_state, **kwargs)
+    if method == "density":
+        return density_sample_idx(data=data, features=features, random_state=random_state, **kwargs)
+    if method == "faithful":
+        features = features or data.columns.tolist()
+        return faithful_downsampling(data=data[features].values, random_state=random_state, **kwargs)
+    raise ValueError("Invalid downsample method, should be one of: 'uniform', 'density' or 'faithful'")
+
+
+def prob_downsample(local_d: int or np.array,
                     target_d: int,
                     outlier_d: int):
     """
@@ -126,25 +245,135 @@ def prob_downsample(local_d: int,
     but less than the target density, return a value of 1 (absolutely keep this
     event). If the local density is greater than the target density, then
     the probability of retention is the ratio between the target and local
-    density.
+    density. An array of local densities can be given, in which case an array
+    of probabilities is returned.
 
     Parameters
     ----------
-    local_d: int
+    local_d: int or Numpy.Array
     target_d: int
     outlier_d: int
 
     Returns
     -------
-    float
-        Value between 0 and 1
+    float or Numpy.Array
+        Value(s) between 0 and 1
+    """
+    local_d = np.asarray(local_d, dtype=np.float64)
+    ratio = np.divide(target_d, local_d, out=np.ones_like(local_d), where=local_d > target_d)
+    prob = np.select([local_d <= outlier_d, local_d <= target_d], [0., 1.], default=ratio)
+    if prob.ndim == 0:
+        return float(prob)
+    return prob
+
+
+def _threaded_query(func: callable,
+                    data: np.array,
+                    njobs: int = -1,
+                    chunk_size: int = 50000) -> np.array:
     """
-    if local_d <= outlier_d:
-        return 0
-    if outlier_d < local_d <= target_d:
-        return 1
-    if local_d > target_d:
-        return target_d / local_d
+    Apply func (e.g. a KDTree query) to data in chunks of rows, distributing chunks
+    across a pool of threads, and concatenate the results. Scikit-Learn's tree queries
+    release the GIL, so threads avoid the cost of pickling data to worker processes.
+
+    Parameters
+    ----------
+    func: callable
+        Function that takes a two dimensional array and returns an array with one
+        element (or row) per row of input
+    data: Numpy.Array
+    njobs: int (default=-1)
+        Number of threads; -1 will use all available cores
+    chunk_size: int (default=50000)
+        Number of rows per chunk
+
+    Returns
+    -------
+    Numpy.Array
+    """
+    if njobs < 0:
+        njobs = cpu_count()
+    chunks = [data[i:i + chunk_size] for i in range(0, data.shape[0], chunk_size)]
+    if njobs == 1 or len(chunks) <= 1:
+        results = [func(c) for c in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=njobs) as executor:
+            results = list(executor.map(func, chunks))
+    return np.concatenate(results)
+
+
+def density_sample_idx(data: pd.DataFrame,
+                       features: list or None = None,
+                       sample_size: int or float = 0.1,
+                       alpha: int = 5,
+                       distance_metric: str = "manhattan",
+                       tree_sample: float or int = 0.1,
+                       outlier_dens: int = 1,
+                       target_dens: int = 5,
+                       njobs: int = -1,
+                       random_state: int or np.random.Generator or None = None) -> np.array:
+    """
+    Perform density dependent down-sampling to remove risk of under-sampling rare populations;
+    adapted from SPADE*. Returns the sorted row positions of the sample, such that a DataFrame
+    can be sliced with DataFrame.iloc and the same sample reused.
+
+    * Extracting a cellular hierarchy from high-dimensional cytometry data with SPADE
+    Peng Qiu-Erin Simonds-Sean Bendall-Kenneth Gibbs-Robert
+    Bruggner-Michael Linderman-Karen Sachs-Garry Nolan-Sylvia Plevritis - Nature Biotechnology - 2011
+
+    Parameters
+    -----------
+    data: Pandas.DataFrame
+        Data to sample
+    features: list (defaults to all columns)
+        Name of columns to be used as features in down-sampling algorithm
+    sample_size: int or float (default=0.1)
+        number of events to return in sample, either as an integer of fraction of original
+        sample size
+    alpha: int, (default=5)
+        used for estimating distance threshold between cell and nearest neighbour (default = 5 used in
+        original paper)
+    distance_metric: str (default="manhattan")
+        Metric used for neighbour assignment
+    tree_sample: float or int, (default=0.1)
+        proportion/number of cells to sample for generation of KD tree
+    outlier_dens: float, (default=1)
+        used to exclude cells with the lowest local densities; int value as a percentile of the
+        lowest local densities e.g. 1 (the default value) means the bottom 1% of cells with lowest local densities
+        are regarded as noise
+    target_dens: float, (default=5)
+        determines how many cells will survive the down-sampling process; int value as a
+        percentile of the lowest local densities e.g. 5 (the default value) means the density of bottom 5% of cells
+        will serve as the density threshold for rare cell populations
+    njobs: int (default=-1)
+        Number of jobs to run in unison when calculating weights (defaults to all available cores)
+    random_state: int or Numpy.random.Generator, optional
+        Seed or Generator for reproducible sampling
+    Returns
+    -------
+    Numpy.Array
+    """
+    n_events = data.shape[0]
+    if isinstance(sample_size, int) and sample_size >= n_events:
+        warn("Requested sample size >= size of dataframe")
+        return np.arange(n_events)
+    rng = _rng(random_state)
+    features = features or data.columns.tolist()
+    x = data[features].values
+    tree_idx = uniform_sample_idx(n_events=n_events, sample_size=tree_sample, random_state=rng)
+    prob = density_probability_assignment(sample=x[tree_idx],
+                                          data=x,
+                                          distance_metric=distance_metric,
+                                          alpha=alpha,
+                                          outlier_dens=outlier_dens,
+                                          target_dens=target_dens,
+                                          njobs=njobs)
+    if prob.sum() == 0:
+        warn('Error: density dependendent downsampling failed; weights sum to zero. '
+             'Defaulting to uniform sampling')
+        return uniform_sample_idx(n_events=n_events, sample_size=sample_size, random_state=rng)
+    n = _sample_size(n_events=n_events, sample_size=sample_size)
+    return np.sort(rng.choice(n_events, size=n, replace=False, p=prob / prob.sum()))
 
 
 def density_dependent_downsampling(data: pd.DataFrame,
@@ -155,10 +384,11 @@ def density_dependent_downsampling(data: pd.DataFrame,
                                    tree_sample: float or int = 0.1,
                                    outlier_dens: int = 1,
                                    target_dens: int = 5,
-                                   njobs: int = -1):
+                                   njobs: int = -1,
+                                   random_state: int or np.random.Generator or None = None):
     """
     Perform density dependent down-sampling to remove risk of under-sampling rare populations;
-    adapted from SPADE*
+    adapted from SPADE*. See density_sample_idx.
 
     * Extracting a cellular hierarchy from high-dimensional cytometry data with SPADE
     Peng Qiu-Erin Simonds-Sean Bendall-Kenneth Gibbs-Robert
@@ -190,31 +420,26 @@ def density_dependent_downsampling(data: pd.DataFrame,
         will serve as the density threshold for rare cell populations
     njobs: int (default=-1)
         Number of jobs to run in unison when calculating weights (defaults to all available cores)
+    random_state: int or Numpy.random.Generator, optional
+        Seed or Generator for reproducible sampling
     Returns
     -------
     Pandas.DataFrame
         Down-sampled pandas dataframe
     """
-    if isinstance(sample_size, int) and sample_size >= data.shape[0]:
-        warn("Requested sample size >= size of dataframe")
+    idx = density_sample_idx(data=data,
+                             features=features,
+                             sample_size=sample_size,
+                             alpha=alpha,
+                             distance_metric=distance_metric,
+                             tree_sample=tree_sample,
+                             outlier_dens=outlier_dens,
+                             target_dens=target_dens,
+                             njobs=njobs,
+                             random_state=random_state)
+    if idx.shape[0] == data.shape[0]:
         return data
-    df = data.copy()
-    features = features or df.columns.tolist()
-    tree_sample = uniform_downsampling(data=df, sample_size=tree_sample)
-    prob = density_probability_assignment(sample=tree_sample[features],
-                                          data=df[features],
-                                          distance_metric=distance_metric,
-                                          alpha=alpha,
-                                          outlier_dens=outlier_dens,
-                                          target_dens=target_dens,
-                                          njobs=njobs)
-    if sum(prob) == 0:
-        warn('Error: density dependendent downsampling failed; weights sum to zero. '
-             'Defaulting to uniform sampling')
-        return uniform_downsampling(data=data, sample_size=sample_size)
-    if isinstance(sample_size, int):
-        return df.sample(n=sample_size, weights=prob)
-    return df.sample(frac=sample_size, weights=prob)
+    return data.iloc[idx]
 
 
 def density_probability_assignment(sample: pd.DataFrame,
@@ -223,7 +448,8 @@ def density_probability_assignment(sample: pd.DataFrame,
                                    alpha: int = 5,
                                    outlier_dens: int = 1,
                                    target_dens: int = 5,
-                                   njobs: int = -1):
+                                   njobs: int = -1,
+                                   chunk_size: int = 50000):
     """
     Generate an estimation of local density amongst single cell population
     using the KDTree algorithm from Scikit-Learn. Using this representation
@@ -255,26 +481,25 @@ def density_probability_assignment(sample: pd.DataFrame,
         means the density of bottom 5% of cells will serve as the density threshold
         for rare cell populations
     njobs: int (default=-1)
-        Controls how many parallel processed to run in KDTree search. Default is -1, which
+        Controls how many threads to run in KDTree search. Default is -1, which
         will use all available cores.
+    chunk_size: int (default=50000)
+        Number of events per chunk of the KDTree search
 
     Returns
     -------
     Numpy.Array
     """
-    if njobs < 0:
-        njobs = cpu_count()
+    data = np.asarray(data)
     tree = KDTree(sample, metric=distance_metric)
-    dist, _ = tree.query(data, k=2)
-    dist = np.median([x[1] for x in dist])
-    dist_threshold = dist * alpha
-    ld = tree.query_radius(data, r=dist_threshold, count_only=True)
+    dist = _threaded_query(lambda x: tree.query(x, k=2)[0][:, 1],
+                           data=data, njobs=njobs, chunk_size=chunk_size)
+    dist_threshold = np.median(dist) * alpha
+    ld = _threaded_query(lambda x: tree.query_radius(x, r=dist_threshold, count_only=True),
+                         data=data, njobs=njobs, chunk_size=chunk_size)
     od = np.percentile(ld, q=outlier_dens)
     td = np.percentile(ld, q=target_dens)
-    prob_f = partial(prob_downsample, target_d=td, outlier_d=od)
-    with Pool(njobs) as pool:
-        prob = np.array(list(pool.map(prob_f, ld)))
-    return np.array(prob)
+    return prob_downsample(ld, target_d=td, outlier_d=od)
 
 
 def upsample_density(data: pd.DataFrame,
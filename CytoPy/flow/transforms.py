@@ -43,6 +43,10 @@ __maintainer__ = "Ross Burton"
 __email__ = "burtonrj@cardiff.ac.uk"
 __status__ = "Production"
 
+# Transforms that act on each value independently, such that the result for an event does not
+# depend on the other events transformed alongside it
+ELEMENTWISE_TRANSFORMS = ["logicle", "hyperlog", "log_transform", "asinh"]
+
 
 def percentile_rank_transform(data: pd.DataFrame, 
                               features_to_transform: list) -> pd.DataFrame:
@@ -35,7 +35,7 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 from ..data.experiment import Experiment, FileGroup
 from ..feedback import progress_bar, vprint
 from .dim_reduction import dimensionality_reduction
-from .sampling import density_dependent_downsampling, faithful_downsampling, uniform_downsampling
+from .sampling import density_dependent_downsampling, faithful_downsampling
 from .transforms import scaler
 from sklearn.model_selection import GridSearchCV
 from sklearn.neighbors import KernelDensity
@@ -44,6 +44,9 @@ from scipy.stats import entropy as kl
 from scipy.cluster import hierarchy
 from scipy.spatial import distance
 from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from typing import List
 from KDEpy import FFTKDE
 from warnings import warn
 import matplotlib.pyplot as plt
@@ -187,15 +190,48 @@ def scale_data(data: OrderedDict,
     return scaled
 
 
+def _map_samples(func: callable,
+                 items: list,
+                 njobs: int = 1,
+                 verbose: bool = True) -> list:
+    """
+    Apply func to each item, distributing across a pool of threads if njobs is not 1.
+    Results are returned in the order of the items given.
+
+    Parameters
+    ----------
+    func: callable
+    items: list
+    njobs: int (default=1)
+        Number of threads; -1 will use all available cores
+    verbose: bool (default=True)
+        If True, show a progress bar
+
+    Returns
+    -------
+    list
+    """
+    if njobs < 0:
+        njobs = cpu_count()
+    if njobs == 1:
+        return [func(x) for x in progress_bar(items, verbose=verbose)]
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        return list(progress_bar(executor.map(func, items), verbose=verbose, total=len(items)))
+
+
 def load_and_sample(experiment: Experiment,
                     population: str,
                     sample_size: int or float,
                     sample_ids: list or None = None,
                     sampling_method: str or None = "uniform",
                     transform: str or None = "logicle",
+                    load_njobs: int = 1,
+                    random_state: int or None = None,
                     **kwargs) -> OrderedDict:
     """
     Load sample data from experiment and return as a dictionary of Pandas DataFrames.
+    Samples can be loaded in parallel (see load_njobs). For uniform sampling only the
+    sampled events of each file are read from disk (see FileGroup.load_population_sample).
 
     Parameters
     ----------
@@ -206,6 +242,11 @@ def load_and_sample(experiment: Experiment,
     sampling_method: str
     transform: str (optional)
     population: str
+    load_njobs: int (default=1)
+        Number of samples to load in parallel; -1 will use all available cores
+    random_state: int (optional)
+        Seed for reproducible sampling; each sample is given an independent random
+        stream derived from this seed
     kwargs:
         Additional keyword arguments for sampling method
 
@@ -213,17 +254,80 @@ def load_and_sample(experiment: Experiment,
     -------
     OrderedDict
     """
-    sample_ids = sample_ids or experiment.list_samples()
-    files = [experiment.get_sample(s) for s in sample_ids]
-    data = OrderedDict()
-    for f in progress_bar(files, verbose=True):
-        data[f.primary_id] = _sample_filegroup(filegroup=f,
-                                               sample_size=sample_size,
-                                               sampling_method=sampling_method,
-                                               transform=transform,
-                                               population=population,
-                                               **kwargs)
-    return data
+    sample_ids = sample_ids or list(experiment.list_samples())
+    seeds = np.random.SeedSequence(random_state).spawn(len(sample_ids))
+
+    def load(x: tuple) -> pd.DataFrame:
+        sample_id, seed = x
+        return _sample_filegroup(filegroup=experiment.get_sample(sample_id),
+                                 sample_size=sample_size,
+                                 sampling_method=sampling_method,
+                                 transform=transform,
+                                 population=population,
+                                 random_state=np.random.default_rng(seed),
+                                 **kwargs)
+
+    data = _map_samples(load, list(zip(sample_ids, seeds)), njobs=load_njobs)
+    return OrderedDict(zip(sample_ids, data))
+
+
+def stratified_sample(experiment: Experiment,
+                      populations: List[str],
+                      sample_size: int or float,
+                      sample_ids: list or None = None,
+                      transform: str or dict or None = "logicle",
+                      load_njobs: int = 1,
+                      random_state: int or None = None,
+                      verbose: bool = True) -> pd.DataFrame:
+    """
+    Uniformly sample events from each of the given populations of each sample in an
+    experiment, such that every (sample, population) stratum is represented by
+    sample_size events (or all of its events if smaller). Only the sampled events
+    are read from disk (see FileGroup.load_population_sample) and samples can be loaded
+    in parallel (see load_njobs).
+
+    Parameters
+    ----------
+    experiment: Experiment
+    populations: list
+        Populations to sample from; must be present in every sample
+    sample_size: int or float
+        Number of events to sample per population per sample, or if a float is given,
+        the proportion of each population
+    sample_ids: list (optional)
+        Samples to include (defaults to all samples of the experiment)
+    transform: str or dict (optional)
+        Transform to apply, see FileGroup.load_population_df
+    load_njobs: int (default=1)
+        Number of samples to load in parallel; -1 will use all available cores
+    random_state: int (optional)
+        Seed for reproducible sampling
+    verbose: bool (default=True)
+
+    Returns
+    -------
+    Pandas.DataFrame
+        Sampled events with the additional columns "sample_id" and "population_label"
+    """
+    sample_ids = sample_ids or list(experiment.list_samples())
+    seeds = np.random.SeedSequence(random_state).spawn(len(sample_ids))
+
+    def load(x: tuple) -> pd.DataFrame:
+        sample_id, seed = x
+        filegroup = experiment.get_sample(sample_id)
+        rng = np.random.default_rng(seed)
+        strata = list()
+        for pop in populations:
+            df = filegroup.load_population_sample(population=pop,
+                                                  sample_size=sample_size,
+                                                  transform=transform,
+                                                  random_state=rng)
+            df["sample_id"] = sample_id
+            df["population_label"] = pop
+            strata.append(df)
+        return pd.concat(strata)
+
+    return pd.concat(_map_samples(load, list(zip(sample_ids, seeds)), njobs=load_njobs, verbose=verbose))
 
 
 def _sample_filegroup(filegroup: FileGroup,
@@ -231,6 +335,7 @@ def _sample_filegroup(filegroup: FileGroup,
                       transform: str or None,
                       sample_size: int or float = 5000,
                       sampling_method: str or None = None,
+                      random_state: int or np.random.Generator or None = None,
                       **kwargs) -> pd.DataFrame:
     """
     Given a FileGroup and the name of the desired population, load the
@@ -243,19 +348,23 @@ def _sample_filegroup(filegroup: FileGroup,
     transform: str (optional)
     sample_size: int or float (optional)
     sampling_method: str (optional)
+    random_state: int or Numpy.random.Generator (optional)
 
     Returns
     -------
     Pandas.DataFrame
     """
+    if sampling_method == "uniform":
+        return filegroup.load_population_sample(population=population,
+                                                sample_size=sample_size,
+                                                transform=transform,
+                                                random_state=random_state)
     data = filegroup.load_population_df(population=population,
                                         transform=transform)
-    if sampling_method == "uniform":
-        return uniform_downsampling(data=data, sample_size=sample_size)
     if sampling_method == "density":
-        return density_dependent_downsampling(data=data, sample_size=sample_size, **kwargs)
+        return density_dependent_downsampling(data=data, sample_size=sample_size, random_state=random_state, **kwargs)
     if sampling_method == "faithful":
-        return faithful_downsampling(data=data, **kwargs)
+        return data.iloc[faithful_downsampling(data=data.values, random_state=random_state, **kwargs)]
     return data
 
 
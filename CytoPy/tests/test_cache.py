@@ -0,0 +1,31 @@
+from ..cache import ArrayCache
+import numpy as np
+
+
+def test_eviction():
+    cache = ArrayCache(max_bytes=2000)
+    for source in ["a", "b", "c"]:
+        cache.put(("test.hdf5", source), np.zeros((100, 1)), ["x"], ["x"])
+    assert ("test.hdf5", "a") not in cache
+    assert cache.nbytes == 1600
+    cache.get(("test.hdf5", "b"))
+    cache.put(("test.hdf5", "d"), np.zeros((100, 1)), ["x"], ["x"])
+    assert ("test.hdf5", "b") in cache
+    assert ("test.hdf5", "c") not in cache
+    cache.put(("test.hdf5", "e"), np.zeros((1000, 1)), ["x"], ["x"])
+    assert ("test.hdf5", "e") not in cache
+    cache.max_bytes = 800
+    assert len(cache) == 1
+    assert ("test.hdf5", "d") in cache
+
+
+def test_invalidate():
+    cache = ArrayCache(max_bytes=10000)
+    for key in [("a.hdf5", "primary"), ("a.hdf5", "ctrl"), ("a.hdf5", "ctrl", "x"), ("b.hdf5", "primary")]:
+        cache.put(key, np.zeros(10))
+    cache.invalidate("a.hdf5", "ctrl")
+    assert len(cache) == 2
+    assert ("a.hdf5", "primary") in cache
+    cache.invalidate("a.hdf5")
+    assert list(cache._entries.keys()) == [("b.hdf5", "primary")]
+    assert cache.nbytes == 80
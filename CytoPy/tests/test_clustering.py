@@ -1,5 +1,11 @@
 from ..data.project import Project
 from ..flow.clustering.main import *
+from ..flow.clustering.main import _meta_preprocess
+from ..flow.clustering.flowsom import winning_nodes, SOM, FlowSOM
+from ..flow.clustering.consensus import ConsensusCluster
+from sklearn.cluster import AgglomerativeClustering, KMeans
+from sklearn.datasets import make_blobs
+from minisom import MiniSom
 from .test_gating_strategy import example_experiment
 import pytest
 import h5py
@@ -28,6 +34,16 @@ def multi_sample_data(example_experiment):
                      verbose=True)
 
 
+@pytest.fixture
+def louvain_tmpdir(tmp_path, monkeypatch):
+    """
+    PhenoGraph writes the graph for Louvain community detection to the working directory;
+    returns a callable that changes the working directory to a temporary directory, to be
+    called once data has been loaded from the paths relative to the original working directory
+    """
+    return lambda: monkeypatch.chdir(tmp_path)
+
+
 def test_load_data(example_experiment):
     data = load_data(experiment=multisample_experiment(example_experiment),
                      population="root",
@@ -82,8 +98,9 @@ def test_sklearn_global_clustering(example_experiment):
     assert len(data.cluster_id.unique()) > 1
 
 
-def test_phenograph_clustering(example_experiment):
+def test_phenograph_clustering(example_experiment, louvain_tmpdir):
     data = multi_sample_data(example_experiment)
+    louvain_tmpdir()
     data, graph, q = phenograph_clustering(data=data,
                                            features=FEATURES,
                                            verbose=True,
@@ -94,8 +111,9 @@ def test_phenograph_clustering(example_experiment):
         assert len(df.cluster_id.unique()) > 1
 
 
-def test_phenograph_global_clustering(example_experiment):
+def test_phenograph_global_clustering(example_experiment, louvain_tmpdir):
     data = multi_sample_data(example_experiment)
+    louvain_tmpdir()
     data, graph, q = phenograph_clustering(data=data,
                                            features=FEATURES,
                                            verbose=True,
@@ -104,6 +122,24 @@ def test_phenograph_global_clustering(example_experiment):
     assert len(data.cluster_id.unique()) > 1
 
 
+@pytest.mark.parametrize("norm_method,summary_method", [(None, "median"), ("norm", "median"),
+                                                        ("standard", "mean"), ("robust", "median")])
+def test_meta_preprocess(norm_method, summary_method):
+    x, labels = make_blobs(n_samples=3000, n_features=3, centers=4, random_state=42)
+    data = pd.DataFrame(x, columns=["X", "Y", "Z"], index=np.arange(3000) * 2)
+    data["cluster_id"] = labels
+    data["sample_id"] = np.repeat(["sample 1", "sample 2"], 1500)
+    metadata = _meta_preprocess(data, ["X", "Y", "Z"], summary_method, norm_method)
+    assert metadata.shape == (8, 6)
+    assert metadata.meta_label.isnull().all()
+    f = np.median if summary_method == "median" else np.mean
+    for _, row in metadata.iterrows():
+        df = data[(data.sample_id == row.sample_id) & (data.cluster_id == row.cluster_id)][["X", "Y", "Z"]].values
+        if norm_method is not None:
+            df = scaler(df, scale_method=norm_method, return_scaler=False)
+        assert np.allclose(row[["X", "Y", "Z"]].values.astype(float), f(df, axis=0))
+
+
 def test_sklearn_metaclustering_invalid(example_experiment):
     data = dummy_data(example_experiment)
     with pytest.raises(AssertionError) as err:
@@ -132,8 +168,9 @@ def test_sklearn_metaclustering(example_experiment):
         assert len(meta.meta_label.unique()) == 5
 
 
-def test_phenograph_metaclustering(example_experiment):
+def test_phenograph_metaclustering(example_experiment, louvain_tmpdir):
     data = multi_sample_data(example_experiment)
+    louvain_tmpdir()
     clustered, _, _ = phenograph_clustering(data=data,
                                             features=FEATURES,
                                             verbose=True,
@@ -201,6 +238,181 @@ def test_flowsom_clustering(example_experiment):
         assert len(df.cluster_id.unique()) > 1
 
 
+@pytest.mark.parametrize("njobs", [1, 2])
+def test_cluster_samples(njobs):
+    frames = list()
+    for i in range(3):
+        x, _ = make_blobs(n_samples=1000, n_features=3, centers=3, random_state=i)
+        df = pd.DataFrame(x, columns=["X", "Y", "Z"])
+        df["sample_id"] = f"sample {i}"
+        frames.append(df)
+    data = pd.concat(frames).sample(frac=1, random_state=42)
+    data.index = np.arange(data.shape[0]) * 2
+    data, _, _ = sklearn_clustering(data=data,
+                                    features=["X", "Y", "Z"],
+                                    method="KMeans",
+                                    verbose=False,
+                                    njobs=njobs,
+                                    n_clusters=3,
+                                    n_init=3,
+                                    random_state=42)
+    for _id, df in data.groupby("sample_id"):
+        expected = KMeans(n_clusters=3, n_init=3, random_state=42).fit_predict(df[["X", "Y", "Z"]].values)
+        assert np.array_equal(df.cluster_id.values, expected)
+
+
+@pytest.mark.parametrize("njobs", [1, 2])
+def test_cluster_samples_edge_cases(njobs):
+    data = pd.DataFrame(columns=["X", "Y", "sample_id"])
+    data, _, _ = sklearn_clustering(data=data, features=["X", "Y"], method="KMeans", verbose=False, njobs=njobs)
+    assert data.shape[0] == 0
+    x, _ = make_blobs(n_samples=1000, n_features=2, centers=3, random_state=42)
+    data = pd.DataFrame(x, columns=["X", "Y"]).astype(object)
+    data["sample_id"] = np.repeat(["sample 1", "sample 2", None], [400, 400, 200])
+    data, _, _ = sklearn_clustering(data=data,
+                                    features=["X", "Y"],
+                                    method="KMeans",
+                                    verbose=False,
+                                    njobs=njobs,
+                                    n_clusters=3,
+                                    n_init=3)
+    assert data.cluster_id.isnull().sum() == 200
+    assert data.cluster_id[data.sample_id.isnull()].isnull().all()
+
+
+@pytest.mark.parametrize("njobs,chunk_size", [(1, 10000), (2, 333)])
+def test_winning_nodes(njobs, chunk_size):
+    data = np.random.normal(size=(2000, 5))
+    som = MiniSom(10, 10, 5, random_seed=42)
+    som.random_weights_init(data)
+    weights = som.get_weights().reshape(100, 5)
+    winners = winning_nodes(data=data, weights=weights, chunk_size=chunk_size, njobs=njobs, verbose=False)
+    expected = [np.ravel_multi_index(som.winner(x), (10, 10)) for x in data]
+    assert np.array_equal(winners, expected)
+
+
+@pytest.mark.parametrize("neighborhood_function", ["gaussian", "mexican_hat", "bubble", "triangle"])
+def test_som_neighborhood_sums(neighborhood_function):
+    som = SOM(6, 4, 3, sigma=2., neighborhood_function=neighborhood_function, random_seed=42)
+    sums = np.random.normal(size=(24, 3))
+    counts = np.random.randint(0, 5, size=24).astype(float)
+    sums[counts == 0] = 0
+    h = som.neighborhood(bmus=np.arange(24), sigma=1.5)
+    numerator, denominator = som._neighborhood_sums(sums=sums, counts=counts, sigma=1.5)
+    assert np.allclose(numerator, h.T @ sums)
+    assert np.allclose(denominator, h.T @ counts)
+
+
+def test_som_train():
+    data, _ = make_blobs(n_samples=5000, n_features=4, centers=5, random_state=42)
+
+    def quantization_error(weights):
+        return np.linalg.norm(data - weights[winning_nodes(data, weights, verbose=False)], axis=1).mean()
+
+    trained = list()
+    for njobs in [1, 1, 2]:
+        som = SOM(8, 8, 4, random_seed=42)
+        som.random_weights_init(data)
+        initial_error = quantization_error(som.get_weights().reshape(64, 4))
+        som.train(data, epochs=3, batch_size=100, njobs=njobs, verbose=False)
+        weights = som.get_weights().reshape(64, 4)
+        assert quantization_error(weights) < initial_error
+        trained.append(weights)
+    assert np.array_equal(trained[0], trained[1])
+    assert np.allclose(trained[0], trained[2])
+
+
+def test_flowsom_train_native():
+    data, _ = make_blobs(n_samples=3000, n_features=3, centers=3, random_state=42)
+    cluster = FlowSOM(data=pd.DataFrame(data, columns=["X", "Y", "Z"]), features=["X", "Y", "Z"], verbose=False)
+    cluster.train(som_dim=(5, 5), engine="native", minibatch_size=100, njobs=1)
+    assert isinstance(cluster.map, SOM)
+    assert cluster.flatten_weights.shape == (25, 3)
+    cluster.train(som_dim=(5, 5))
+    assert isinstance(cluster.map, MiniSom)
+
+
+def test_flowsom_train_invalid_engine():
+    data, _ = make_blobs(n_samples=500, n_features=3, random_state=42)
+    cluster = FlowSOM(data=pd.DataFrame(data, columns=["a", "b", "c"]), features=["a", "b", "c"], verbose=False)
+    with pytest.raises(ValueError):
+        cluster.train(som_dim=(5, 5), engine="invalid")
+
+
+def test_consensus_matrix():
+    data, _ = make_blobs(n_samples=200, n_features=3, centers=4, random_state=42)
+    cc = ConsensusCluster(cluster=AgglomerativeClustering,
+                          smallest_cluster_n=2,
+                          largest_cluster_n=6,
+                          n_resamples=5,
+                          verbose=False,
+                          njobs=2)
+    consensus = cc._consensus_matrix(data=data, k=3, seed=np.random.SeedSequence(42))
+    assert consensus.dtype == np.float32
+    # Brute force: for each pair of observations sampled together, the proportion clustered together
+    together, sampled = np.zeros((200, 200)), np.zeros((200, 200))
+    for resample_seed in np.random.SeedSequence(42).spawn(5):
+        idx, resample_data = cc._internal_resample(data, 0.5, np.random.default_rng(resample_seed))
+        labels = AgglomerativeClustering(n_clusters=3).fit_predict(resample_data)
+        for a in range(len(idx)):
+            for b in range(len(idx)):
+                sampled[idx[a], idx[b]] += 1
+                together[idx[a], idx[b]] += labels[a] == labels[b]
+    expected = together / (sampled + 1e-8)
+    np.fill_diagonal(expected, 1)
+    assert np.allclose(consensus, expected, atol=1e-5)
+
+
+def test_consensus_cluster_fit():
+    data, _ = make_blobs(n_samples=300, n_features=3, centers=4, cluster_std=0.5, random_state=42)
+    fits = list()
+    for njobs in [1, 2]:
+        cc = ConsensusCluster(cluster=AgglomerativeClustering,
+                              smallest_cluster_n=2,
+                              largest_cluster_n=8,
+                              n_resamples=10,
+                              verbose=False,
+                              njobs=njobs,
+                              random_state=42)
+        cc.fit(data)
+        assert cc.Ak.shape == (6,)
+        assert cc.deltaK.shape == (5,)
+        assert cc.Mk.shape == (300, 300)
+        assert len(np.unique(cc.predict_data(data))) == cc.bestK
+        seed = np.random.SeedSequence(42).spawn(6)[cc.bestK - 2]
+        assert np.array_equal(cc.Mk, cc._consensus_matrix(data=data, k=cc.bestK, seed=seed))
+        fits.append(cc)
+    assert np.array_equal(fits[0].Ak, fits[1].Ak)
+    assert fits[0].bestK == fits[1].bestK
+
+
+def test_flowsom_clustering_serial_single_thread(monkeypatch):
+    data, _ = make_blobs(n_samples=600, n_features=3, centers=3, random_state=42)
+    data = pd.DataFrame(data, columns=["a", "b", "c"])
+    data["sample_id"] = np.repeat(["s1", "s2"], 300)
+    njobs = list()
+    meta_cluster, predict = FlowSOM.meta_cluster, FlowSOM.predict
+
+    def record_meta_cluster(self, *args, **kwargs):
+        njobs.append(kwargs.get("njobs", 1))
+        return meta_cluster(self, *args, **kwargs)
+
+    def record_predict(self, *args, **kwargs):
+        njobs.append(kwargs.get("njobs", 1))
+        return predict(self, *args, **kwargs)
+    monkeypatch.setattr(FlowSOM, "meta_cluster", record_meta_cluster)
+    monkeypatch.setattr(FlowSOM, "predict", record_predict)
+    data, _, _ = flowsom_clustering(data=data,
+                                    features=["a", "b", "c"],
+                                    meta_cluster_class=AgglomerativeClustering,
+                                    verbose=False,
+                                    training_kwargs={"som_dim": (5, 5)},
+                                    meta_cluster_kwargs={"min_n": 2, "max_n": 5},
+                                    njobs=1)
+    assert data.cluster_id.notnull().all()
+    assert njobs == [1, 1, 1, 1]
+
+
 def test_flowsom_global_clustering(example_experiment):
     data = multi_sample_data(example_experiment)
     data, _, _ = flowsom_clustering(data=data,
@@ -235,11 +447,12 @@ def test_clustering_check_null(example_experiment):
     assert len(features) == len(FEATURES) - 1
 
 
-def test_clustering_cluster(example_experiment):
+def test_clustering_cluster(example_experiment, louvain_tmpdir):
     exp = multisample_experiment(example_experiment)
     c = Clustering(experiment=exp,
                    tag="test",
                    features=FEATURES)
+    louvain_tmpdir()
     c.cluster(phenograph_clustering)
     assert len(c.data["cluster_id"].unique()) > 1
 
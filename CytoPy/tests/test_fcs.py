@@ -1,4 +1,6 @@
 from CytoPy.data.fcs import FileGroup
+from CytoPy.data import fcs, population
+import h5py
 from CytoPy.data.project import Project
 from CytoPy.data.population import Cluster, Population
 import pandas as pd
@@ -92,6 +94,107 @@ def test_access_data(example_filegroup, source, sample_size):
         assert df.shape == (30000, 7)
 
 
+@pytest.mark.parametrize("cache", [False, True])
+def test_access_data_columns_and_idx(example_filegroup, cache):
+    fg = example_filegroup
+    full = fg.data("primary", cache=cache)
+    columns = list(full.columns[[3, 0]])
+    idx = np.random.choice(full.index.values, 500, replace=False)
+    df = fg.data("primary", columns=columns, idx=idx)
+    assert df.shape == (500, 2)
+    assert list(df.columns) == columns
+    assert np.array_equal(df.index.values, idx)
+    assert np.allclose(df.values, full.loc[idx, columns].values)
+    with pytest.raises(AssertionError) as err:
+        fg.data("primary", columns=["not a column"])
+    assert "Invalid column(s)" in str(err.value)
+
+
+def test_event_cache(example_filegroup, monkeypatch):
+    fg = example_filegroup
+    fcs.event_cache.invalidate(fg.h5path)
+    fg.data("primary", columns=list(fg.data("primary").columns[:2]))
+    assert (fg.h5path, "primary") not in fcs.event_cache
+    full = fg.data("primary", cache=True)
+    assert (fg.h5path, "primary") in fcs.event_cache
+    assert (fg.h5path, "test_ctrl") not in fcs.event_cache
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Event data read from disk")
+    monkeypatch.setattr(fcs, "_read_events", fail)
+    df = fg.data("primary")
+    df.iloc[:, 0] = -1
+    assert np.array_equal(fg.data("primary").values, full.values)
+    fcs.event_cache.invalidate(fg.h5path, "primary")
+    with pytest.raises(AssertionError):
+        fg.data("primary")
+
+
+def test_access_data_mmap(example_filegroup):
+    fg = example_filegroup
+    full = fg.data("primary")
+    df = fg.data("primary", mmap=True)
+    assert np.array_equal(df.values, full.values)
+    assert not df.values.flags.writeable
+    idx = np.random.choice(full.index.values, 500, replace=False)
+    df = fg.data("primary", columns=list(full.columns[:2]), idx=idx, mmap=True)
+    assert np.array_equal(df.values, full.loc[idx, full.columns[:2]].values)
+    fg.migrate_storage(compression="gzip", verbose=False)
+    with pytest.warns(UserWarning):
+        df = fg.data("primary", mmap=True)
+    assert np.array_equal(df.values, full.values)
+
+
+@pytest.mark.parametrize("compression,n", [(None, 500), (None, 20000), ("gzip", 500)])
+def test_read_events(tmp_path, compression, n):
+    values = np.random.default_rng(42).normal(size=(50000, 5))
+    idx = np.random.default_rng(42).choice(50000, n, replace=True)
+    with h5py.File(tmp_path / "events.hdf5", "w") as f:
+        f.create_dataset("primary", data=values, compression=compression)
+        read = fcs._read_events(dataset=f["primary"], columns=np.array([3, 0]), idx=idx)
+        assert np.array_equal(read, values[idx][:, [3, 0]])
+        assert np.array_equal(fcs._read_events(dataset=f["primary"], idx=idx), values[idx])
+
+
+@pytest.mark.parametrize("compression", ["gzip", "lzf"])
+def test_compressed_storage(compression):
+    test_project = Project(project_id="test")
+    exp = test_project.add_experiment(experiment_id="test experiment",
+                                      data_directory=f"{os.getcwd()}/test_data",
+                                      panel_definition=f"{os.getcwd()}/assets/test_panel.xlsx")
+    exp.add_new_sample(sample_id="test sample",
+                       primary_path=f"{os.getcwd()}/assets/test.FCS",
+                       controls_path={"test_ctrl": f"{os.getcwd()}/assets/test.FCS"},
+                       compensate=False,
+                       compression=compression)
+    fg = exp.get_sample(sample_id="test sample")
+    with h5py.File(fg.h5path, "r") as f:
+        for source in ["primary", "test_ctrl"]:
+            assert f[source].compression == compression
+            assert f[source].chunks == (30000, 1)
+    assert fg.data("primary").shape == (30000, 7)
+    df = fg.data("test_ctrl", columns=list(fg.data("test_ctrl").columns[:2]), idx=np.arange(100, 200))
+    assert df.shape == (100, 2)
+    test_project.delete()
+
+
+def test_migrate_storage(example_filegroup):
+    fg, populations = create_populations(filegroup=example_filegroup)
+    fg.save()
+    before = {s: fg.data(s) for s in ["primary", "test_ctrl"]}
+    fg.migrate_storage(compression="gzip", chunks=(1000, 2), verbose=False)
+    with h5py.File(fg.h5path, "r") as f:
+        for source in ["primary", "test_ctrl"]:
+            assert f[source].compression == "gzip"
+            assert f[source].chunks == (1000, 2)
+    fg = reload_file()
+    for source, df in before.items():
+        assert np.array_equal(fg.data(source).values, df.values)
+    for p in populations:
+        assert np.array_equal(fg.get_population(p.population_name).index, np.sort(p.index))
+    assert fg.load_population_df("pop3").shape == (6000, 7)
+
+
 def test_add_population(example_filegroup):
     fg, populations = create_populations(filegroup=example_filegroup)
     fg.save()
@@ -122,6 +225,85 @@ def test_add_population(example_filegroup):
     assert fg.tree.get("pop3").parent == fg.tree.get("pop2")
 
 
+def test_index_storage_encoded(example_filegroup):
+    fg, populations = create_populations(filegroup=example_filegroup)
+    fg.save()
+    with h5py.File(fg.h5path, "a") as f:
+        assert f["index/root/primary"].attrs["encoding"] == "rle"
+        assert f["index/root/primary"].shape == (2, 1)
+        # Plain indexes written by previous versions remain readable
+        del f["index/pop1/primary"]
+        f.create_dataset("index/pop1/primary", data=populations[0].index)
+    fg = reload_file()
+    for p in populations:
+        pop = fg.get_population(p.population_name)
+        assert np.array_equal(np.sort(pop.index), np.sort(p.index))
+        assert np.array_equal(pop.ctrl_index.get("test_ctrl"), np.sort(p.ctrl_index.get("test_ctrl")))
+        assert np.array_equal(pop.clusters[0].index, np.sort(p.clusters[0].index))
+
+
+def test_incremental_save(example_filegroup, monkeypatch):
+    fg, populations = create_populations(filegroup=example_filegroup)
+    fg.save()
+    fg = reload_file()
+    assert not any([p.dirty for p in fg.populations])
+    written = []
+    write_index = fcs._write_index
+    monkeypatch.setattr(fcs, "_write_index", lambda f, key, idx: written.append(key) or write_index(f, key, idx))
+    fg.save()
+    assert written == []
+    pop2 = fg.get_population("pop2")
+    pop2.index = pop2.index[:100]
+    pop2.delete_all_clusters()
+    fg.cell_meta_labels["test"] = np.array(["a"] * 30000, dtype="U")
+    fg.delete_populations(["pop3"])
+    fg.save()
+    assert written == ["/index/pop2/primary"]
+    with h5py.File(fg.h5path, "r") as f:
+        assert "pop3" not in f["index"].keys()
+        assert len(f["clusters/pop2"].keys()) == 0
+        assert len(f["clusters/pop1"].keys()) == 1
+        assert "test" in f["cell_meta_labels"].keys()
+    fg = reload_file()
+    assert fg.get_population("pop2").n == 100
+    assert len(fg.get_population("pop2").clusters) == 0
+    assert fg.get_population("pop1").n == 24000
+    assert len(fg.get_population("pop1").clusters[0].index) == 6000
+    assert fg.cell_meta_labels["test"].shape == (30000,)
+
+
+def test_assign_cell_meta_labels(example_filegroup):
+    example_filegroup.cell_meta_labels["old"] = np.array(["a"] * 30000, dtype="U")
+    example_filegroup.save()
+    fg = reload_file()
+    fg.cell_meta_labels = {"new": np.array(["b"] * 30000, dtype="U")}
+    fg.save()
+    with h5py.File(fg.h5path, "r") as f:
+        assert list(f["cell_meta_labels"].keys()) == ["new"]
+    fg = reload_file()
+    assert list(fg.cell_meta_labels.keys()) == ["new"]
+
+
+def test_lazy_index_loading(example_filegroup, monkeypatch):
+    fg, populations = create_populations(filegroup=example_filegroup)
+    fg.save()
+    read = []
+    read_index = population._read_index
+    monkeypatch.setattr(population, "_read_index", lambda f, key: read.append(key) or read_index(f, key))
+    fg = reload_file()
+    assert read == []
+    pop1 = fg.get_population("pop1")
+    assert pop1.n == 24000
+    assert read == []
+    assert len(pop1.index) == 24000
+    assert read == ["/index/pop1/primary"]
+    assert len(pop1.ctrl_index.get("test_ctrl")) == 24000
+    assert len(pop1.clusters[0].index) == 6000
+    assert read == ["/index/pop1/primary", "/index/pop1/test_ctrl", "/clusters/pop1/test cluster_testing"]
+    fg.save()
+    assert len(read) == 3
+
+
 @pytest.mark.parametrize("pop_name,n", [("pop1", 24000), ("pop2", 12000), ("pop3", 6000)])
 def test_load_population_df(example_filegroup, pop_name, n):
     fg, populations = create_populations(filegroup=example_filegroup)
@@ -131,6 +313,69 @@ def test_load_population_df(example_filegroup, pop_name, n):
     assert df.shape == (n, 7)
 
 
+def test_load_population_df_columns(example_filegroup):
+    fg, populations = create_populations(filegroup=example_filegroup)
+    fg.save()
+    full = fg.load_population_df(population="pop2", transform="logicle")
+    columns = list(full.columns[:2])
+    df = fg.load_population_df(population="pop2", transform="logicle", columns=columns)
+    assert df.shape == (12000, 2)
+    assert np.array_equal(df.index.values, full.index.values)
+    assert np.allclose(df.values, full[columns].values)
+
+
+@pytest.mark.parametrize("transform", ["logicle", "asinh", "percentile rank"])
+def test_load_population_df_transform_cache(example_filegroup, transform, monkeypatch):
+    fg, populations = create_populations(filegroup=example_filegroup)
+    fg.save()
+    columns = list(fg.data("primary").columns[:3])
+    monkeypatch.setattr(fcs.transform_cache, "max_bytes", 0)
+    expected = fg.load_population_df(population="pop2",
+                                     transform={columns[0]: transform, columns[1]: "logicle"},
+                                     columns=columns)
+    monkeypatch.setattr(fcs.transform_cache, "max_bytes", 2 ** 29)
+    df = fg.load_population_df(population="pop2",
+                               transform={columns[0]: transform, columns[1]: "logicle"},
+                               columns=columns)
+    assert (fg.h5path, "primary", fg.columns_default, columns[1], "logicle") in fcs.transform_cache
+    assert np.allclose(df.values, expected.values)
+    assert np.array_equal(df.index.values, expected.index.values)
+    df = fg.load_population_df(population="pop3", transform=transform, columns=columns)
+    expected = fg.data("primary", columns=columns, idx=fg.get_population("pop3").index)
+    assert np.allclose(df.values, fcs.apply_transform(expected, transform_method=transform).values)
+
+
+@pytest.mark.parametrize("cache_bytes", [0, 2 ** 29])
+def test_load_population_df_transform_wider_than_columns(example_filegroup, cache_bytes, monkeypatch):
+    fg, populations = create_populations(filegroup=example_filegroup)
+    fg.save()
+    monkeypatch.setattr(fcs.transform_cache, "max_bytes", cache_bytes)
+    columns = list(fg.data("primary").columns[:2])
+    df = fg.load_population_df(population="pop2",
+                               transform={columns[0]: "percentile rank", columns[1]: "logicle"},
+                               columns=[columns[1]])
+    assert list(df.columns) == [columns[1]]
+    expected = fg.load_population_df(population="pop2", transform="logicle", columns=[columns[1]])
+    assert np.allclose(df.values, expected.values)
+
+
+@pytest.mark.parametrize("transform", ["logicle", "percentile rank", None])
+def test_load_population_sample(example_filegroup, transform):
+    fg, populations = create_populations(filegroup=example_filegroup)
+    fg.save()
+    fcs.event_cache.clear()
+    df = fg.load_population_sample(population="pop2", sample_size=1000, transform=transform, random_state=42)
+    assert df.shape == (1000, 7)
+    assert np.isin(df.index.values, fg.get_population("pop2").index).all()
+    if transform != "percentile rank":
+        # Only the sampled events are read, the event matrix is not cached
+        assert (fg.h5path, "primary") not in fcs.event_cache
+    expected = fg.load_population_df(population="pop2", transform=transform)
+    assert np.allclose(df.values, expected.loc[df.index].values)
+    repeat = fg.load_population_sample(population="pop2", sample_size=1000, transform=transform, random_state=42)
+    assert np.array_equal(df.index.values, repeat.index.values)
+
+
 @pytest.mark.parametrize("pop_name,n", [("pop1", 24000), ("pop2", 12000), ("pop3", 6000)])
 def test_load_ctrl_population_df(example_filegroup, pop_name, n):
     fg, populations = create_populations(filegroup=example_filegroup)
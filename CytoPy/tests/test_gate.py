@@ -9,6 +9,7 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import pytest
+import copy
 
 np.random.seed(42)
 
@@ -292,6 +293,30 @@ def test_threshold_2d():
     assert len(np.intersect1d(x_neg, y_neg)) == results.get("--").shape[0]
 
 
+def test_threshold_labels():
+    x = np.random.normal(loc=1., scale=1.5, size=1000)
+    y = np.random.normal(loc=1., scale=1.5, size=1000)
+    x[:10] = np.nan
+    data = pd.DataFrame({"X": x, "Y": y}, index=np.arange(1000) * 2)
+    labels, definitions = gate.threshold_labels(data=data, x="X", x_threshold=0.5)
+    assert labels.dtype == np.int8
+    assert definitions == ["+", "-"]
+    assert (labels[:10] == -1).all()
+    expected = gate.threshold_1d(data=data, x="X", x_threshold=0.5)
+    for i, d in enumerate(definitions):
+        assert np.array_equal(data.index.values[labels == i], expected[d].index.values)
+    labels, definitions = gate.threshold_labels(data=data, x="X", x_threshold=0.5, y="Y", y_threshold=0.5)
+    assert definitions == ["++", "--", "+-", "-+"]
+    assert (labels[:10] == -1).all()
+    with np.errstate(invalid="ignore"):
+        masks = {"++": (x >= 0.5) & (y >= 0.5),
+                 "--": (x < 0.5) & (y < 0.5),
+                 "+-": (x >= 0.5) & (y < 0.5),
+                 "-+": (x < 0.5) & (y >= 0.5)}
+    for i, d in enumerate(definitions):
+        assert np.array_equal(labels == i, masks[d])
+
+
 def test_smoothed_peak_finding():
     n1 = np.random.normal(loc=0.2, scale=1, size=500)
     n2 = np.random.normal(loc=2.5, scale=0.2, size=250)
@@ -303,6 +328,38 @@ def test_smoothed_peak_finding():
     assert len(peaks) == 2
 
 
+def test_kde_cache():
+    gate.kde_cache.clear()
+    data = np.random.normal(loc=2, scale=1, size=1000)
+    x, y = gate.kde(data, kernel="gaussian", bw="silverman")
+    expected_x, expected_y = FFTKDE(kernel="gaussian", bw="silverman").fit(data).evaluate()
+    assert np.array_equal(x, expected_x)
+    assert np.array_equal(y, expected_y)
+    assert not y.flags.writeable
+    x_, y_ = gate.kde(data.copy(), kernel="gaussian", bw="silverman")
+    assert np.shares_memory(y, y_)
+    assert len(gate.kde_cache) == 1
+    gate.kde(data, kernel="gaussian", bw=0.5)
+    gate.kde(data[:-1], kernel="gaussian", bw="silverman")
+    assert len(gate.kde_cache) == 3
+
+
+def test_threshold_fit_reuses_kde():
+    gate.kde_cache.clear()
+    data = pd.DataFrame({"X": np.hstack([np.random.normal(loc=0.2, scale=1, size=500),
+                                         np.random.normal(loc=6.5, scale=0.5, size=500)])})
+    g = gate.ThresholdGate(gate_name="test",
+                           parent="test parent",
+                           x="X",
+                           method="density")
+    thresholds = list()
+    for min_peak_threshold in [0.05, 0.1, 0.2]:
+        g.method_kwargs = {"min_peak_threshold": min_peak_threshold}
+        thresholds.append(g._fit(data=data))
+    assert len(gate.kde_cache) == 1
+    assert all(t == thresholds[0] for t in thresholds)
+
+
 def test_find_local_minima():
     n1 = np.random.normal(loc=2, scale=1, size=1000)
     n2 = np.random.normal(loc=10, scale=0.5, size=1000)
@@ -527,6 +584,20 @@ def create_polygon_gate(klass,
     return gate
 
 
+def test_gate_copy():
+    g = gate.EllipseGate(gate_name="test",
+                         parent="test parent",
+                         x="X",
+                         y="Y",
+                         method="GaussianMixture",
+                         method_kwargs={"n_components": 2, "conf": 0.9})
+    g_copy = copy.deepcopy(g)
+    assert g_copy.conf == 0.9
+    assert g_copy.model is not g.model
+    assert g_copy.model.get_params() == g.model.get_params()
+    assert g_copy.method_kwargs == g.method_kwargs
+
+
 def test_polygon_add_child():
     g = create_polygon_gate(klass=gate.PolygonGate, method="MiniBatchKMeans")
     data, _ = make_blobs(n_samples=3000,
@@ -675,3 +746,19 @@ def test_polygon_fit_predict(gate):
     assert {p.population_name for p in pops} == {"Pop1", "Pop2"}
     assert sum([1900 < len(p.index) < 2100 for p in pops]) == 1
     assert sum([900 < len(p.index) < 1100 for p in pops]) == 1
+
+
+def test_ellipse_fit_masks():
+    data, labels = make_blobs(n_samples=5000,
+                              n_features=2,
+                              cluster_std=1,
+                              centers=[(1., 1.), (10., 6.2)],
+                              random_state=42)
+    data = pd.DataFrame(data, columns=["X", "Y"])
+    g = create_polygon_gate(klass=gate.EllipseGate, method="GaussianMixture", n_components=2)
+    polygons, masks = g._fit_masks(data=data)
+    assert masks.shape == (data.shape[0], 2)
+    assert masks.dtype == bool
+    # Analytic membership should agree with the polygon approximation of each ellipse
+    poly_masks = g._population_masks(data=data, polygons=polygons)
+    assert (masks == poly_masks).mean() > 0.99
@@ -1,2 +1,69 @@
+from CytoPy.data import gate
+from CytoPy.flow import gate_search
+import pandas as pd
+import numpy as np
+import pytest
 
 
+def create_threshold_gate(data: pd.DataFrame):
+    g = gate.ThresholdGate(gate_name="test",
+                           parent="test parent",
+                           x="X",
+                           method="density")
+    g.fit(data=data)
+    g.label_children({"+": "Positive", "-": "Negative"})
+    return g
+
+
+@pytest.mark.parametrize("cost", ["manhattan", "threshold_dist"])
+def test_hyperparameter_gate_parallel(cost):
+    np.random.seed(42)
+    data = pd.DataFrame({"X": np.hstack([np.random.normal(loc=0.2, scale=1, size=1000),
+                                         np.random.normal(loc=6.5, scale=0.5, size=1000)])})
+    g = create_threshold_gate(data)
+    grid = {"bw": ["silverman", 0.5, 1.], "min_peak_threshold": [0.01, 0.05]}
+    original_kwargs = g.method_kwargs.copy()
+    serial = gate_search.hyperparameter_gate(gate=g, grid=grid, cost=cost, parent=data, verbose=False, njobs=1)
+    parallel = gate_search.hyperparameter_gate(gate=g, grid=grid, cost=cost, parent=data, verbose=False, njobs=4)
+    assert g.method_kwargs == original_kwargs
+    assert [p.population_name for p in serial] == [p.population_name for p in parallel]
+    for s, p in zip(serial, parallel):
+        assert s.geom.x_threshold == p.geom.x_threshold
+        assert np.array_equal(s.index, p.index)
+
+
+@pytest.mark.parametrize("search,kwargs", [("random", {"n_iter": 3}),
+                                           ("halving", {"factor": 2, "min_events": 250})])
+def test_hyperparameter_gate_search(search, kwargs):
+    np.random.seed(42)
+    data = pd.DataFrame({"X": np.hstack([np.random.normal(loc=0.2, scale=1, size=2000),
+                                         np.random.normal(loc=6.5, scale=0.5, size=2000)])})
+    g = create_threshold_gate(data)
+    grid = {"bw": ["silverman", 0.5, 1.], "min_peak_threshold": [0.01, 0.05]}
+    pops = gate_search.hyperparameter_gate(gate=g, grid=grid, cost="threshold_dist", parent=data,
+                                           verbose=False, njobs=1, search=search, random_state=42, **kwargs)
+    assert {p.population_name for p in pops} == {"Positive", "Negative"}
+    assert sum([p.n for p in pops]) == data.shape[0]
+    assert all(2 < p.geom.x_threshold < 5 for p in pops)
+
+
+def test_successive_halving():
+    np.random.seed(42)
+    data = pd.DataFrame({"X": np.hstack([np.random.normal(loc=0.2, scale=1, size=2000),
+                                         np.random.normal(loc=6.5, scale=0.5, size=2000)])})
+    g = create_threshold_gate(data)
+    grid = [{"bw": bw} for bw in ["silverman", 0.1, 0.5, 1., 2.]]
+    populations = gate_search.successive_halving(gate=g, grid=grid, cost="threshold_dist", parent=data,
+                                                 factor=2, min_events=200, njobs=1, random_state=42,
+                                                 verbose=False)
+    assert len(populations) == 1
+    assert all(p.n > 0 for p in populations[0])
+    assert sum([p.n for p in populations[0]]) == data.shape[0]
+
+
+def test_hyperparameter_gate_invalid_search():
+    data = pd.DataFrame({"X": np.random.normal(loc=0.2, scale=1, size=100)})
+    g = gate.ThresholdGate(gate_name="test", parent="test parent", x="X", method="density")
+    with pytest.raises(ValueError):
+        gate_search.hyperparameter_gate(gate=g, grid={"bw": [0.5]}, cost="manhattan", parent=data,
+                                        verbose=False, search="bayesian")
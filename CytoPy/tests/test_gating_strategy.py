@@ -3,6 +3,7 @@ from CytoPy.data.gate import ThresholdGate, PolygonGate, EllipseGate, PolygonGeo
 from CytoPy.data.project import Project
 import matplotlib.pyplot as plt
 import pandas as pd
+import numpy as np
 import pytest
 import os
 
@@ -249,23 +250,86 @@ def test_apply_action_subtract(example_experiment):
     assert all([x in gs.filegroup.tree.keys() for x in ["subtract_pop2_pop4", "pop3", "pop4"]])
 
 
-def test_apply_all(example_experiment):
+@pytest.mark.parametrize("njobs", [1, 2])
+def test_apply_all(example_experiment, njobs):
     gs = create_gatingstrategy_and_load(example_experiment)
     with pytest.raises(AssertionError) as err:
-        gs.apply_all()
+        gs.apply_all(njobs=njobs)
     assert str(err.value) == "No gates to apply"
     gs = apply_some_gates(gs)
     exp = Project.objects(project_id="test").get().load_experiment("test experiment")
     gs.load_data(experiment=exp,
                  sample_id="test sample")
-    gs.apply_all()
+    gs.apply_all(njobs=njobs)
     assert_expected_gated_pops(gs)
     with pytest.raises(AssertionError) as err:
-        gs.apply_all()
+        gs.apply_all(njobs=njobs)
     assert str(err.value) == "One or more of the populations generated from this gating strategy are already " \
                              "presented in the population tree"
 
 
+def test_apply_all_siblings(example_experiment):
+    gs = create_gatingstrategy_and_load(example_experiment)
+    gate = create_threshold_gate()
+    gs.preview_gate(gate=gate)
+    gate.label_children(labels={"++": "pop1"})
+    gs.apply_gate(gate)
+    for i, x in enumerate(["IgG1-PC5", "CD45-ECD"]):
+        gate = create_threshold_gate()
+        gate.gate_name = f"sibling {i}"
+        gate.parent = "pop1"
+        gate.x, gate.y = x, None
+        gate.transformations = {"x": "logicle", "y": None}
+        gs.preview_gate(gate=gate)
+        gate.label_children({"+": f"sibling {i} pos", "-": f"sibling {i} neg"})
+        gs.apply_gate(gate=gate)
+    expected = {p: gs.filegroup.get_population(p).n for p in gs.list_populations()}
+    exp = Project.objects(project_id="test").get().load_experiment("test experiment")
+    gs.load_data(experiment=exp,
+                 sample_id="test sample")
+    gs.apply_all(njobs=2)
+    assert {p: gs.filegroup.get_population(p).n for p in gs.list_populations()} == expected
+
+
+def test_apply_all_control_gates(example_experiment):
+    gs = create_gatingstrategy_and_load(example_experiment)
+    for i, x in enumerate(["IgG1-PC5", "CD45-ECD"]):
+        gate = create_threshold_gate()
+        gate.gate_name = f"ctrl {i}"
+        gate.ctrl = "test_ctrl"
+        gate.x, gate.y = x, None
+        gate.transformations = {"x": "logicle", "y": None}
+        gs.preview_gate(gate=gate)
+        gate.label_children({"+": f"ctrl {i} pos", "-": f"ctrl {i} neg"})
+        gs.apply_gate(gate=gate)
+    expected = {p: gs.filegroup.get_population(p).n for p in gs.list_populations()}
+    thresholds = [c.geom.x_threshold for g in gs.gates for c in g.children]
+    exp = Project.objects(project_id="test").get().load_experiment("test experiment")
+    gs.load_data(experiment=exp,
+                 sample_id="test sample")
+    gs.apply_all(njobs=2)
+    assert {p: gs.filegroup.get_population(p).n for p in gs.list_populations()} == expected
+    assert [c.geom.x_threshold for g in gs.gates for c in g.children] == thresholds
+
+
+def test_apply_all_missing_parent(example_experiment):
+    gs = create_gatingstrategy_and_load(example_experiment)
+    gate = create_threshold_gate()
+    gs.preview_gate(gate=gate)
+    gate.label_children(labels={"++": "pop1"})
+    gs.apply_gate(gate)
+    gate = create_threshold_gate()
+    gate.gate_name = "orphan"
+    gate.parent = "missing"
+    gs.gates.append(gate)
+    exp = Project.objects(project_id="test").get().load_experiment("test experiment")
+    gs.load_data(experiment=exp,
+                 sample_id="test sample")
+    with pytest.raises(AssertionError) as err:
+        gs.apply_all(njobs=1)
+    assert "orphan" in str(err.value)
+
+
 def test_delete_gate(example_experiment):
     gs = create_gatingstrategy_and_load(example_experiment)
     gs = apply_some_gates(gs)
@@ -341,6 +405,21 @@ def test_save(example_experiment):
     assert len(gs.gates) == 3
 
 
+def test_save_float32_signatures(example_experiment):
+    gs = create_gatingstrategy_and_load(example_experiment)
+    assert (gs.filegroup.data("primary").dtypes == np.float32).any()
+    gs = apply_some_gates(gs)
+    for gate in gs.gates:
+        for child in gate.children:
+            assert all(isinstance(v, float) for v in child.signature.values())
+    gs.save()
+    fg = (Project.objects(project_id="test")
+          .get()
+          .load_experiment("test experiment")
+          .get_sample("test sample"))
+    assert {"pop1", "pop2", "pop3", "pop4"}.issubset(fg.list_populations())
+
+
 @pytest.mark.parametrize("remove_associations", [True, False])
 def test_delete(example_experiment, remove_associations):
     gs = create_gatingstrategy_and_load(example_experiment)
@@ -1,5 +1,5 @@
 from CytoPy.data.geometry import PopulationGeometry, ThresholdGeom, PolygonGeom, create_polygon, \
-    polygon_overlap, create_convex_hull, probablistic_ellipse, inside_ellipse, inside_polygon
+    polygon_overlap, create_convex_hull, probablistic_ellipse, inside_ellipse, inside_polygon, points_in_polygon
 from shapely.geometry import Polygon
 from sklearn.datasets import make_blobs
 from sklearn.mixture import GaussianMixture
@@ -109,6 +109,27 @@ def test_inside_ellipse(test_data, expected_mask):
                           width=width,
                           height=height,
                           angle=angle)
-    assert isinstance(mask, list)
+    assert isinstance(mask, np.ndarray)
+    assert mask.dtype == bool
     assert np.array_equal(mask, expected_mask)
 
+
+def test_inside_ellipse_batch():
+    test_data = np.array([[3, 4.5], [7.5, 9], [0, 0], [11, 5], [6.2, 4.3], [-3, -2]])
+    ellipses = [((5, 5), 10, 5, 15), ((0, 0), 4, 2, 0), ((-2, -2), 3, 6, 45)]
+    center, width, height, angle = [np.array(x) for x in zip(*ellipses)]
+    mask = inside_ellipse(data=test_data, center=center, width=width, height=height, angle=angle)
+    assert mask.shape == (test_data.shape[0], len(ellipses))
+    for i, e in enumerate(ellipses):
+        assert np.array_equal(mask[:, i], inside_ellipse(test_data, *e))
+
+
+def test_points_in_polygon():
+    poly = Polygon([[0, 0], [0, 10], [10, 10], [10, 0]],
+                   holes=[[[4, 4], [4, 6], [6, 6], [6, 4]]])
+    xy = np.array([[1, 1], [5, 5], [9, 5], [11, 5], [-1, -1], [3, 5]])
+    mask = points_in_polygon(xy, poly)
+    assert isinstance(mask, np.ndarray)
+    assert mask.dtype == bool
+    assert np.array_equal(mask, [True, False, True, False, False, True])
+    assert points_in_polygon(np.empty((0, 2)), poly).shape == (0,)
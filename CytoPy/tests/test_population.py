@@ -38,6 +38,50 @@ def test_create_signature():
         assert pytest.approx(z.get(i), 0.001) == np.mean(np.array(d_norm.get(i))[[1, 2]])
 
 
+@pytest.mark.parametrize("summary_method", [None, np.mean])
+def test_create_signatures(summary_method):
+    example = pd.DataFrame({"x": np.random.normal(size=1000),
+                            "y": np.random.uniform(size=1000),
+                            "Time": np.arange(1000)})
+    example["z"] = 1.
+    labels = np.random.randint(-1, 3, size=1000)
+    signatures = population.create_signatures(example, labels=labels, n_labels=4, summary_method=summary_method)
+    assert len(signatures) == 4
+    for i in range(3):
+        expected = population.create_signature(example[labels == i], summary_method=summary_method)
+        assert set(signatures[i].keys()) == {"x", "y", "z"}
+        for k, v in expected.items():
+            assert signatures[i][k] == pytest.approx(v)
+    assert signatures[3] == {}
+
+
+def test_create_signatures_masks():
+    example = pd.DataFrame({"x": np.random.normal(size=1000),
+                            "y": np.random.uniform(size=1000)},
+                           index=np.arange(1000) * 2)
+    masks = np.random.uniform(size=(1000, 3)) > 0.5
+    signatures = population.create_signatures(example, labels=masks, normalise="data")
+    assert len(signatures) == 3
+    for i in range(3):
+        expected = population.create_signature(example, idx=example.index.values[masks[:, i]])
+        for k, v in expected.items():
+            assert signatures[i][k] == pytest.approx(v)
+    with pytest.raises(ValueError):
+        population.create_signatures(example, labels=masks, normalise="invalid")
+
+
+def test_create_signatures_max_events():
+    example = pd.DataFrame({"x": np.random.normal(size=100000),
+                            "y": np.random.uniform(size=100000)})
+    labels = (example["x"].values > 0).astype(int)
+    exact = population.create_signatures(example, labels=labels)
+    approx = population.create_signatures(example, labels=labels, max_events=5000, random_state=42)
+    assert approx == population.create_signatures(example, labels=labels, max_events=5000, random_state=42)
+    for e, a in zip(exact, approx):
+        for k in ["x", "y"]:
+            assert a[k] == pytest.approx(e[k], abs=0.02)
+
+
 def test_cluster_init():
     x = population.Cluster(cluster_id="test",
                            n=1000)
@@ -134,6 +178,23 @@ def test_merge_index():
     assert np.array_equal(idx, np.array([0, 1, 2, 3, 4, 5, 8, 11, 13, 15, 19]))
 
 
+@pytest.mark.parametrize("idx", [np.arange(0, 1000),
+                                 np.array([0, 1, 2, 5, 6, 100, 101, 70000]),
+                                 np.random.choice(np.arange(0, 100000), 5000, replace=False),
+                                 np.array([], dtype=np.int64)])
+def test_encode_decode_index(idx):
+    runs = population.encode_index(idx)
+    assert runs.shape[0] == 2
+    assert np.issubdtype(runs.dtype, np.unsignedinteger)
+    assert np.array_equal(population.decode_index(runs), np.sort(idx))
+
+
+def test_encode_index_compact():
+    runs = population.encode_index(np.concatenate([np.arange(0, 5000), np.arange(6000, 8000)]))
+    assert np.array_equal(runs, np.array([[0, 1000], [5000, 2000]]))
+    assert runs.dtype == np.uint16
+
+
 def test_merge_signatures():
     x = population.Population(population_name="test")
     x.signature = dict(x=10., y=10., z=20.)
@@ -0,0 +1,94 @@
+from CytoPy.flow import sampling
+from sklearn.datasets import make_blobs
+import pandas as pd
+import numpy as np
+import pytest
+
+
+def _blobs(n_samples: int = 5000):
+    data, _ = make_blobs(n_samples=n_samples,
+                         n_features=2,
+                         centers=[(1., 1.), (6., 6.), (1., 8.)],
+                         cluster_std=[0.5, 1., 2.],
+                         random_state=42)
+    return pd.DataFrame(data, columns=["X", "Y"])
+
+
+@pytest.mark.parametrize("local_d,expected",
+                         [(0, 0.), (2, 0.), (3, 1.), (5, 1.), (10, 0.5)])
+def test_prob_downsample(local_d, expected):
+    assert sampling.prob_downsample(local_d, target_d=5, outlier_d=2) == expected
+
+
+def test_prob_downsample_array():
+    local_d = np.array([0, 2, 3, 5, 10, 20])
+    prob = sampling.prob_downsample(local_d, target_d=5, outlier_d=2)
+    assert isinstance(prob, np.ndarray)
+    assert np.array_equal(prob, [0., 0., 1., 1., 0.5, 0.25])
+
+
+@pytest.mark.parametrize("njobs,chunk_size", [(1, 50000), (2, 333)])
+def test_density_probability_assignment(njobs, chunk_size):
+    data = _blobs()
+    sample = data.sample(n=500, random_state=42)
+    prob = sampling.density_probability_assignment(sample=sample,
+                                                   data=data,
+                                                   njobs=njobs,
+                                                   chunk_size=chunk_size)
+    assert prob.shape == (data.shape[0],)
+    assert ((prob >= 0) & (prob <= 1)).all()
+    tree = sampling.KDTree(sample, metric="manhattan")
+    dist = np.median(tree.query(data, k=2)[0][:, 1]) * 5
+    ld = tree.query_radius(data, r=dist, count_only=True)
+    od, td = np.percentile(ld, q=1), np.percentile(ld, q=5)
+    expected = [sampling.prob_downsample(x, target_d=td, outlier_d=od) for x in ld]
+    assert np.allclose(prob, expected)
+
+
+def test_density_dependent_downsampling():
+    data = _blobs()
+    sample = sampling.density_dependent_downsampling(data=data, sample_size=1000, njobs=1)
+    assert sample.shape == (1000, 2)
+    assert sample.index.isin(data.index).all()
+
+
+@pytest.mark.parametrize("batch_size", [10000, 7])
+def test_faithful_downsampling(batch_size):
+    data = _blobs()
+    h = 0.5
+    idx = sampling.faithful_downsampling(data=data.values, h=h, batch_size=batch_size)
+    assert 0 < idx.shape[0] < data.shape[0]
+    assert np.array_equal(idx, np.unique(idx))
+    tree = sampling.BallTree(data.values[idx])
+    # Representatives are separated by more than h and every event is within h of a representative
+    assert (tree.query(data.values[idx], k=2)[0][:, 1] > h).all()
+    assert (tree.query(data.values, k=1)[0][:, 0] <= h).all()
+    sample = data.iloc[idx]
+    assert np.array_equal(sample.index.values, data.index.values[idx])
+
+
+@pytest.mark.parametrize("sample_size,expected", [(100, 100), (0.1, 500), (10000, 5000)])
+def test_uniform_sample_idx(sample_size, expected):
+    idx = sampling.uniform_sample_idx(n_events=5000, sample_size=sample_size, random_state=42)
+    assert idx.shape[0] == expected
+    assert np.array_equal(idx, np.unique(idx))
+    assert np.array_equal(idx, sampling.uniform_sample_idx(n_events=5000, sample_size=sample_size, random_state=42))
+
+
+@pytest.mark.parametrize("method,kwargs", [("uniform", {"sample_size": 500}),
+                                           ("density", {"sample_size": 500, "njobs": 1}),
+                                           ("faithful", {"h": 0.5})])
+def test_sample_idx(method, kwargs):
+    data = _blobs()
+    data.index = data.index.values * 2
+    idx = sampling.sample_idx(data=data, method=method, features=["X", "Y"], random_state=42, **kwargs)
+    assert idx.dtype.kind == "i"
+    assert 0 < idx.shape[0] < data.shape[0]
+    assert np.array_equal(idx, sampling.sample_idx(data=data, method=method, features=["X", "Y"],
+                                                   random_state=42, **kwargs))
+    assert np.array_equal(data.iloc[idx].index.values, idx * 2)
+
+
+def test_sample_idx_invalid():
+    with pytest.raises(ValueError):
+        sampling.sample_idx(data=_blobs(), method="invalid")
@@ -0,0 +1,65 @@
+from CytoPy.data.project import Project
+from CytoPy.data.population import Population
+from CytoPy.flow import variance
+import pandas as pd
+import numpy as np
+import pytest
+import os
+
+
+@pytest.fixture
+def example_experiment():
+    test_project = Project(project_id="test")
+    exp = test_project.add_experiment(experiment_id="test experiment",
+                                      data_directory=f"{os.getcwd()}/test_data",
+                                      panel_definition=f"{os.getcwd()}/assets/test_panel.xlsx")
+    for sample_id in ["sample 1", "sample 2"]:
+        exp.add_new_sample(sample_id=sample_id,
+                           primary_path=f"{os.getcwd()}/assets/test.FCS",
+                           compensate=False)
+        fg = exp.get_sample(sample_id)
+        data = fg.data("primary").sample(frac=0.5, random_state=42)
+        fg.add_population(Population(population_name="pop1",
+                                     n=data.shape[0],
+                                     parent="root",
+                                     index=data.index.values))
+        fg.save()
+    yield exp
+    test_project.delete()
+
+
+@pytest.mark.parametrize("load_njobs", [1, 2])
+def test_load_and_sample(example_experiment, load_njobs):
+    data = variance.load_and_sample(experiment=example_experiment,
+                                    population="pop1",
+                                    sample_size=1000,
+                                    transform="logicle",
+                                    load_njobs=load_njobs,
+                                    random_state=42)
+    assert list(data.keys()) == ["sample 1", "sample 2"]
+    for sample_id, df in data.items():
+        assert df.shape == (1000, 7)
+        pop_idx = example_experiment.get_sample(sample_id).get_population("pop1").index
+        assert np.isin(df.index.values, pop_idx).all()
+    repeat = variance.load_and_sample(experiment=example_experiment,
+                                      population="pop1",
+                                      sample_size=1000,
+                                      transform="logicle",
+                                      load_njobs=load_njobs,
+                                      random_state=42)
+    for sample_id, df in data.items():
+        assert np.array_equal(df.index.values, repeat[sample_id].index.values)
+
+
+def test_stratified_sample(example_experiment):
+    data = variance.stratified_sample(experiment=example_experiment,
+                                      populations=["root", "pop1"],
+                                      sample_size=500,
+                                      transform=None,
+                                      load_njobs=2,
+                                      random_state=42)
+    assert isinstance(data, pd.DataFrame)
+    assert data.shape[0] == 2000
+    counts = data.groupby(["sample_id", "population_label"]).size()
+    assert (counts == 500).all()
+    assert len(counts) == 4